@@ -4,6 +4,8 @@ Created on Wed Aug 16 10:53:19 2017
 
 @author: Diego L.Guarin -- diego_guarin at meei.harvard.edu
 """
+import time
+from collections import deque
 import cv2
 import numpy as np
 from scipy.spatial.distance import cdist
@@ -11,18 +13,142 @@ from scipy.spatial.distance import cdist
 from PyQt5 import QtWidgets
 from PyQt5 import QtGui
 from PyQt5 import QtCore
+try:
+    from PyQt5 import sip
+except ImportError:
+    # PyQt5 older than 5.11
+    import sip
 
-
-from utilities import mark_picture  #this function draws the landmarks and iris circles 
+from utilities import get_landmark_size
 from process_eye import get_iris_manual #this function opens a new window to manually select the iris
 
 
+"""
+The landmarks, iris circles and the lines in the middle of the face are items
+of the scene that stay there from frame to frame, only their positions change.
+The frame pixels are never drawn on.
+"""
+
+# frames are shown in the BGR order of OpenCV when Qt supports it (Qt 5.14 and later)
+FORMAT_BGR888 = getattr(QtGui.QImage, 'Format_BGR888', None)
+
+# landmarks (numbered from 1) drawn in yellow, as in mark_picture
+YELLOW_LANDMARKS = (38, 39, 44, 45, 62, 63, 64)
+# landmarks drawn one pixel larger
+LARGE_LANDMARKS = (63, 67)
+
+
+class LandmarkOverlay(QtWidgets.QGraphicsItemGroup):
+    """
+    Group with one dot and one label for each of the 68 landmarks, two iris
+    circles (with their centers) and the three lines of estimate_lines.
+    set_landmarks(shape, points, lefteye, righteye, landmark_size, image_height)
+    moves the items, lifted landmarks (x <= 0) and missing parts are hidden.
+    All the positions are in video pixels, as the scene.
+    """
+
+    def __init__(self):
+        super(LandmarkOverlay, self).__init__()
+        self.setZValue(1)  # above the frame
+        self._size = None
+
+        self.dots = []
+        self.labels = []
+        for number in range(1, 69):
+            dot = QtWidgets.QGraphicsEllipseItem()
+            dot.setPen(QtGui.QPen(QtCore.Qt.NoPen))
+            colour = QtCore.Qt.yellow if number in YELLOW_LANDMARKS else QtCore.Qt.red
+            dot.setBrush(QtGui.QBrush(colour))
+            label = QtWidgets.QGraphicsSimpleTextItem(str(number), dot)
+            label.setBrush(QtGui.QBrush(QtCore.Qt.black))
+            self.addToGroup(dot)
+            self.dots.append(dot)
+            self.labels.append(label)
+
+        self.irises = []
+        for _ in range(2):
+            circle = QtWidgets.QGraphicsEllipseItem()
+            circle.setBrush(QtGui.QBrush(QtCore.Qt.NoBrush))
+            center = QtWidgets.QGraphicsEllipseItem(circle)
+            center.setPen(QtGui.QPen(QtCore.Qt.NoPen))
+            center.setBrush(QtGui.QBrush(QtCore.Qt.green))
+            self.addToGroup(circle)
+            self.irises.append(circle)
+
+        self.lines = []
+        for _ in range(3):
+            line = QtWidgets.QGraphicsLineItem()
+            self.addToGroup(line)
+            self.lines.append(line)
+
+    def set_size(self, size, image_height):
+        # size of the dots and labels and width of the lines, changed only when needed
+        if (size, image_height) == self._size:
+            return
+        self._size = (size, image_height)
+        font = QtGui.QFont()
+        # same height as the cv2.putText labels of mark_picture
+        font.setPixelSize(max(int(round(2.75 * size)), 1))
+        for number, (dot, label) in enumerate(zip(self.dots, self.labels), 1):
+            radius = size + 1 if number in LARGE_LANDMARKS else size
+            dot.setRect(-radius, -radius, 2 * radius, 2 * radius)
+            label.setFont(font)
+            label.setPos(-2, -2 - label.boundingRect().height())
+        pen = QtGui.QPen(QtCore.Qt.green)
+        pen.setWidth(2 if image_height < 1000 else 4)
+        for line in self.lines:
+            line.setPen(pen)
+        pen = QtGui.QPen(QtCore.Qt.green)
+        pen.setWidth(1 if image_height < 1000 else 3)
+        for circle in self.irises:
+            circle.setPen(pen)
+
+    def set_landmarks(self, shape, points=None, lefteye=None, righteye=None, landmark_size=None, image_height=0):
+        if shape is None:
+            self.setVisible(False)
+            return
+        if landmark_size is None:
+            landmark_size = get_landmark_size(shape)
+        self.set_size(max(landmark_size, 1), image_height)
+
+        for dot, (x, y) in zip(self.dots, shape):
+            if x > 0:
+                dot.setPos(float(x), float(y))
+                dot.setVisible(True)
+            else:
+                dot.setVisible(False)
+
+        for circle, eye in zip(self.irises, (lefteye, righteye)):
+            if eye is None or eye[2] <= 0:
+                circle.setVisible(False)
+                continue
+            x, y, radius = (float(c) for c in eye[:3])
+            circle.setRect(-radius, -radius, 2 * radius, 2 * radius)
+            circle.childItems()[0].setRect(-radius / 4, -radius / 4, radius / 2, radius / 2)
+            circle.setPos(x, y)
+            circle.setVisible(True)
+
+        for i, line in enumerate(self.lines):
+            if points is None:
+                line.setVisible(False)
+                continue
+            (x1, y1), (x2, y2) = points[2 * i], points[2 * i + 1]
+            line.setLine(float(x1), float(y1), float(x2), float(y2))
+            line.setVisible(True)
+        self.setVisible(True)
+
+
 """
 This class is in charge of drawing the picture and the landmarks in the main 
 window, it also takes care of lifting and re-location of landmarks. 
 """
 
 class ImageViewer(QtWidgets.QGraphicsView):       
+
+    # emitted when the user zooms into an image that is shown at low resolution
+    zoomed_in = QtCore.pyqtSignal()
+    # emitted when a landmark is relocated (landmark index, new x, new y)
+    landmark_moved = QtCore.pyqtSignal(int, float, float)
     
     def __init__(self):
         # usual parameters to make sure the image can be zoom-in and out and is
@@ -32,7 +158,19 @@ class ImageViewer(QtWidgets.QGraphicsView):
         self._scene = QtWidgets.QGraphicsScene(self)
         self._photo = QtWidgets.QGraphicsPixmapItem()
         self._scene.addItem(self._photo)
+        # landmarks, iris circles and lines, drawn over the frame
+        self._overlay = LandmarkOverlay()
+        self._overlay.setVisible(False)
+        self._scene.addItem(self._overlay)
+        self._show_overlay = True
         self.setScene(self._scene)
+        # the frame covers this rectangle of the scene (video pixels). Only the visible
+        # part of the frame is in the pixmap, at the resolution of the screen
+        self._frame_rect = QtCore.QRectF()
+        self._rendered = None
+        self._render_pending = False
+        self.horizontalScrollBar().valueChanged.connect(self.schedule_render)
+        self.verticalScrollBar().valueChanged.connect(self.schedule_render)
         self.setTransformationAnchor(QtWidgets.QGraphicsView.AnchorUnderMouse)
         self.setResizeAnchor(QtWidgets.QGraphicsView.AnchorUnderMouse)
         self.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
@@ -52,6 +190,20 @@ class ImageViewer(QtWidgets.QGraphicsView):
         self._points = None
         self._landmark_size = None
         self._store_old_value = None
+        # frame and scale shown by _photo, the pixmap is only created again when they change
+        self._uploaded_image = None
+        self._uploaded_scale = None
+        # the frame shown by the pixmap (it can use its memory) and the buffer used to
+        # convert frames when Qt cannot show BGR images
+        self._frame_buffer = None
+        self._rgb_buffer = None
+        # upload time of the last frame and present times of the last frames
+        self._upload_time = None
+        self._present_times = deque(maxlen=30)
+        # the image might be a low resolution version of the video frame (proxy),
+        # this is the factor that converts image pixels into video pixels. Landmarks
+        # are always in video pixels
+        self._image_scale = 1.0
 
         # this variable is used to verify is a landmark will be relocated
         self._IsPointLifted = False
@@ -70,16 +222,24 @@ class ImageViewer(QtWidgets.QGraphicsView):
         if pixmap and not pixmap.isNull():
             self.setDragMode(QtWidgets.QGraphicsView.RubberBandDrag)
             self._photo.setPixmap(pixmap)
+            self._photo.setPos(0, 0)
+            self._photo.setTransform(QtGui.QTransform.fromScale(self._image_scale, self._image_scale))
+            self._frame_rect = self._photo.mapRectToScene(QtCore.QRectF(pixmap.rect()))
+            self._scene.setSceneRect(self._frame_rect)
+            # this pixmap is not a frame, it is shown as it is
+            self._uploaded_image = None
             self.fitInView()
         else:
             self.setDragMode(QtWidgets.QGraphicsView.NoDrag)
             self._photo.setPixmap(QtGui.QPixmap())
+            self._frame_buffer = None
+            self._rendered = None
 
     def fitInView(self):
         # this function takes care of accommodating the view so that it can fit
         # in the scene, it resets the zoom to 0 (i think is a overkill, i took
         # it from somewhere else)
-        rect = QtCore.QRectF(self._photo.pixmap().rect())
+        rect = self._frame_rect
 
         if not rect.isNull():
             unity = self.transform().mapRect(QtCore.QRectF(0, 0, 1, 1))
@@ -90,6 +250,7 @@ class ImageViewer(QtWidgets.QGraphicsView):
             self.scale(factor, factor)
             self.centerOn(rect.center())
             self._zoom = 0                        
+            self.render_visible()
             
     def zoomFactor(self):
         return self._zoom
@@ -108,6 +269,10 @@ class ImageViewer(QtWidgets.QGraphicsView):
                                         
             if self._zoom > 0:
                 self.scale(factor, factor)
+                # the visible part of the frame is rendered again with more detail
+                self.render_visible()
+                if self._image_scale != 1.0:
+                    self.zoomed_in.emit()
             elif self._zoom <= 0:
                 self._zoom = 0
                 self.fitInView()
@@ -153,6 +318,7 @@ class ImageViewer(QtWidgets.QGraphicsView):
                     x_mousePos = scenePos.toPoint().x()
                     y_mousePos = scenePos.toPoint().y()
                     self._shape[self._PointToModify] = [x_mousePos, y_mousePos]
+                    self.landmark_moved.emit(self._PointToModify, x_mousePos, y_mousePos)
                     self._IsPointLifted = False
                     self._PointToModify = None
                     self.set_update_photo()
@@ -327,31 +493,126 @@ class ImageViewer(QtWidgets.QGraphicsView):
     #     self._scene.addItem(Ellipse)
 
 
+    def frame_pixmap(self, image):
+        # pixmap with a BGR frame (or a part of it). If Qt knows the BGR order the
+        # QImage wraps the memory of the frame (a part keeps the row length of the frame)
+        # and the colors are never converted. Depending on the platform the pixmap copies
+        # the pixels or keeps using that memory, so the frame (which must not change while
+        # it is shown) is kept in _frame_buffer as long as the pixmap is used.
+        # Otherwise the frame is converted into a buffer that is reused for every frame
+        # of the same size, and then copied into the pixmap
+        height, width, channel = image.shape
+        if FORMAT_BGR888 is not None:
+            if image.strides[1:] != (3, 1):
+                image = np.ascontiguousarray(image)
+            img_Qt = QtGui.QImage(sip.voidptr(image.ctypes.data), width, height, image.strides[0], FORMAT_BGR888)
+            pixmap = QtGui.QPixmap.fromImage(img_Qt, QtCore.Qt.NoFormatConversion)
+            self._frame_buffer = (image, img_Qt)
+            return pixmap
+        bytesPerLine = 3 * width
+        if self._rgb_buffer is None or self._rgb_buffer.shape != image.shape:
+            self._rgb_buffer = np.empty_like(image)
+        cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=self._rgb_buffer)
+        img_Qt = QtGui.QImage(self._rgb_buffer.data, width, height, bytesPerLine, QtGui.QImage.Format_RGB888)
+        self._frame_buffer = None
+        return QtGui.QPixmap.fromImage(img_Qt)
+
+    def upload_frame(self, fit=False):
+        # show a new frame, nothing is drawn on the frame. If fit is True the zoom is
+        # reset so that the whole frame is visible
+        start = time.perf_counter()
+        height, width = self._opencvimage.shape[:2]
+        # the scene is the frame, in video pixels
+        self._frame_rect = QtCore.QRectF(0, 0, width * self._image_scale, height * self._image_scale)
+        self._scene.setSceneRect(self._frame_rect)
+        self._uploaded_image = self._opencvimage
+        self._uploaded_scale = self._image_scale
+        if fit:
+            self.fitInView()
+        else:
+            self.render_visible()
+        # the frame is on the screen after the next paint, see paintEvent
+        self._upload_time = time.perf_counter() - start
+
+    def schedule_render(self):
+        # the view moved, render the visible part of the frame once the events are processed
+        if not self._render_pending:
+            self._render_pending = True
+            QtCore.QTimer.singleShot(0, self.render_visible)
+
+    def render_visible(self):
+        # put in the pixmap the part of the frame that is visible, resampled to the size it
+        # has on the screen, so the cost of showing a frame depends on the size of the
+        # window and not on the resolution of the video. The linear filter only reads
+        # the pixels it needs. When zoomed in past the resolution of the frame the
+        # visible pixels are used as they are and the view enlarges them
+        self._render_pending = False
+        image = self._uploaded_image
+        if image is None or self._frame_rect.isEmpty():
+            return
+        visible = self.mapToScene(self.viewport().rect()).boundingRect().intersected(self._frame_rect)
+        if visible.isEmpty():
+            return
+        scale = self._uploaded_scale
+        height, width = image.shape[:2]
+        x0 = max(int(np.floor(visible.left() / scale)), 0)
+        y0 = max(int(np.floor(visible.top() / scale)), 0)
+        x1 = min(int(np.ceil(visible.right() / scale)), width)
+        y1 = min(int(np.ceil(visible.bottom() / scale)), height)
+        # screen pixels per frame pixel
+        zoom = self.transform().m11() * scale
+        tile_width = min(x1 - x0, max(int(np.ceil((x1 - x0) * zoom)), 1))
+        tile_height = min(y1 - y0, max(int(np.ceil((y1 - y0) * zoom)), 1))
+        region = (x0, y0, x1, y1, tile_width, tile_height)
+        if self._rendered is not None and self._rendered[0] is image and self._rendered[1] == region:
+            return
+
+        tile = image[y0:y1, x0:x1]
+        if (tile_width, tile_height) != (x1 - x0, y1 - y0):
+            tile = cv2.resize(tile, (tile_width, tile_height), interpolation=cv2.INTER_LINEAR)
+        self._photo.setPixmap(self.frame_pixmap(tile))
+        self._photo.setPos(x0 * scale, y0 * scale)
+        self._photo.setTransform(QtGui.QTransform.fromScale((x1 - x0) * scale / tile_width,
+                                                            (y1 - y0) * scale / tile_height))
+        self._rendered = (image, region)
+
+    def paintEvent(self, event):
+        # measure the time needed to present a frame: upload and first paint
+        start = time.perf_counter()
+        QtWidgets.QGraphicsView.paintEvent(self, event)
+        if self._upload_time is not None:
+            self._present_times.append(self._upload_time + time.perf_counter() - start)
+            self._upload_time = None
+
+    def present_time(self):
+        # average time (seconds) needed to present the last frames, None if no frame was shown
+        if len(self._present_times) == 0:
+            return None
+        return sum(self._present_times) / len(self._present_times)
+
+    def update_overlay(self, toggle=True):
+        # move the landmark items to the landmarks of the current frame
+        if self._shape is None or not self._show_overlay or not toggle:
+            self._overlay.setVisible(False)
+            return
+        self._overlay.set_landmarks(self._shape, self._points, self._lefteye, self._righteye,
+                                    self._landmark_size, self._scene.height())
+
+    def set_overlay_visible(self, visible):
+        # show or hide the landmarks, the frame is not touched
+        self._show_overlay = visible
+        self.update_overlay()
+
     def set_update_photo(self, toggle=True):
 
         # this function takes care of updating the view without re-setting the
         # zoom. Is useful for when you lift or relocate landmarks or when
-        # drawing lines in the middle of the face
+        # drawing lines in the middle of the face. The frame is only uploaded
+        # again if it changed
         if self._opencvimage is not None:
-            self._scene.removeItem(self._photo)
-            
-            temp_image = self._opencvimage.copy()
-            
-            if toggle:  # verify if the user wants to remove the landmarks..
-                # if shape then draw 68 landmark points
-                if self._shape is not None:
-                    # mark_picture takes care of drawing the landmarks and the circles
-                    # in the iris using opencv
-                    temp_image = mark_picture(temp_image, self._shape, self._points, self._landmark_size)
-
-            image = cv2.cvtColor(temp_image,cv2.COLOR_BGR2RGB)
-            height, width, channel = image.shape
-            bytesPerLine = 3 * width
-            img_Qt = QtGui.QImage(image.data, width, height, bytesPerLine, QtGui.QImage.Format_RGB888)
-            img_show = QtGui.QPixmap.fromImage(img_Qt)
-            
-            self._photo.setPixmap(img_show)    
-            self._scene.addItem(self._photo)
+            if self._opencvimage is not self._uploaded_image or self._image_scale != self._uploaded_scale:
+                self.upload_frame()
+            self.update_overlay(toggle)  # verify if the user wants to remove the landmarks..
             self.setDragMode(QtWidgets.QGraphicsView.RubberBandDrag)
 
     def show_entire_image(self):
@@ -366,23 +627,10 @@ class ImageViewer(QtWidgets.QGraphicsView):
     def update_view(self):
         # this function takes care of updating the view by re-setting the zoom.
         # is useful to place the image in the scene for the first time
-
-        # if shape then add shape to image
         if self._opencvimage is not None:
-            temp_image = self._opencvimage.copy()
-        
-            # draw 68 landmark points
-            if self._shape is not None:
-                temp_image = mark_picture(temp_image, self._shape, self._points, self._landmark_size)
-    
-            image = cv2.cvtColor(temp_image, cv2.COLOR_BGR2RGB)
-            height, width, channel = image.shape
-            bytesPerLine = 3 * width
-            img_Qt = QtGui.QImage(image.data, width, height, bytesPerLine, QtGui.QImage.Format_RGB888)
-            img_show = QtGui.QPixmap.fromImage(img_Qt)
-            
-            # show the photo
-            self.setPhoto(img_show)
+            self.upload_frame(fit=True)
+            self.update_overlay()
+            self.setDragMode(QtWidgets.QGraphicsView.RubberBandDrag)
 
     def keyPressEvent(self, event):
         # this function handles the Undo functionality
@@ -2,7 +2,6 @@ import os
 import sys
 import cv2
 import numpy as np
-import pandas as pd
 
 from PyQt5 import QtWidgets, QtGui, QtCore
 from multiprocessing import freeze_support
@@ -10,9 +9,19 @@ from multiprocessing import freeze_support
 from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot, QThread
 
 from ImageViewerandProcess import ImageViewer
+from video_index import load_or_build_indexes
+from frame_cache import FrameCache, FramePrefetcher, MemmapFrameCache
+from video_reader import FrameReader
+from video_proxy import VideoProxy
+from thumbnails import ThumbnailAtlas
+from frame_plan import FramePlan
+from processing_job import LandmarkJob
+from processing_window import ProcessingWindow
+from landmark_store import LandmarkLoader, LandmarkCorrections, find_landmark_file
+from video_backends import open_video, select_backend
 
 from queue import Queue
-from threading import Thread
+from threading import Thread, Event
 import time
 
 """
@@ -26,11 +35,11 @@ This file will contain a new app for extracting movement features of videos usin
 
 class VideoHandler:
     
-    def __init__(self, filename, queuesize = 30):
+    def __init__(self, filename, queuesize = 30, backend = 'opencv'):
         
         self.video_filename = filename
         try:
-            self.video_handler = cv2.VideoCapture(self.video_filename)
+            self.video_handler = open_video(self.video_filename, backend)
         except:
             # there was an error reading the file, return
             # we need to add error codes so that the user can knows what happened 
@@ -93,8 +102,8 @@ class VideoGet:
     with a dedicated thread.
     """
 
-    def __init__(self, src=0):
-        self.stream = cv2.VideoCapture(src)
+    def __init__(self, src=0, backend='opencv'):
+        self.stream = open_video(src, backend)
         (self.grabbed, self.frame) = self.stream.read()
         self.video_length = int(self.stream.get(cv2.CAP_PROP_FRAME_COUNT))
         self.video_fps = int(self.stream.get(cv2.CAP_PROP_FPS))
@@ -121,14 +130,27 @@ class VideoGet:
 class VideoInformation:
     """
     Class that contains all the information related to the video. It provide a 
-    read() function that passes frames from from a cv2.VideoCapture object
+    read() function that passes frames from from a cv2.VideoCapture object.
+    Random access is done by jumping to the closest keyframe and decoding forward,
+    the keyframe index is built in a different thread the first time the video is
+    opened and stored next to the video. Decoded frames are kept in a cache of
+    cache_size bytes, that is filled in advance with the frames_ahead and
+    frames_behind frames around the position requested with prefetch().
+    The decoding back-end is the fastest one for this file, unless a back-end is
+    given. If disk_cache_dir is given (or start_disk_cache is called), decoded
+    frames are also stored on disk (see MemmapFrameCache) and the next time the
+    video is opened, or processed, they are read from there. Frames cached at a
+    reduced resolution are only used by the landmark jobs, never shown.
     """
     
-    def __init__(self, filename):
+    def __init__(self, filename, cache_size=512 * 1024 * 1024, frames_ahead=30, frames_behind=15, backend=None,
+                 disk_cache_dir=None, disk_cache_size=20 * 1024 ** 3):
         
         self.video_filename = filename
         try:
-            self.video_handler = cv2.VideoCapture(self.video_filename)
+            # decode a few frames with every back-end and keep the fastest one
+            self.backend = backend if backend is not None else select_backend(self.video_filename)
+            self.video_handler = FrameReader(self.video_filename, backend=self.backend)
         except:
             QtWidgets.QMessageBox.critical(0,"Error","Video file cannot be read");
             self.return_error()
@@ -136,20 +158,138 @@ class VideoInformation:
             # we need to add error codes so that the user can knows what happened
 
         self.video_length = int(self.video_handler.get(cv2.CAP_PROP_FRAME_COUNT))
-        self.video_fps = int(self.video_handler.get(cv2.CAP_PROP_FPS))
+        # the frame rate is not rounded, for videos with variable frame rate this is
+        # only the average and the frame timestamps are used instead
+        self.video_fps = self.video_handler.get(cv2.CAP_PROP_FPS)
         self.playbackspeed = self.video_fps
         self.video_exist_landmarks = None
         self.video_landmarks_filename = None
-        self.video_landmarks_DF = None
+        self.video_landmarks = None  # LandmarkCorrections over the landmarks of every frame
+        self.landmark_loader = None  # fills video_landmarks in the background
         
         self.grabbed = False
         self.frame = None
-
-    def read(self):
-        # read frames
-        (self.grabbed, self.frame) = self.video_handler.read()
+        self.next_frame = 0  # number of the frame that will be returned by read()
+        self.frame_cache = FrameCache(cache_size)
+        frame_shape = (int(self.video_handler.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                       int(self.video_handler.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        self.frame_shape = frame_shape
+        self.disk_cache = None
+        if disk_cache_dir is not None:
+            self.start_disk_cache(disk_cache_dir, disk_cache_size)
+
+        # frames around the current position are decoded in a different thread, with
+        # its own decoder, and placed in the cache
+        self.prefetcher = FramePrefetcher(FrameReader(self.video_filename, backend=self.backend), self.frame_cache,
+                                          frames_ahead=frames_ahead, frames_behind=frames_behind,
+                                          frame_count=self.video_length,
+                                          frame_bytes=frame_shape[0] * frame_shape[1] * 3)
+        self.prefetcher.start()
+
+        # the keyframe index and the frame timestamps are not required to show the video,
+        # they make seeking faster and exact. Until they are ready seeking is done by OpenCV
+        self.keyframe_index = None
+        self.frame_timestamps = None
+        self.proxy = None  # low resolution version of the video used to scrub
+        # small pictures shown above the slider. They do not wait for the indexes (the
+        # scan reads every packet of the video), the frames are sampled with the frame
+        # rate and the decoder gets the keyframe index when it is ready
+        self.thumbnails = ThumbnailAtlas(self.video_filename, backend=self.backend)
+        self.thumbnails.start()
+        self.index_thread = Thread(target=self.load_indexes, args=())
+        self.index_thread.daemon = True
+        self.index_thread.start()
+
+    def load_indexes(self):
+        self.keyframe_index, self.frame_timestamps = load_or_build_indexes(self.video_filename)
+        # both decoders can use the indexes
+        for reader in (self.video_handler, self.prefetcher.reader):
+            reader.keyframe_index = self.keyframe_index
+            reader.frame_timestamps = self.frame_timestamps
+        self.thumbnails.use_indexes(self.keyframe_index, self.frame_timestamps)
+
+    def frame_times(self, frame_numbers):
+        # time (in seconds) of the frames, used for landmark time series
+        frame_numbers = np.asarray(frame_numbers)
+        if self.frame_timestamps is not None:
+            return (self.frame_timestamps.time_of(frame_numbers) - self.frame_timestamps.time_of(0)) / 1000
+        return frame_numbers / self.video_fps
+
+    def read(self, frame_number=None):
+        # read frames, if frame_number is None then the next frame is returned.
+        # The cache is verified first, the decoder is only used if the frame is not there.
+        # The frame is shared with the caches: frames found there are read-only and
+        # decoded frames are stored as they are, copy the frame before drawing on it
+        if frame_number is None:
+            frame_number = self.next_frame
+
+        frame = self.frame_cache.get(frame_number)
+        if frame is None and self.disk_cache is not None and self.disk_cache.scale == 1.0:
+            frame = self.disk_cache.get(frame_number)
+        if frame is not None:
+            self.grabbed = True
+        else:
+            (self.grabbed, frame) = self.video_handler.read(frame_number)
+            if self.grabbed:
+                self.frame_cache.put(frame_number, frame)
+                if self.disk_cache is not None:
+                    self.disk_cache.put(frame_number, frame)
+
+        if self.grabbed:
+            self.next_frame = frame_number + 1
+        self.frame = frame
         return self.grabbed, self.frame
 
+    def prefetch(self, frame_number):
+        # start decoding the frames around frame_number, whatever the prefetcher was
+        # doing before is cancelled
+        self.prefetcher.set_target(frame_number)
+
+    def start_disk_cache(self, cache_dir, max_bytes=20 * 1024 ** 3):
+        # store the decoded frames in cache_dir, downscaled if the video does not fit in
+        # max_bytes. Returns False if the cache cannot be used
+        try:
+            self.disk_cache = MemmapFrameCache(self.video_filename, self.video_length, self.frame_shape,
+                                               cache_dir, max_bytes=max_bytes)
+        except (OSError, ValueError):
+            # the video is too long for the cache or the folder cannot be written
+            self.disk_cache = None
+        return self.disk_cache is not None
+
+    def stop_disk_cache(self):
+        if self.disk_cache is not None:
+            self.disk_cache.flush()
+            self.disk_cache = None
+
+    def start_proxy(self, max_height=480):
+        # create (or load) the low resolution version of the video in the background
+        if self.proxy is None:
+            self.proxy = VideoProxy(self.video_filename, max_height)
+            self.proxy.start()
+
+    def read_proxy(self, frame_number):
+        # read a frame from the proxy, if the proxy is not ready then the frame is read
+        # from the video. Returns the frame and the factor between video and frame pixels
+        if self.proxy is not None and self.proxy.ready:
+            success, image = self.proxy.read(frame_number)
+            if success:
+                return success, image, self.proxy.scale
+        success, image = self.read(frame_number)
+        return success, image, 1.0
+
+    def release(self):
+        self.prefetcher.stop()
+        if self.landmark_loader is not None:
+            self.landmark_loader.stop()
+        if self.video_landmarks is not None:
+            self.video_landmarks.close()
+        self.thumbnails.stop()
+        if self.proxy is not None:
+            self.proxy.release()
+        if self.disk_cache is not None:
+            self.disk_cache.flush()
+        self.video_handler.release()
+
     @staticmethod
     def return_error():
         return None
@@ -171,8 +311,7 @@ class UpdateViewer(QThread):
 
     @pyqtSlot()
     def updateviewer(self, frame_number):
-        self.video_handler.video_handler.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-        success, image = self.video_handler.video_handler.read()
+        success, image = self.video_handler.read(frame_number)
         if success:
             # update the view
             self.image_viewer._opencvimage = image
@@ -187,8 +326,118 @@ class UpdateViewer(QThread):
         self.finished.emit()
 
 
+class PlaybackEngine(QThread):
+    """
+        Class that plays the video in a dedicated thread. Frames are decoded in this thread
+        and sent to the main window when they are due according to a wall clock. If the
+        main window is still presenting the previous frame when a new frame is due then the
+        new frame is dropped, this way the video is always played at the requested speed.
+        The achieved and target frames per second are reported once per second.
+    """
+    newframe = pyqtSignal(object, int)
+    fps_report = pyqtSignal(float, float)
+
+    def __init__(self, video_handler, start_frame=0):
+        super(PlaybackEngine, self).__init__()
+
+        # the engine has its own decoder, the decoder of video_handler belongs to the main thread
+        self.reader = FrameReader(video_handler.video_filename, video_handler.keyframe_index,
+                                  backend=video_handler.backend,
+                                  frame_timestamps=video_handler.frame_timestamps)
+        # frames are presented at their own time, this is important for videos with
+        # variable frame rate. The playback speed is relative to the video frame rate
+        self.frame_timestamps = video_handler.frame_timestamps
+        self.speed = video_handler.playbackspeed / video_handler.video_fps if video_handler.video_fps else 1.0
+        self.frame_cache = video_handler.frame_cache
+        self.frame_count = video_handler.video_length
+        self.fps = float(video_handler.playbackspeed)
+        if self.frame_timestamps is not None:
+            self.fps = self.frame_timestamps.average_fps() * self.speed
+        self.start_frame = start_frame
+
+        self.presented_frames = 0
+        self.dropped_frames = 0
+        self.stopped = False
+        # set when the main window finished presenting the last frame
+        self._ready = Event()
+        self._ready.set()
+
+    def frame_presented(self):
+        self._ready.set()
+
+    def frame_time(self, frame_number):
+        # time (in seconds of playback) at which the frame must be presented
+        if self.frame_timestamps is not None:
+            video_time = self.frame_timestamps.time_of(frame_number) - self.frame_timestamps.time_of(self.start_frame)
+            return video_time / 1000 / self.speed
+        return (frame_number - self.start_frame) / self.fps
+
+    def due_frame(self, playback_time):
+        # frame that should be in the screen after playback_time seconds
+        if self.frame_timestamps is not None:
+            video_time = self.frame_timestamps.time_of(self.start_frame) + playback_time * self.speed * 1000
+            return max(self.frame_timestamps.frame_at(video_time), self.start_frame)
+        return self.start_frame + int(playback_time * self.fps)
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        frame_number = self.start_frame
+        self.reader.seek(frame_number)
+        start_time = time.perf_counter()
+        report_time = start_time
+        report_frames = 0
+
+        while not self.stopped and frame_number < self.frame_count:
+            # frame that should be in the screen right now
+            due_frame = self.due_frame(time.perf_counter() - start_time)
+            if frame_number < due_frame:
+                # decoding fell behind the clock, skip to the frame that is due
+                self.dropped_frames += due_frame - frame_number
+                frame_number = due_frame
+                if frame_number >= self.frame_count:
+                    break
+
+            success, image = self.reader.read(frame_number)
+            if not success:
+                break
+
+            # wait until it is time to show the frame
+            delay = start_time + self.frame_time(frame_number) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            if self._ready.is_set():
+                self._ready.clear()
+                self.frame_cache.put(frame_number, image)
+                self.newframe.emit(image, frame_number)
+                self.presented_frames += 1
+                report_frames += 1
+            else:
+                # the main window is busy with the previous frame
+                self.dropped_frames += 1
+
+            frame_number += 1
+
+            now = time.perf_counter()
+            if now - report_time >= 1.0:
+                self.fps_report.emit(report_frames / (now - report_time), self.fps)
+                report_time = now
+                report_frames = 0
+
+        self.reader.release()
+
+
 class MainWindow(QtWidgets.QMainWindow):
 
+    # progress of the landmark job (done, total, remaining seconds), sent from the job thread
+    jobprogress = pyqtSignal(int, int, object)
+    jobfinished = pyqtSignal(object)
+    # landmark file loaded in the background, range of frames ready and end of the loading
+    landmarkschunk = pyqtSignal(int, int)
+    landmarksloaded = pyqtSignal(object)
+
     def __init__(self):
         super(MainWindow, self).__init__()
         # self.setGeometry(5,60,700,500)
@@ -208,6 +457,8 @@ class MainWindow(QtWidgets.QMainWindow):
         # Elements of the main window
         # image viewer
         self.displayImage = ImageViewer()
+        self.displayImage.zoomed_in.connect(self.showfullresolution)
+        self.displayImage.landmark_moved.connect(self.savecorrection)
 
         # Menu bar __ Top - Main options
         self.menuBar = QtWidgets.QMenuBar(self)
@@ -232,6 +483,12 @@ class MainWindow(QtWidgets.QMainWindow):
         self.slider_Bottom.setEnabled(False)
         self.slider_Bottom.valueChanged.connect(self.slidervaluechange)
         self.slider_Bottom.sliderReleased.connect(self.slidervaluefinal)
+        # show a thumbnail of the video when the mouse is over the slider
+        self.slider_Bottom.setMouseTracking(True)
+        self.slider_Bottom.installEventFilter(self)
+        self.thumbnailLabel = QtWidgets.QLabel(self, QtCore.Qt.ToolTip)
+        self.thumbnailLabel.setFrameShape(QtWidgets.QFrame.Box)
+        self.thumbnailLabel.hide()
 
         # Status Bar _ Bottom - Show the current frame number
         self.frameLabel = QtWidgets.QLabel('')
@@ -239,13 +496,27 @@ class MainWindow(QtWidgets.QMainWindow):
         self.statusBar_Bottom = QtWidgets.QStatusBar()
         self.statusBar_Bottom.setFont(QtGui.QFont("Times", 10))
         self.statusBar_Bottom.addPermanentWidget(self.frameLabel)
+        self.fpsLabel = QtWidgets.QLabel('')
+        self.fpsLabel.setFont(QtGui.QFont("Times", 10))
+        self.statusBar_Bottom.addWidget(self.fpsLabel)
+        self.jobLabel = QtWidgets.QLabel('')
+        self.jobLabel.setFont(QtGui.QFont("Times", 10))
+        self.statusBar_Bottom.addWidget(self.jobLabel)
+        self.jobprogress.connect(self.showjobprogress)
+        self.jobfinished.connect(self.jobdone)
+        self.landmarkschunk.connect(self.showlandmarks)
+        self.landmarksloaded.connect(self.landmarksfinished)
 
         # Definition of Variables
         self.video_handler = None
         self.video_name = None  # name and location of video file
         self.current_frame = 0  # what is the current frame
-        self.timer = QtCore.QTimer()  # controls video playback
+        self.playback_engine = None  # controls video playback
         self.jump_frames = 1  # number of frames to jump with fastforward or rewind buttons
+        self.use_proxy = False  # scrub using a low resolution version of the video
+        self.disk_cache_dir = None  # folder where decoded frames are stored, None if they are not
+        self.landmark_job = None  # landmark localization running in the background
+        self.processing_window = None
 
         # initialize the User Interface
         self.initUI()
@@ -291,6 +562,26 @@ class MainWindow(QtWidgets.QMainWindow):
         playback_settings.setStatusTip('Define video playback settings')
         # playback_settings.triggered.connect(self.load_file)
 
+        next_processed = video_menu.addAction("Next Processed Frame")
+        next_processed.setShortcut("Ctrl+Right")
+        next_processed.setStatusTip('Jump to the next frame with facial landmarks')
+        next_processed.triggered.connect(self.nextprocessedframe)
+
+        previous_processed = video_menu.addAction("Previous Processed Frame")
+        previous_processed.setShortcut("Ctrl+Left")
+        previous_processed.setStatusTip('Jump to the previous frame with facial landmarks')
+        previous_processed.triggered.connect(self.previousprocessedframe)
+
+        proxy_scrubbing = video_menu.addAction("Scrub with Low Resolution Proxy")
+        proxy_scrubbing.setCheckable(True)
+        proxy_scrubbing.setStatusTip('Create a low resolution copy of the video to move quickly with the slider')
+        proxy_scrubbing.toggled.connect(self.toggleproxy)
+
+        self.frame_cache_action = video_menu.addAction("Cache Decoded Frames on Disk")
+        self.frame_cache_action.setCheckable(True)
+        self.frame_cache_action.setStatusTip('Store the decoded frames in a folder, processing the video again does not decode it')
+        self.frame_cache_action.toggled.connect(self.toggleframecache)
+
         landmarks_menu = self.menuBar.addMenu("&Landmarks")
         # process_current_frame = landmarks_menu.addAction("Process Current Frame")
         # process_current_frame.setShortcut("Ctrl+C")
@@ -300,12 +591,23 @@ class MainWindow(QtWidgets.QMainWindow):
         process_some_frame = landmarks_menu.addAction("Process Frames")
         process_some_frame.setShortcut("Ctrl+S")
         process_some_frame.setStatusTip('Determine facial landmarks for some frames in the video')
-        # process_some_frame.triggered.connect(self.load_file)
+        process_some_frame.triggered.connect(self.selectframes)
 
         process_all_frame = landmarks_menu.addAction("Process All Frames")
         process_all_frame.setShortcut("Ctrl+A")
         process_all_frame.setStatusTip('Determine facial landmarks for all frames in the video')
-        # process_all_frame.triggered.connect(self.load_file)
+        process_all_frame.triggered.connect(self.processallframes)
+
+        self.pause_processing = landmarks_menu.addAction("Pause Processing")
+        self.pause_processing.setCheckable(True)
+        self.pause_processing.setEnabled(False)
+        self.pause_processing.setStatusTip('Pause or resume the landmark localization running in the background')
+        self.pause_processing.toggled.connect(self.pausejob)
+
+        self.cancel_processing = landmarks_menu.addAction("Cancel Processing")
+        self.cancel_processing.setEnabled(False)
+        self.cancel_processing.setStatusTip('Stop the landmark localization, the frames already processed are kept')
+        self.cancel_processing.triggered.connect(self.canceljob)
 
         process_settings = landmarks_menu.addAction("Process Frames Settings")
         process_settings.setShortcut("Ctrl+L")
@@ -320,7 +622,9 @@ class MainWindow(QtWidgets.QMainWindow):
 
         toggle_landmark = QtWidgets.QAction('Show/Hide facial landmarks', self)
         toggle_landmark.setIcon(QtGui.QIcon('./icons/facial-analysis.png'))
-        # toggle_landmark.connect(self.match_iris)
+        toggle_landmark.setCheckable(True)
+        toggle_landmark.setChecked(True)
+        toggle_landmark.toggled.connect(self.displayImage.set_overlay_visible)
 
         manual_adjustment = QtWidgets.QAction('Manually adjust landmarks position in current frame', self)
         manual_adjustment.setIcon(QtGui.QIcon('./icons/facial-analysis.png'))
@@ -418,29 +722,28 @@ class MainWindow(QtWidgets.QMainWindow):
 
             name = os.path.normpath(name)
             # Remove previous video handlers to avoid taking odd frames
+            if self.video_handler is not None:
+                self.video_handler.release()
             self.video_handler = None
             # change window name to match the file name
             self.setWindowTitle('Video Processing - ' + name.split(os.path.sep)[-1])
 
             # user provided a video, open it using OpenCV
             self.video_handler = VideoInformation(name)  # read the video
+            if self.use_proxy:
+                self.video_handler.start_proxy()
+            if self.disk_cache_dir is not None:
+                self.video_handler.start_disk_cache(self.disk_cache_dir)
             success, image = self.video_handler.read()  # get the first frame
             if success:  # if the frame exists then show the image
-                # video was successfully loaded and will be presented to the user, now we will verify if a csv file with
-                # with the same name as the video exits. This file should contain the landmark and bounding box
-                # information
-                cvs_file_name = name[:-3] + 'csv'
-                if os.path.exists(cvs_file_name):
-                    self.video_handler.video_landmarks_filename = cvs_file_name
-                    try:
-                        self.video_handler.video_landmarks_DF = pd.read_csv(self.video_handler.video_landmarks_filename)
-                        # self.video_handler.video_landmarks_DF.set_index('Frame_number', inplace=True)
-                    except ValueError:
-                        QtWidgets.QMessageBox.critical(0, "Error", "Landmark file appears to exist but cannot be loaded")
-                        self.video_handler.video_landmarks_filename = None
-                        self.video_handler.video_landmarks_DF = None
-
                 self.updateviewer(image, 0)
+
+                # video was successfully loaded and is presented to the user, now we will verify if a landmark file
+                # (binary or .csv) with the same name as the video exists. This file should contain the landmark and
+                # bounding box information, it is loaded in the background
+                landmark_file_name = find_landmark_file(name)
+                if landmark_file_name is not None:
+                    self.loadlandmarks(landmark_file_name)
                 self.slider_Bottom.setMinimum(1)
                 self.slider_Bottom.setMaximum(self.video_handler.video_length)
                 self.slider_Bottom.setEnabled(True)
@@ -449,40 +752,54 @@ class MainWindow(QtWidgets.QMainWindow):
 
 
     def playvideo(self):
-        # verify that the video handler is not empty
-        if self.video_handler is not None:
-            self.timer.timeout.connect(self.nextframefunction)
-            self.timer.start(1000.0/self.video_handler.playbackspeed)
-
-    def nextframefunction(self):
-        # verify that we are not at the last frame
-        if self.current_frame <= self.video_handler.video_length :
-            success, image = self.video_handler.read()  # get a new frame
-            if success:
-                frame_number = self.current_frame + 1
-                self.updateviewer(image, frame_number)
-        else:
-            # reached the end of the video
-            self.timer.stop()
+        # verify that the video handler is not empty and that the video is not playing already
+        if self.video_handler is not None and self.playback_engine is None:
+            if self.current_frame >= self.video_handler.video_length - 1:
+                return
+            self.playback_engine = PlaybackEngine(self.video_handler, self.current_frame + 1)
+            self.playback_engine.newframe.connect(self.nextframefunction)
+            self.playback_engine.fps_report.connect(self.showfps)
+            self.playback_engine.finished.connect(self.playbackfinished)
+            self.playback_engine.start()
+
+    def nextframefunction(self, image, frame_number):
+        # present a frame sent by the playback engine
+        if self.playback_engine is None or self.sender() is not self.playback_engine:
+            # the video was stopped, this frame was sent before that
+            return
+        self.updateviewer(image, frame_number)
+        self.playback_engine.frame_presented()
+
+    def showfps(self, achieved_fps, target_fps):
+        text = 'FPS : ' + str(round(achieved_fps, 1)) + '/' + str(round(target_fps, 1))
+        present_time = self.displayImage.present_time()
+        if present_time is not None:
+            text += ' - present : ' + str(round(present_time * 1000, 1)) + ' ms'
+        self.fpsLabel.setText(text)
+
+    def playbackfinished(self):
+        # reached the end of the video
+        self.stopvideo()
 
     def stopvideo(self):
         # stop video if video is playing
-        if self.timer.isActive():  # verify is the video is running
-            self.timer.stop()
+        if self.playback_engine is not None:  # verify is the video is running
+            self.playback_engine.stop()
+            self.playback_engine.wait()
+            self.playback_engine = None
+            self.fpsLabel.setText('')
 
     def fastforward(self):
 
-        if self.timer.isActive():  # verify is the video is running
-            # top video playback before moving slider
-            self.timer.stop()
+        # stop video playback before moving slider
+        self.stopvideo()
 
         next_frame = self.current_frame + self.jump_frames
         if next_frame > self.video_handler.video_length-1:
             next_frame = self.video_handler.video_length-1
             pass
         else:
-            self.video_handler.video_handler.set(cv2.CAP_PROP_POS_FRAMES, next_frame)
-            success, image = self.video_handler.read()
+            success, image = self.video_handler.read(next_frame)
             if success:
                 self.updateviewer(image, next_frame)
             else:
@@ -490,32 +807,43 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def rewind(self):
 
-        if self.timer.isActive():  # verify is the video is running
-            # top video playback before moving slider
-            self.timer.stop()
+        # stop video playback before moving slider
+        self.stopvideo()
 
         previous_frame = self.current_frame - self.jump_frames
         if previous_frame < 0:
             previous_frame = 0
             pass
         else:
-            self.video_handler.video_handler.set(cv2.CAP_PROP_POS_FRAMES, previous_frame)
-            success, image = self.video_handler.read()
+            success, image = self.video_handler.read(previous_frame)
             if success:
                 self.updateviewer(image, previous_frame)
 
-    def updateviewer(self, image, frame_number):
-        self.displayImage._opencvimage = image
-        if self.video_handler.video_landmarks_DF is not None:
-            try:
-                frame_information = self.video_handler.video_landmarks_DF.loc[self.video_handler.video_landmarks_DF['Frame_number'] == frame_number].values
-            except ValueError:
-                frame_information = []
+    def nextprocessedframe(self):
+        if self.video_handler is None or self.video_handler.video_landmarks is None:
+            return
+        self.jumptoframe(self.video_handler.video_landmarks.next_processed(self.current_frame))
+
+    def previousprocessedframe(self):
+        if self.video_handler is None or self.video_handler.video_landmarks is None:
+            return
+        self.jumptoframe(self.video_handler.video_landmarks.previous_processed(self.current_frame))
+
+    def jumptoframe(self, frame_number):
+        # frame_number is None if there is no frame to jump to
+        if frame_number is None or frame_number >= self.video_handler.video_length:
+            return
+        self.stopvideo()
+        success, image = self.video_handler.read(frame_number)
+        if success:
+            self.updateviewer(image, frame_number)
 
-            if len(frame_information) > 0:
-                shape = np.array([frame_information[0][6:]])
-                shape = np.reshape(shape.astype(np.int), (-1, 2))
-                self.displayImage._shape = shape
+    def updateviewer(self, image, frame_number, scale=1.0):
+        # scale is different from 1 if image is a frame of the low resolution proxy
+        self.displayImage._opencvimage = image
+        self.displayImage._image_scale = scale
+        if self.video_handler.video_landmarks is not None:
+            self.displayImage._shape = self.frameshape(frame_number)
 
         self.displayImage.update_view()
         self.current_frame = frame_number
@@ -526,10 +854,29 @@ class MainWindow(QtWidgets.QMainWindow):
         self.slider_Bottom.setValue(frame_number+1)
         self.slider_Bottom.blockSignals(False)
 
+        # decode the frames around the new position in the background, during playback
+        # the playback engine does the decoding
+        if self.playback_engine is None:
+            self.video_handler.prefetch(frame_number)
+
+    def frameshape(self, frame_number):
+        # copy of the landmarks of a frame (the viewer moves them around), None if the
+        # frame was not processed
+        shape = self.video_handler.video_landmarks.get(frame_number)
+        return None if shape is None else np.array(shape)
+
+    def savecorrection(self, landmark, x, y):
+        # a landmark was moved by hand, the correction is added to the correction log
+        if self.video_handler is None or self.video_handler.video_landmarks is None:
+            return
+        try:
+            self.video_handler.video_landmarks.correct(self.current_frame, landmark, x, y)
+        except OSError as error:
+            QtWidgets.QMessageBox.critical(self, "Error", "The correction cannot be saved: " + str(error))
+
     def slidervaluechange(self):
-        if self.timer.isActive():  # verify is the video is running
-            # top video playback before moving slider
-            self.timer.stop()
+        # stop video playback before moving slider
+        self.stopvideo()
 
         # get slider position and update frame number
         slider_position = self.slider_Bottom.value()
@@ -537,15 +884,219 @@ class MainWindow(QtWidgets.QMainWindow):
         self.frameLabel.setText(
             'Frame : ' + str(int(self.current_frame) + 1) + '/' + str(self.video_handler.video_length))
 
+        if self.slider_Bottom.isSliderDown():
+            # show the thumbnail above the slider handle
+            handle = self.slider_Bottom.style().subControlRect(
+                QtWidgets.QStyle.CC_Slider, self.slideroption(), QtWidgets.QStyle.SC_SliderHandle, self.slider_Bottom)
+            self.showthumbnail(self.current_frame, handle.center().x())
+
+        if self.use_proxy and self.slider_Bottom.isSliderDown():
+            # scrub using the proxy, the full resolution frame is shown when the slider is released
+            success, image, scale = self.video_handler.read_proxy(self.current_frame)
+            if success:
+                self.updateviewer(image, self.current_frame, scale)
+        else:
+            # the slider moved, the prefetcher should work around the new position
+            self.video_handler.prefetch(self.current_frame)
+
         self.is_slider_moving = True
 
     def slidervaluefinal(self):
         # adjust view only when the slider reaches its final position
-        self.video_handler.video_handler.set(cv2.CAP_PROP_POS_FRAMES, self.current_frame)
-        success, image = self.video_handler.read()
+        self.thumbnailLabel.hide()
+        success, image = self.video_handler.read(self.current_frame)
         if success:
             self.updateviewer(image, self.current_frame)
 
+    def slideroption(self):
+        option = QtWidgets.QStyleOptionSlider()
+        self.slider_Bottom.initStyleOption(option)
+        return option
+
+    def eventFilter(self, obj, event):
+        # thumbnails while the mouse moves over the slider
+        if obj is self.slider_Bottom and self.video_handler is not None:
+            if event.type() == QtCore.QEvent.MouseMove and not self.slider_Bottom.isSliderDown():
+                groove = self.slider_Bottom.style().subControlRect(
+                    QtWidgets.QStyle.CC_Slider, self.slideroption(), QtWidgets.QStyle.SC_SliderGroove, self.slider_Bottom)
+                value = QtWidgets.QStyle.sliderValueFromPosition(
+                    self.slider_Bottom.minimum(), self.slider_Bottom.maximum(),
+                    event.pos().x() - groove.x(), groove.width())
+                self.showthumbnail(value - 1, event.pos().x())
+            elif event.type() == QtCore.QEvent.Leave:
+                self.thumbnailLabel.hide()
+        return super(MainWindow, self).eventFilter(obj, event)
+
+    def showthumbnail(self, frame_number, x):
+        # show the thumbnail closest to frame_number above the slider, at position x
+        # of the slider. The decoder is not used, if there is no thumbnail nothing is shown
+        thumbnails = self.video_handler.thumbnails
+        if thumbnails is None:
+            return
+        _, thumbnail = thumbnails.nearest(frame_number)
+        if thumbnail is None:
+            return
+        thumbnail = np.ascontiguousarray(thumbnail)
+        height, width = thumbnail.shape[:2]
+        image = QtGui.QImage(thumbnail.data, width, height, 3 * width, QtGui.QImage.Format_RGB888).rgbSwapped()
+        self.thumbnailLabel.setPixmap(QtGui.QPixmap.fromImage(image))
+        self.thumbnailLabel.adjustSize()
+        position = self.slider_Bottom.mapToGlobal(QtCore.QPoint(x, 0))
+        self.thumbnailLabel.move(position.x() - self.thumbnailLabel.width() // 2,
+                                 position.y() - self.thumbnailLabel.height() - 4)
+        self.thumbnailLabel.show()
+
+    def selectframes(self):
+        # the processing window compiles the selected frames into a plan
+        if self.video_handler is None:
+            return
+        self.processing_window = ProcessingWindow()
+        self.processing_window.setvideo(self.video_handler.video_length, self.video_handler.keyframe_index)
+        self.processing_window.processframes.connect(self.startjob)
+
+    def processallframes(self):
+        if self.video_handler is None:
+            return
+        self.startjob(FramePlan(range(self.video_handler.video_length), self.video_handler.keyframe_index))
+
+    def startjob(self, frame_plan):
+        # localize the landmarks in the background, a previous run of the same job is continued
+        if self.video_handler is None or self.landmark_job is not None or len(frame_plan) == 0:
+            return
+        self.landmark_job = LandmarkJob(self.video_handler.video_filename, frame_plan,
+                                        self.video_handler.keyframe_index, self.video_handler.frame_timestamps,
+                                        self.video_handler.backend,
+                                        progress_callback=self.jobprogress.emit,
+                                        finished_callback=self.jobfinished.emit,
+                                        sparse=len(frame_plan) < self.video_handler.video_length,
+                                        frame_cache=self.video_handler.disk_cache,
+                                        before_save=self.releaselandmarks)
+        self.pause_processing.setEnabled(True)
+        self.cancel_processing.setEnabled(True)
+        self.jobLabel.setText('Processing : ' + frame_plan.summary())
+        self.landmark_job.start()
+
+    def showjobprogress(self, done, total, eta):
+        if self.landmark_job is None:
+            return
+        text = 'Processing : ' + str(done) + '/' + str(total)
+        if self.landmark_job.paused:
+            text += ' - paused'
+        elif eta is not None:
+            minutes, seconds = divmod(int(eta), 60)
+            text += ' - ' + str(minutes) + ':' + str(seconds).zfill(2) + ' left'
+        self.jobLabel.setText(text)
+
+    def pausejob(self, checked):
+        if self.landmark_job is None:
+            return
+        if checked:
+            self.landmark_job.pause()
+            self.jobLabel.setText(self.jobLabel.text().split(' - ')[0] + ' - paused')
+        else:
+            self.landmark_job.resume()
+
+    def canceljob(self):
+        if self.landmark_job is not None:
+            self.landmark_job.cancel()
+
+    def jobdone(self, job):
+        if job is not self.landmark_job:
+            return
+        self.landmark_job = None
+        self.pause_processing.setChecked(False)
+        self.pause_processing.setEnabled(False)
+        self.cancel_processing.setEnabled(False)
+        if job.error is not None:
+            self.jobLabel.setText('')
+            QtWidgets.QMessageBox.critical(self, "Error", "Landmark processing stopped: " + str(job.error))
+        elif not job.finished:
+            self.jobLabel.setText('Processing cancelled, ' + str(len(job.results)) +
+                                  ' frames are kept for the next time the frames are processed')
+        else:
+            self.jobLabel.setText('')
+            # show the new landmarks if the video is still open
+            if self.video_handler is not None and self.video_handler.video_filename == job.video_filename:
+                self.loadlandmarks(job.landmark_filename)
+
+    def releaselandmarks(self):
+        # called by the landmark jobs (from their thread) before they replace the landmark
+        # file and its correction log, the landmarks that are shown stop using them
+        video_handler = self.video_handler
+        if video_handler is not None and video_handler.video_landmarks is not None:
+            video_handler.video_landmarks.release()
+
+    def loadlandmarks(self, filename):
+        # the landmarks are loaded in the background, frames show their landmarks as
+        # soon as they are available
+        if self.video_handler.landmark_loader is not None:
+            self.video_handler.landmark_loader.stop()
+        try:
+            loader = LandmarkLoader(filename, self.video_handler.video_length,
+                                    chunk_callback=self.landmarkschunk.emit,
+                                    finished_callback=self.landmarksloaded.emit)
+        except (OSError, ValueError):
+            QtWidgets.QMessageBox.critical(0, "Error", "Landmark file appears to exist but cannot be loaded")
+            return
+        if self.video_handler.video_landmarks is not None:
+            self.video_handler.video_landmarks.close()
+        self.video_handler.landmark_loader = loader
+        self.video_handler.video_landmarks_filename = filename
+        # manual corrections are kept in a log and applied over the landmarks of the file
+        self.video_handler.video_landmarks = LandmarkCorrections(loader.store, filename)
+        loader.start()
+        self.showlandmarks(0, self.video_handler.video_length - 1)
+
+    def showlandmarks(self, first_frame, last_frame):
+        # the landmarks of these frames are ready, update the current frame if it is one of them
+        if self.video_handler is None or self.playback_engine is not None:
+            return
+        if first_frame <= self.current_frame <= last_frame and self.video_handler.video_landmarks is not None:
+            self.displayImage._shape = self.frameshape(self.current_frame)
+            self.displayImage.set_update_photo()
+
+    def landmarksfinished(self, loader):
+        if self.video_handler is None or loader is not self.video_handler.landmark_loader:
+            return
+        if loader.error is not None:
+            QtWidgets.QMessageBox.critical(0, "Error", "Landmark file appears to exist but cannot be loaded")
+            self.video_handler.video_landmarks.close()
+            self.video_handler.video_landmarks_filename = None
+            self.video_handler.video_landmarks = None
+            self.displayImage._shape = None
+            self.displayImage.set_update_photo()
+
+    def toggleproxy(self, checked):
+        self.use_proxy = checked
+        if checked and self.video_handler is not None:
+            self.video_handler.start_proxy()
+
+    def toggleframecache(self, checked):
+        if not checked:
+            self.disk_cache_dir = None
+            if self.video_handler is not None:
+                self.video_handler.stop_disk_cache()
+            return
+        cache_dir = QtWidgets.QFileDialog.getExistingDirectory(self, 'Folder for the decoded frames')
+        if not cache_dir:
+            self.frame_cache_action.setChecked(False)
+            return
+        self.disk_cache_dir = os.path.normpath(cache_dir)
+        if self.video_handler is not None and not self.video_handler.start_disk_cache(self.disk_cache_dir):
+            QtWidgets.QMessageBox.warning(self, 'Frame cache', 'The frames of this video cannot be stored in ' +
+                                          self.disk_cache_dir)
+
+    def showfullresolution(self):
+        # the user zoomed into a proxy frame, replace it with the full resolution frame
+        # keeping the current zoom
+        if self.video_handler is None or self.playback_engine is not None:
+            return
+        success, image = self.video_handler.read(self.current_frame)
+        if success:
+            self.displayImage._opencvimage = image
+            self.displayImage._image_scale = 1.0
+            self.displayImage.set_update_photo()
+
 
 if __name__ == '__main__':
     __spec__ = "ModuleSpec(name='builtins', loader=<class '_frozen_importlib.BuiltinImporter'>)"
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Command line batch processing of videos, without a graphical interface (it
+never imports PyQt5) so that it can run on a server without a display. For
+every video the face is detected and the 68 facial landmarks are localized in
+every frame, the result is stored in a .csv file next to the video with the
+layout used by the video viewer. Optionally, the facial measurements of every
+frame are stored in a second .csv file.
+
+usage: python batch_process.py video_or_folder [video_or_folder ...] [options]
+
+The frames of each video are divided between all the processor cores, every
+core decodes and processes its own part of the video. Processed frames are
+logged as they arrive, an interrupted run continues where it stopped. With
+--frame-cache the decoded frames are also stored in a folder (see
+MemmapFrameCache), the next pass over the same video does not decode again.
+"""
+import os
+import sys
+import time
+import argparse
+from functools import partial
+import numpy as np
+import pandas as pd
+import cv2
+
+from video_index import KeyframeIndex, sidecar_filename, video_signature
+from video_reader import SegmentedDecoder
+from frame_cache import MemmapFrameCache
+from landmark_store import (LandmarkWriter, read_landmark_log, store_from_log, landmark_file_lock,
+                            keep_corrections)
+from processing_job import LandmarkJob
+from utilities import find_circle_from_points
+from measurements import get_measurements_from_data
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov')
+
+# the model is created once in every worker process, the first time it is used
+_face_alignment = None
+
+
+def get_face_alignment(device):
+    global _face_alignment
+    if _face_alignment is None:
+        import torch
+        import face_alignment
+        # every core runs its own worker, more threads per worker only compete for the cores
+        torch.set_num_threads(1)
+        _face_alignment = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, device=device)
+    return _face_alignment
+
+
+def process_frame(frame_number, frame, device='cpu'):
+    # find the face (the largest one if there are more) and its landmarks. Returns
+    # (bounding box, landmarks) or None if there is no face in the frame
+    model = get_face_alignment(device)
+    detected_faces = model.face_detector.detect_from_image(frame.copy())
+    if len(detected_faces) == 0:
+        return None
+    boundingbox = max(detected_faces, key=lambda d: (d[2] - d[0]) * (d[3] - d[1]))[:4]
+    # the landmark network uses RGB images
+    result = model.get_landmarks_from_image(frame[..., ::-1].copy(), detected_faces=[boundingbox])
+    if result is None:
+        return None
+    landmarks = result[0][0]
+    return np.asarray(boundingbox, dtype=np.float64), np.asarray(landmarks, dtype=np.float64)
+
+
+def measurements_from_shape(shape, CalibrationType='Iris', CalibrationValue=11.77):
+    # facial measurements of a frame, the iris is approximated by the circle that
+    # goes through the landmarks of each eye
+    left_pupil = find_circle_from_points(shape[42:48, 0], shape[42:48, 1])
+    right_pupil = find_circle_from_points(shape[36:42, 0], shape[36:42, 1])
+    results = get_measurements_from_data(shape, left_pupil, right_pupil, CalibrationType, CalibrationValue)
+    row = {}
+    for side, result in zip(('Left', 'Right', 'Deviation', 'Percentile'), results):
+        for name, value in vars(result).items():
+            row[side + '_' + name] = value
+    return row
+
+
+def find_videos(paths):
+    # videos given directly and videos inside the given folders
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(VIDEO_EXTENSIONS):
+                    videos.append(os.path.join(path, name))
+        elif os.path.isfile(path):
+            videos.append(path)
+        else:
+            print('Skipping ' + path + ', file not found')
+    return videos
+
+
+def process_video(video_filename, device='cpu', n_workers=None, measurements=False, CalibrationValue=11.77,
+                  frame_cache_dir=None, frame_cache_size=20 * 1024 ** 3):
+    # landmarks (and measurements) of every frame of a video, stored next to the video.
+    # Every frame is appended to a log as soon as it is processed, if the process is
+    # interrupted the next run only processes the frames that are not in the log.
+    # If a worker fails the error is raised, the log is kept and no landmark file is
+    # written, so the video is processed again (from the log) the next time.
+    # If frame_cache_dir is given the frames go through a MemmapFrameCache in that folder.
+    # Returns the name of the landmark file
+    log_filename = sidecar_filename(video_filename, LandmarkJob.sidecar_ending)
+    writer = LandmarkWriter(log_filename, video_signature(video_filename))
+    done = writer.done()
+
+    keyframe_index = KeyframeIndex.load_or_build(video_filename)
+    stream = cv2.VideoCapture(video_filename)
+    frame_count = int(stream.get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_shape = (int(stream.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(stream.get(cv2.CAP_PROP_FRAME_WIDTH)))
+    stream.release()
+    remaining = [n for n in range(frame_count) if n not in done]
+    frame_cache = None
+    if frame_cache_dir is not None and remaining:
+        try:
+            # downscaled if the video does not fit in the cache at full resolution
+            frame_cache = MemmapFrameCache(video_filename, frame_count, frame_shape, frame_cache_dir,
+                                           max_bytes=frame_cache_size)
+        except ValueError as error:
+            print('  frame cache not used: ' + str(error))
+    try:
+        if remaining:
+            decoder = SegmentedDecoder(video_filename, remaining, n_workers=n_workers,
+                                       keyframe_index=keyframe_index,
+                                       worker_function=partial(process_frame, device=device),
+                                       frame_cache=frame_cache)
+            for frame_number, result in decoder:
+                if result is None:
+                    writer.append(frame_number)
+                elif frame_cache is not None:
+                    writer.append(frame_number, frame_cache.video_coordinates(result[0]),
+                                  frame_cache.video_coordinates(result[1]))
+                else:
+                    writer.append(frame_number, result[0], result[1])
+    finally:
+        writer.close()
+
+    store = store_from_log(read_landmark_log(log_filename))
+    landmark_filename = os.path.splitext(video_filename)[0] + '.csv'
+    with landmark_file_lock(landmark_filename):
+        store.save_csv(landmark_filename)
+        # every frame was processed again, the manual corrections are not valid anymore
+        keep_corrections(landmark_filename, [])
+    os.remove(log_filename)
+
+    if measurements:
+        rows = []
+        for frame_number in store.frame_numbers():
+            try:
+                row = measurements_from_shape(store.get(frame_number).astype(int), CalibrationValue=CalibrationValue)
+            except (ValueError, np.linalg.LinAlgError):
+                # the landmarks of this frame are degenerated (eyes closed, face turned)
+                row = {}
+            row['Frame_number'] = frame_number
+            rows.append(row)
+        MeasurementsDataFrame = pd.DataFrame(rows)
+        if len(rows) > 0:
+            columns = ['Frame_number'] + [c for c in MeasurementsDataFrame.columns if c != 'Frame_number']
+            MeasurementsDataFrame = MeasurementsDataFrame[columns]
+        MeasurementsDataFrame.to_csv(os.path.splitext(video_filename)[0] + '_measurements.csv', index=False)
+
+    return landmark_filename
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Facial landmarks of every frame of the videos, without display.')
+    parser.add_argument('paths', nargs='+', help='videos or folders with videos')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of processes used for each video (default: number of cores)')
+    parser.add_argument('--device', default='cpu', help='torch device used by the models (cpu, cuda)')
+    parser.add_argument('--measurements', action='store_true',
+                        help='also store the facial measurements of every frame')
+    parser.add_argument('--iris-diameter', type=float, default=11.77,
+                        help='iris diameter in mm, used to calibrate the measurements')
+    parser.add_argument('--overwrite', action='store_true', help='process videos that already have a landmark file')
+    parser.add_argument('--frame-cache', metavar='FOLDER',
+                        help='store the decoded frames in this folder, later passes over the videos read them from there')
+    parser.add_argument('--frame-cache-size', type=float, default=20,
+                        help='size of the frame cache folder in GB (default: 20), videos that do not fit at full '
+                             'resolution are stored downscaled')
+    args = parser.parse_args(argv)
+
+    videos = find_videos(args.paths)
+    if len(videos) == 0:
+        print('No videos to process')
+        return 1
+
+    failed = 0
+    for video_filename in videos:
+        if not args.overwrite and os.path.exists(os.path.splitext(video_filename)[0] + '.csv'):
+            print('Skipping ' + video_filename + ', landmark file exists')
+            continue
+        start = time.perf_counter()
+        print('Processing ' + video_filename)
+        try:
+            landmark_filename = process_video(video_filename, args.device, args.workers, args.measurements,
+                                              args.iris_diameter, args.frame_cache,
+                                              int(args.frame_cache_size * 1024 ** 3))
+        except (RuntimeError, OSError) as error:
+            # the frames processed so far stay in the log, the next run continues from them
+            print('  failed: ' + str(error))
+            failed += 1
+            continue
+        print('  done in ' + str(round(time.perf_counter() - start, 1)) + 's -> ' + landmark_filename)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Ring buffer of video frames stored in shared memory. It is used to pass decoded
+frames between processes without copying them, SegmentedDecoder uses it to
+return the frames decoded by its workers. The landmark jobs and batch_process
+do not need it, each of their workers processes the frames it decodes.
+"""
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class FrameRingBuffer:
+    """
+    n_slots frames of frame_shape stored in a block of shared memory. Every slot
+    belongs to a single owner at a time:
+
+    - the producer takes a free slot with acquire_write(), writes the frame in the
+      view returned by slot() and hands the slot to the consumers with publish()
+    - a consumer takes the next published slot with acquire_read(), uses the
+      view returned by slot() and gives the slot back with release()
+
+    The views point to the shared memory, nothing is copied. A view must not be
+    used after its slot has been released. The buffer can be passed as argument
+    to multiprocessing.Process, the child processes attach to the same memory.
+    The process that created the buffer must call close() and unlink() at the end.
+    """
+
+    def __init__(self, n_slots, frame_shape, dtype=np.uint8):
+        self.n_slots = n_slots
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_bytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+
+        self.shared_memory = shared_memory.SharedMemory(create=True, size=self.slot_bytes * self.n_slots)
+        self._owner = True
+
+        # numbers of the slots that can be written, and of the slots (with their frame
+        # number) that are ready to be read
+        self.free_slots = multiprocessing.Queue()
+        self.ready_slots = multiprocessing.Queue()
+        for slot in range(self.n_slots):
+            self.free_slots.put(slot)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shared_memory'] = self.shared_memory.name
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop('shared_memory')
+        self.__dict__.update(state)
+        try:
+            # the memory belongs to the process that created it
+            self.shared_memory = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # python older than 3.13
+            self.shared_memory = shared_memory.SharedMemory(name=name)
+
+    def slot(self, slot):
+        # numpy view of the memory of a slot
+        return np.ndarray(self.frame_shape, dtype=self.dtype, buffer=self.shared_memory.buf,
+                          offset=slot * self.slot_bytes)
+
+    def acquire_write(self, timeout=None):
+        # wait for a free slot and return its number
+        return self.free_slots.get(timeout=timeout)
+
+    def publish(self, slot, frame_number):
+        # the producer is done with the slot, the frame is available to the consumers
+        self.ready_slots.put((slot, frame_number))
+
+    def acquire_read(self, timeout=None):
+        # wait for the next frame and return (slot, frame_number). If the producer
+        # finished then (None, None) is returned
+        item = self.ready_slots.get(timeout=timeout)
+        if item is None:
+            # let the other consumers know as well
+            self.ready_slots.put(None)
+            return None, None
+        return item
+
+    def release(self, slot):
+        # the consumer is done with the slot, it can be written again
+        self.free_slots.put(slot)
+
+    def put(self, frame_number, frame, timeout=None):
+        # copy a frame that was created somewhere else into a slot and publish it
+        slot = self.acquire_write(timeout)
+        np.copyto(self.slot(slot), frame)
+        self.publish(slot, frame_number)
+
+    def finish(self):
+        # the producer will not publish more frames
+        self.ready_slots.put(None)
+
+    def close(self):
+        self.shared_memory.close()
+
+    def unlink(self):
+        if self._owner:
+            self.shared_memory.unlink()
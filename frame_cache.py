@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Caches used to avoid decoding the same video frames over and over, while the
+user moves around the video and between analysis passes over the same video.
+"""
+import os
+import hashlib
+from collections import OrderedDict
+from threading import Lock, Condition, Thread
+import numpy as np
+import cv2
+
+
+class FrameCache:
+    """
+    Decoded frames indexed by frame number. The cache holds at most max_bytes of
+    frames, when it is full the least recently used frames are removed. The
+    number of hits and misses is recorded so that the size of the cache can be
+    adjusted to the resolution of the videos. The frames are not copied: get()
+    returns read-only views, and the array given to put() stays writable but
+    must not be changed afterwards (copy it before drawing on it).
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        # frames can be added from other threads (prefetching)
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, frame_number):
+        return frame_number in self._frames
+
+    def get(self, frame_number):
+        # return the frame or None if the frame is not in the cache
+        with self._lock:
+            frame = self._frames.get(frame_number)
+            if frame is None:
+                self.misses += 1
+                return None
+            self._frames.move_to_end(frame_number)
+            self.hits += 1
+            return frame
+
+    def touch(self, frame_number):
+        # mark a frame as recently used (without counting a hit), returns False if
+        # the frame is not in the cache
+        with self._lock:
+            if frame_number not in self._frames:
+                return False
+            self._frames.move_to_end(frame_number)
+            return True
+
+    def put(self, frame_number, frame):
+        if frame.nbytes > self.max_bytes:
+            return
+        # frames are shared with whoever reads them, make sure nobody draws on them. The
+        # array of the caller is left as it is
+        frame = frame.view()
+        frame.flags.writeable = False
+        with self._lock:
+            old_frame = self._frames.pop(frame_number, None)
+            if old_frame is not None:
+                self.current_bytes -= old_frame.nbytes
+            self._frames[frame_number] = frame
+            self.current_bytes += frame.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, removed = self._frames.popitem(last=False)
+                self.current_bytes -= removed.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.current_bytes = 0
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hit_rate(),
+                'frames': len(self._frames),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes}
+
+
+class FramePrefetcher:
+    """
+    Decodes the frames around a target position in a separate thread and stores
+    them in a FrameCache. The frames_ahead frames after the target and the
+    frames_behind frames before it are decoded, but never more frames than fit
+    in the cache (large frames make the window smaller). The frames closest to
+    the target are the last ones used, so they are the last ones removed from
+    the cache. Every call to set_target cancels the current work and starts
+    again around the new position.
+    The reader must be used only by the prefetcher (it cannot be shared with
+    the main thread).
+    """
+
+    def __init__(self, reader, frame_cache, frames_ahead=30, frames_behind=15, frame_count=None,
+                 frame_bytes=None, spare_frames=2):
+        self.reader = reader
+        self.frame_cache = frame_cache
+        self.frames_ahead = frames_ahead
+        self.frames_behind = frames_behind
+        self.frame_count = frame_count
+        # size of a decoded frame, updated with the frames that are decoded
+        self.frame_bytes = frame_bytes
+        # room left in the cache for the target frame and the frames read by others
+        self.spare_frames = spare_frames
+
+        self._target = None
+        self._generation = 0  # changes every time that the target changes
+        self._condition = Condition()
+        self.stopped = False
+        self.Thread = Thread(target=self.update, args=())
+        self.Thread.daemon = True
+
+    def start(self):
+        self.Thread.start()
+        return self
+
+    def set_target(self, frame_number):
+        with self._condition:
+            self._target = frame_number
+            self._generation += 1
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self.stopped = True
+            self._condition.notify()
+
+    def window(self):
+        # number of frames (ahead, behind) to keep around the target. If the whole
+        # window does not fit in the cache both sides shrink in the same proportion,
+        # otherwise the frames decoded last would remove the first ones
+        frames_ahead, frames_behind = self.frames_ahead, self.frames_behind
+        if self.frame_bytes:
+            fits = max(self.frame_cache.max_bytes // self.frame_bytes - self.spare_frames, 0)
+            if frames_ahead + frames_behind > fits:
+                frames_ahead = min(frames_ahead, (fits * frames_ahead + frames_ahead + frames_behind - 1) //
+                                   max(frames_ahead + frames_behind, 1))
+                frames_behind = fits - frames_ahead
+        return frames_ahead, frames_behind
+
+    def frames_to_decode(self, target):
+        # the frames right after the target are decoded first (they are needed for
+        # playback), then the frames before the target and last the rest of the frames
+        # ahead. Each group is decoded in increasing order, the decoder only moves forward
+        frames_ahead, frames_behind = self.window()
+        last = target + frames_ahead
+        if self.frame_count is not None:
+            last = min(last, self.frame_count - 1)
+        near = min(target + frames_behind, last)
+        near_ahead = range(target + 1, near + 1)
+        behind = range(max(target - frames_behind, 0), target)
+        far_ahead = range(near + 1, last + 1)
+        return list(near_ahead) + list(behind) + list(far_ahead)
+
+    def keep(self, target, frame_numbers):
+        # mark the frames around the target as used, the furthest first, so that the
+        # cache removes the frames outside the window before them and the frames
+        # closest to the target the last
+        for frame_number in sorted(frame_numbers, key=lambda n: (-abs(n - target), n > target)):
+            self.frame_cache.touch(frame_number)
+
+    def decode_window(self, target, generation):
+        # decode the frames around the target that are not in the cache. Returns False
+        # if it has to start again because the size of the frames was not the expected one
+        frame_numbers = self.frames_to_decode(target)
+        self.keep(target, frame_numbers)
+        for frame_number in frame_numbers:
+            if self.stopped or self._generation != generation:
+                # the target moved, start again around the new one
+                return True
+            if frame_number in self.frame_cache:
+                continue
+            grabbed, frame = self.reader.read(frame_number)
+            if not grabbed:
+                continue
+            self.frame_cache.put(frame_number, frame)
+            if frame.nbytes != self.frame_bytes:
+                # the window depends on the size of the frames
+                self.frame_bytes = frame.nbytes
+                return False
+        self.keep(target, frame_numbers)
+        return True
+
+    def update(self):
+        generation = 0
+        while True:
+            with self._condition:
+                while not self.stopped and self._generation == generation:
+                    self._condition.wait()
+                if self.stopped:
+                    break
+                generation = self._generation
+                target = self._target
+
+            while not self.decode_window(target, generation):
+                pass
+
+        self.reader.release()
+
+
+def cache_directory_size(cache_dir):
+    return sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir))
+
+
+def enforce_cache_budget(cache_dir, max_bytes):
+    # remove the least recently used caches of the cache directory until its size
+    # is below max_bytes. The files of a cache share their name and are removed together
+    caches = {}
+    for name in os.listdir(cache_dir):
+        filename = os.path.join(cache_dir, name)
+        if os.path.isfile(filename):
+            caches.setdefault(os.path.splitext(name)[0], []).append(filename)
+    last_used = {key: max(os.path.getmtime(f) for f in files) for key, files in caches.items()}
+    total = cache_directory_size(cache_dir)
+    for key in sorted(caches, key=last_used.get):
+        if total <= max_bytes:
+            break
+        for filename in caches[key]:
+            total -= os.path.getsize(filename)
+            os.remove(filename)
+
+
+def fitting_scale(frame_count, frame_shape, max_bytes):
+    # largest scale (1 at most, in steps of 1/16) at which all the frames of a video
+    # fit in max_bytes, or 0 if not even the smallest one fits
+    height, width = frame_shape[:2]
+    scale = min(np.sqrt(max_bytes / max(frame_count * height * width * 3, 1)), 1.0)
+    scale = np.floor(scale * 16) / 16
+    # rounding the size of the frames can make them larger
+    while scale > 0 and frame_count * round(height * scale) * round(width * scale) * 3 > max_bytes:
+        scale -= 1 / 16
+    return float(scale)
+
+
+class MemmapFrameCache:
+    """
+    Decoded frames of a video stored on disk as a numpy.memmap (uint8, N x H x W x 3),
+    so that the frames decoded by one pass over the video (detection, landmarks,
+    manual review) can be read by the following ones without decoding again.
+    Frames can be stored downscaled by scale (< 1), if scale is None the frames are
+    stored at full resolution when the whole video fits in max_bytes and
+    downscaled as little as possible otherwise. Landmarks found in cached frames
+    are converted to video pixels with video_coordinates(). A second small file
+    marks which frames are already stored. get() returns views into the file,
+    nothing is copied. All the caches share cache_dir, which is kept below
+    max_bytes by removing the least recently used files. The cache can be sent
+    to other processes, they open the same files.
+    """
+
+    def __init__(self, video_filename, frame_count, frame_shape, cache_dir, scale=None,
+                 max_bytes=20 * 1024 ** 3):
+        height, width = frame_shape[:2]
+        if scale is None:
+            scale = fitting_scale(frame_count, frame_shape, max_bytes)
+            if scale == 0:
+                raise ValueError('The frames of this video do not fit in the cache budget')
+        if scale != 1.0:
+            width, height = int(round(width * scale)), int(round(height * scale))
+        self.scale = scale
+        self.frame_size = (width, height)
+        self.frame_count = frame_count
+        shape = (frame_count, height, width, 3)
+        size = int(np.prod(shape))
+        if size > max_bytes:
+            raise ValueError('The frame cache of this video is larger than the cache budget, use a smaller scale')
+
+        # the cache is identified by the video (and its version) and the size of the frames
+        stats = os.stat(video_filename)
+        key = '%s|%d|%d|%d|%d' % (os.path.abspath(video_filename), stats.st_size, int(stats.st_mtime), width, height)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.frames_filename = os.path.join(cache_dir, name + '.frames')
+        self.valid_filename = os.path.join(cache_dir, name + '.valid')
+
+        exists = os.path.exists(self.frames_filename) and os.path.exists(self.valid_filename)
+        if not exists:
+            # make space for the new cache before creating it
+            enforce_cache_budget(cache_dir, max_bytes - size - frame_count)
+        mode = 'r+' if exists else 'w+'
+        self.shape = shape
+        self.frames = np.memmap(self.frames_filename, dtype=np.uint8, mode=mode, shape=shape)
+        self.valid = np.memmap(self.valid_filename, dtype=np.uint8, mode=mode, shape=(frame_count,))
+        # mark the cache as recently used
+        os.utime(self.frames_filename)
+        os.utime(self.valid_filename)
+
+    def __getstate__(self):
+        # the files are opened again by the other process, the memory maps are not copied
+        state = self.__dict__.copy()
+        del state['frames'], state['valid']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.frames = np.memmap(self.frames_filename, dtype=np.uint8, mode='r+', shape=self.shape)
+        self.valid = np.memmap(self.valid_filename, dtype=np.uint8, mode='r+', shape=(self.frame_count,))
+
+    def video_coordinates(self, points):
+        # positions measured in the cached frames (bounding boxes, landmarks) in video pixels
+        points = np.asarray(points, dtype=np.float64)
+        return points / self.scale if self.scale != 1.0 else points
+
+    def __contains__(self, frame_number):
+        return 0 <= frame_number < self.frame_count and bool(self.valid[frame_number])
+
+    def get(self, frame_number):
+        # read-only view of the stored frame or None if the frame is not in the cache
+        if frame_number not in self:
+            return None
+        return self._view(frame_number)
+
+    def _view(self, frame_number):
+        frame = self.frames[frame_number]
+        frame.flags.writeable = False
+        return frame
+
+    def put(self, frame_number, frame):
+        if not 0 <= frame_number < self.frame_count:
+            return
+        if self.scale != 1.0:
+            self.frames[frame_number] = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+        else:
+            self.frames[frame_number] = frame
+        self.valid[frame_number] = 1
+
+    def read_frames(self, reader, frame_numbers):
+        # generator that returns (frame_number, frame) for each frame, from the cache
+        # if possible and from the reader (a FrameReader) otherwise. Decoded frames
+        # are stored for the next pass
+        missing = [n for n in frame_numbers if n not in self]
+        decoded = reader.read_frames(missing)
+        for frame_number in sorted(set(frame_numbers)):
+            if frame_number in self:
+                yield frame_number, self._view(frame_number)
+                continue
+            for decoded_number, frame in decoded:
+                self.put(decoded_number, frame)
+                if decoded_number == frame_number:
+                    yield frame_number, self._view(frame_number)
+                    break
+            else:
+                return
+
+    def flush(self):
+        self.frames.flush()
+        self.valid.flush()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Turns the frame selection of the processing window (all frames, first frame,
+a list of frames and init/step/end ranges) into a plan: the selected frames
+grouped in intervals, sorted and without repetitions, with the way each
+interval will be read and the estimated decoding cost. The plan is always read
+in a single forward pass over the video.
+"""
+from video_reader import frames_from_ranges, jump_target
+
+SEQUENTIAL = 'sequential'  # every frame of the interval is selected, decode them one after the other
+GRAB_SKIP = 'grab-skip'  # frames that are not selected are decoded but not converted
+KEYFRAME_SEEK = 'keyframe seek'  # jump to the keyframe before the interval, then grab-skip
+
+
+def parse_frame_list(text):
+    # frame numbers written as "1,5,20" (as accepted by the frame list validator)
+    return [int(value) for value in text.split(',') if value.strip().isdigit()]
+
+
+class PlanInterval:
+    """
+    Group of selected frames read with the same strategy. entry is the frame
+    where decoding of the interval starts (the keyframe for seeks), decoded is
+    the number of frames that go through the decoder.
+    """
+
+    def __init__(self, frame_numbers, strategy, entry, seek_cost=0):
+        self.frame_numbers = frame_numbers
+        self.strategy = strategy
+        self.entry = entry
+        self.first = frame_numbers[0]
+        self.last = frame_numbers[-1]
+        self.decoded = self.last - entry + 1 + seek_cost
+
+    def __repr__(self):
+        return 'PlanInterval(%d-%d, %d frames, %s)' % (self.first, self.last, len(self.frame_numbers), self.strategy)
+
+
+class FramePlan:
+    """
+    The selected frames grouped in intervals. Intervals are separated where it is
+    cheaper to seek than to keep decoding, using the same rule as FrameReader so
+    that the estimate matches what the reader does.
+    seek_cost is the number of frames that a seek decodes before landing on its
+    target (OpenCV decodes around 16).
+    """
+
+    def __init__(self, frame_numbers, keyframe_index=None, max_grab=16, seek_cost=16):
+        self.frame_numbers = sorted(set(int(n) for n in frame_numbers))
+        self.keyframe_index = keyframe_index
+        self.max_grab = max_grab
+        self.seek_cost = seek_cost
+        self.intervals = self.compile()
+
+    def compile(self):
+        intervals = []
+        position = 0  # the decoder starts at the beginning of the video
+        current = []
+        strategy = entry = None
+        for frame_number in self.frame_numbers:
+            target = jump_target(position, frame_number, self.keyframe_index, self.max_grab)
+            if current and target is None:
+                current.append(frame_number)
+            else:
+                if current:
+                    intervals.append(self._interval(current, strategy, entry))
+                current = [frame_number]
+                strategy = KEYFRAME_SEEK if target is not None else None
+                entry = target if target is not None else position
+            position = frame_number + 1
+        if current:
+            intervals.append(self._interval(current, strategy, entry))
+        return intervals
+
+    def _interval(self, frame_numbers, strategy, entry):
+        if strategy == KEYFRAME_SEEK:
+            return PlanInterval(frame_numbers, KEYFRAME_SEEK, entry, self.seek_cost if entry > 0 else 0)
+        if entry == frame_numbers[0] and frame_numbers[-1] - frame_numbers[0] + 1 == len(frame_numbers):
+            return PlanInterval(frame_numbers, SEQUENTIAL, entry)
+        return PlanInterval(frame_numbers, GRAB_SKIP, entry)
+
+    @classmethod
+    def from_selection(cls, frame_count, all_frames=False, first_frame=False, frame_list=(), ranges=(),
+                       keyframe_index=None, max_grab=16):
+        # merge the frames selected with the different widgets. ranges are (init, step, end)
+        # with the end included, frames outside the video are ignored
+        if all_frames:
+            return cls(range(frame_count), keyframe_index, max_grab)
+        frames = set(n for n in frame_list if 0 <= n < frame_count)
+        if first_frame and frame_count > 0:
+            frames.add(0)
+        frames.update(frames_from_ranges(ranges, frame_count))
+        return cls(frames, keyframe_index, max_grab)
+
+    def __len__(self):
+        return len(self.frame_numbers)
+
+    def decoded_frames(self):
+        # estimated number of frames that go through the decoder
+        return sum(interval.decoded for interval in self.intervals)
+
+    def seeks(self):
+        return sum(1 for interval in self.intervals if interval.strategy == KEYFRAME_SEEK)
+
+    def estimated_time(self, seconds_per_frame):
+        # seconds_per_frame is the decoding time of a frame (see video_backends.probe_backends)
+        return self.decoded_frames() * seconds_per_frame
+
+    def summary(self):
+        return '%d frames selected, %d frames decoded, %d seeks' % (len(self), self.decoded_frames(), self.seeks())
+
+    def read(self, reader):
+        # generator that returns (frame_number, frame) following the plan, reader is a
+        # FrameReader with the same keyframe index and max_grab used to create the plan
+        for interval in self.intervals:
+            if interval.strategy == KEYFRAME_SEEK:
+                reader.jump(interval.entry)
+            for frame_number in interval.frame_numbers:
+                grabbed, frame = reader.read(frame_number)
+                if not grabbed:
+                    return
+                yield frame_number, frame
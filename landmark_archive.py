@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Compact landmark files for archiving the landmarks of many videos. The
+landmarks and bounding boxes are stored as int16 in fractions of a pixel
+(1/scale pixels, scale is chosen so that the largest coordinate fits), and
+along time every value is stored as the difference with the previous frame,
+which is a small number because faces move little between frames.
+
+The video is divided in chunks of chunk_frames frames (around one second).
+Each chunk starts with the full values of its first frame and is compressed
+on its own, so any range of frames is decoded by reading only its chunks.
+File layout (ending .landmark_archive):
+
+    header      64 bytes
+    chunks      zlib compressed: bitmap of the frames with landmarks, then the
+                values (140 per frame, 136 landmark and 4 bounding box
+                coordinates) value by value, low bytes first and then high bytes
+    index       uint64 (n_chunks + 1,), offset of every chunk and end of the last
+
+Frames without landmarks repeat the values of the previous frame (difference
+0). The confidence of the landmarks is not archived.
+
+usage: python landmark_archive.py archive landmark_file archive_file
+       python landmark_archive.py extract archive_file landmark_file
+       python landmark_archive.py benchmark landmark_file.csv
+"""
+import os
+import sys
+import time
+import zlib
+import argparse
+import numpy as np
+import pandas as pd
+
+from landmark_store import LandmarkStore
+
+ARCHIVE_ENDING = '.landmark_archive'
+ARCHIVE_HEADER = np.dtype([('magic', 'S4'), ('version', '<u4'), ('frame_count', '<u8'), ('chunk_frames', '<u4'),
+                           ('n_chunks', '<u4'), ('scale', '<f4'), ('n_values', '<u4'), ('index_offset', '<u8'),
+                           ('reserved', 'V24')])
+ARCHIVE_MAGIC = b'LMKA'
+ARCHIVE_VERSION = 1
+N_VALUES = 68 * 2 + 4
+MAX_SCALE = 16  # values are never stored with more precision than 1/16 pixel
+
+
+def archive_scale(values):
+    # largest power of 2 (up to MAX_SCALE) that keeps the values inside int16. Whole
+    # pixels (the landmarks of .csv files) are stored as they are
+    largest = float(np.abs(values).max()) if values.size > 0 else 0
+    scale = 1 if np.array_equal(values, np.round(values)) else MAX_SCALE
+    while scale > 1 and largest * scale > np.iinfo(np.int16).max:
+        scale //= 2
+    if largest * scale > np.iinfo(np.int16).max:
+        raise ValueError('Landmarks are too far from the image to be archived')
+    return scale
+
+
+def _encode_chunk(valid, values):
+    # values is int16 (n_frames, N_VALUES). The differences wrap around like the int16
+    # sums of the decoder, the original values are always recovered
+    deltas = values.copy()
+    deltas[1:] = np.diff(values, axis=0)
+    # one value after the other along time, then the low and the high bytes apart
+    data = np.ascontiguousarray(deltas.T).view(np.uint8).reshape(-1, 2).T
+    return zlib.compress(np.packbits(valid).tobytes() + data.tobytes(), 9)
+
+
+def _decode_chunk(chunk, n_frames):
+    data = zlib.decompress(chunk)
+    n_bytes = (n_frames + 7) // 8
+    valid = np.unpackbits(np.frombuffer(data, dtype=np.uint8, count=n_bytes))[:n_frames].astype(bool)
+    shuffled = np.frombuffer(data, dtype=np.uint8, offset=n_bytes).reshape(2, -1)
+    deltas = np.ascontiguousarray(shuffled.T).view('<i2').reshape(N_VALUES, n_frames).T
+    return valid, np.cumsum(deltas, axis=0, dtype=np.int16)
+
+
+def write_archive(store, filename, chunk_frames=30):
+    # archive the landmarks of a LandmarkStore, chunk_frames is usually the frame rate
+    # of the video (one second per chunk)
+    frame_count = store.frame_count
+    valid = np.asarray(store.valid, dtype=bool)
+    values = np.zeros((frame_count, N_VALUES), dtype=np.float64)
+    values[:, :136] = np.asarray(store.shapes).reshape(frame_count, 136)
+    values[:, 136:] = np.asarray(store.boxes)
+    scale = archive_scale(values[valid])
+    values = np.round(values * scale).astype(np.int16)
+    # frames without landmarks repeat the previous frame, they compress to nothing
+    last = np.maximum.accumulate(np.where(valid, np.arange(frame_count), 0))
+    values = values[last]
+
+    n_chunks = (frame_count + chunk_frames - 1) // chunk_frames
+    header = np.zeros(1, dtype=ARCHIVE_HEADER)
+    header['magic'] = ARCHIVE_MAGIC
+    header['version'] = ARCHIVE_VERSION
+    header['frame_count'] = frame_count
+    header['chunk_frames'] = chunk_frames
+    header['n_chunks'] = n_chunks
+    header['scale'] = scale
+    header['n_values'] = N_VALUES
+    offsets = np.zeros(n_chunks + 1, dtype='<u8')
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        f.write(header.tobytes())
+        offsets[0] = ARCHIVE_HEADER.itemsize
+        for chunk in range(n_chunks):
+            frames = slice(chunk * chunk_frames, min((chunk + 1) * chunk_frames, frame_count))
+            f.write(_encode_chunk(valid[frames], values[frames]))
+            offsets[chunk + 1] = f.tell()
+        f.write(offsets.tobytes())
+        header['index_offset'] = offsets[-1]
+        f.seek(0)
+        f.write(header.tobytes())
+    os.replace(temp_filename, filename)
+
+
+class LandmarkArchive:
+    """
+    Reads the frames of an archive. read(first_frame, last_frame) decodes the
+    chunks of that range (last frame included) and returns the frame numbers
+    with landmarks, their bounding boxes and their landmarks, in video pixels.
+    The last decoded chunk is kept, reading frame after frame does not decode
+    a chunk more than once.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        header = np.fromfile(filename, dtype=ARCHIVE_HEADER, count=1)
+        if len(header) == 0 or header['magic'][0] != ARCHIVE_MAGIC or header['version'][0] > ARCHIVE_VERSION:
+            raise ValueError('Not a landmark archive')
+        if header['n_values'][0] != N_VALUES:
+            raise ValueError('Unknown landmark format')
+        self.frame_count = int(header['frame_count'][0])
+        self.chunk_frames = int(header['chunk_frames'][0])
+        self.scale = float(header['scale'][0])
+        n_chunks = int(header['n_chunks'][0])
+        self.offsets = np.fromfile(filename, dtype='<u8', count=n_chunks + 1, offset=int(header['index_offset'][0]))
+        if len(self.offsets) != n_chunks + 1:
+            raise ValueError('Landmark archive is truncated')
+        self.file = open(filename, 'rb')
+        self._chunk = None  # (chunk number, valid, values) of the last decoded chunk
+
+    def chunk(self, chunk):
+        # valid frames and int16 values of a chunk
+        if self._chunk is None or self._chunk[0] != chunk:
+            self.file.seek(int(self.offsets[chunk]))
+            data = self.file.read(int(self.offsets[chunk + 1] - self.offsets[chunk]))
+            n_frames = min(self.chunk_frames, self.frame_count - chunk * self.chunk_frames)
+            self._chunk = (chunk,) + _decode_chunk(data, n_frames)
+        return self._chunk[1], self._chunk[2]
+
+    def read(self, first_frame=0, last_frame=None):
+        if last_frame is None:
+            last_frame = self.frame_count - 1
+        first_frame = max(first_frame, 0)
+        last_frame = min(last_frame, self.frame_count - 1)
+        frame_numbers, values = [], []
+        for chunk in range(first_frame // self.chunk_frames, last_frame // self.chunk_frames + 1):
+            valid, chunk_values = self.chunk(chunk)
+            start = chunk * self.chunk_frames
+            frames = np.arange(start, start + len(valid))
+            keep = valid & (frames >= first_frame) & (frames <= last_frame)
+            frame_numbers.append(frames[keep])
+            values.append(chunk_values[keep])
+        if not frame_numbers:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 4)), np.zeros((0, 68, 2))
+        values = np.concatenate(values) / self.scale
+        return np.concatenate(frame_numbers), values[:, 136:], values[:, :136].reshape(-1, 68, 2)
+
+    def get(self, frame_number):
+        # landmarks of a frame or None if the frame has no landmarks
+        frame_numbers, boxes, shapes = self.read(frame_number, frame_number)
+        return shapes[0] if len(frame_numbers) > 0 else None
+
+    def to_store(self):
+        # LandmarkStore with all the landmarks of the archive
+        frame_numbers, boxes, shapes = self.read()
+        return LandmarkStore.from_arrays(frame_numbers, boxes, shapes, self.frame_count)
+
+    def close(self):
+        self.file.close()
+
+
+def benchmark(csv_filename, chunk_frames=30, repeat=3):
+    # size and decoding time of a .csv landmark file against its archive. Returns a
+    # dictionary with the measurements
+    archive_filename = os.path.splitext(csv_filename)[0] + '_benchmark' + ARCHIVE_ENDING
+
+    def best_time(function):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    store = LandmarkStore.load_csv(csv_filename)
+    start = time.perf_counter()
+    write_archive(store, archive_filename, chunk_frames)
+    results = {'frames': len(store), 'encode_time': time.perf_counter() - start,
+               'csv_size': os.path.getsize(csv_filename), 'archive_size': os.path.getsize(archive_filename)}
+    results['csv_read_time'] = best_time(lambda: pd.read_csv(csv_filename).values)
+
+    archive = LandmarkArchive(archive_filename)
+    results['archive_read_time'] = best_time(lambda: archive.read())
+    # one second of video from the middle of the file
+    middle = store.frame_count // 2
+
+    def read_range():
+        archive._chunk = None
+        archive.read(middle, middle + chunk_frames - 1)
+    results['archive_range_time'] = best_time(read_range)
+    frame_numbers, boxes, shapes = archive.read()
+    results['max_error'] = float(np.abs(shapes - store.shapes[frame_numbers]).max()) if len(frame_numbers) else 0.0
+    archive.close()
+    os.remove(archive_filename)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compact landmark archives.')
+    commands = parser.add_subparsers(dest='command')
+    archive = commands.add_parser('archive', help='archive a landmark file (.csv or binary)')
+    archive.add_argument('landmark_file')
+    archive.add_argument('archive_file')
+    archive.add_argument('--chunk-frames', type=int, default=30, help='frames per chunk (default: 30)')
+    extract = commands.add_parser('extract', help='write the landmarks of an archive to a landmark file')
+    extract.add_argument('archive_file')
+    extract.add_argument('landmark_file')
+    compare = commands.add_parser('benchmark', help='compare a .csv landmark file with its archive')
+    compare.add_argument('landmark_file')
+    compare.add_argument('--chunk-frames', type=int, default=30, help='frames per chunk (default: 30)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'archive':
+        write_archive(LandmarkStore.load(args.landmark_file), args.archive_file, args.chunk_frames)
+    elif args.command == 'extract':
+        archive = LandmarkArchive(args.archive_file)
+        archive.to_store().save(args.landmark_file)
+        archive.close()
+    elif args.command == 'benchmark':
+        results = benchmark(args.landmark_file, args.chunk_frames)
+        print('frames with landmarks : ' + str(results['frames']))
+        print('size                  : csv %.1f MB, archive %.2f MB (%.0fx smaller)' % (
+            results['csv_size'] / 1e6, results['archive_size'] / 1e6, results['csv_size'] / results['archive_size']))
+        print('read all frames       : csv %.3f s, archive %.3f s' % (
+            results['csv_read_time'], results['archive_read_time']))
+        print('read one chunk        : archive %.2f ms' % (results['archive_range_time'] * 1000))
+        print('largest error         : %.3f pixels' % results['max_error'])
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
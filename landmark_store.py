@@ -0,0 +1,1029 @@
+# -*- coding: utf-8 -*-
+"""
+Landmarks and bounding boxes of all the frames of a video kept in memory as
+arrays indexed by frame number, so that the landmarks of a frame can be found
+without searching the landmark file.
+
+Landmarks can be stored in the .csv files used so far or in a binary file
+(same name as the video, ending in .landmarks) that is much smaller and
+faster to open. The binary file has a 64 bytes header followed by the arrays:
+
+    valid       frame_count bits, 1 if the frame was processed
+    boxes       float32 (frame_count, 4), face bounding box
+    confidence  float32 (frame_count,), confidence of the landmarks (nan if unknown)
+    shapes      int16 or float32 (frame_count, 68, 2), landmarks
+
+each array starts at a multiple of 64 bytes. The file is memory-mapped, data is
+only read from disk when a frame is used.
+
+When only some frames of a video are processed the landmarks can be kept in a
+sparse file (ending in .landmark_runs) that only stores the processed frames.
+Each processing run is appended to the file as it is: a 64 bytes header, the
+compressed bitmap of the frames that have landmarks, the compressed bitmap of
+the frames that were processed without finding a face, and the boxes,
+confidence and landmarks of the frames of the bitmap, in frame order. Runs are
+merged when the file is opened, later runs replace the frames of earlier ones,
+so adding a run never rewrites the file.
+
+While a video is being processed the landmarks are appended, one fixed size
+record per frame, to a log file (see LandmarkWriter). If the process dies the
+complete records are still there and the processing can continue from them.
+
+Landmarks moved by hand are not written into the landmark file, every
+correction is appended to a second log (same name as the video, ending in
+_corrections.log) that is applied over the landmarks when they are read (see
+LandmarkCorrections). From time to time the corrections are copied into the
+landmark file in the background and removed from the log. The log keeps the
+size and modification time of the landmark file it was written for, if the
+landmark file was replaced by something else (processed again) the log is
+ignored. Everything in this program that replaces the landmark file of a video
+or its correction log holds landmark_file_lock() meanwhile.
+"""
+import os
+import sys
+import time
+import zlib
+import numpy as np
+import pandas as pd
+from threading import Thread, Lock
+
+from utilities import save_landmark_csv_file
+
+BINARY_ENDING = '.landmarks'
+BINARY_HEADER = np.dtype([('magic', 'S4'), ('version', '<u4'), ('frame_count', '<u8'),
+                          ('n_landmarks', '<u4'), ('shape_dtype', 'S4'), ('reserved', 'V40')])
+BINARY_MAGIC = b'LMKS'
+BINARY_VERSION = 1
+SHAPE_DTYPES = {b'i2': np.dtype('<i2'), b'f4': np.dtype('<f4')}
+
+
+SPARSE_ENDING = '.landmark_runs'
+RUN_HEADER = np.dtype([('magic', 'S4'), ('version', '<u4'), ('frame_count', '<u8'), ('n_frames', '<u8'),
+                       ('bitmap_size', '<u4'), ('cleared_size', '<u4'), ('shape_dtype', 'S4'),
+                       ('checksum', '<u4'), ('reserved', 'V24')])
+RUN_MAGIC = b'LMKR'
+RUN_VERSION = 1
+# frames per block of the rank table of the sparse bitmaps
+RANK_BLOCK = 512
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+LOG_HEADER = np.dtype([('magic', 'S4'), ('version', '<u4'), ('record_size', '<u4'), ('reserved0', '<u4'),
+                       ('signature', '<i8', (2,)), ('reserved', 'V32')])
+LOG_MAGIC = b'LMKL'
+LOG_VERSION = 1
+# one record per processed frame, frames without face have nan boxes. The checksum
+# covers the rest of the record and detects records that were not completely written
+LOG_RECORD = np.dtype([('frame_number', '<i8'), ('box', '<f4', (4,)), ('confidence', '<f4'),
+                       ('shape', '<f4', (68, 2)), ('checksum', '<u4')])
+
+# manual corrections, one record per relocated landmark
+CORRECTION_ENDING = '_corrections.log'
+CORRECTION_MAGIC = b'LMKC'
+CORRECTION_RECORD = np.dtype([('frame_number', '<i8'), ('landmark', '<u4'), ('position', '<f4', (2,)),
+                              ('checksum', '<u4')])
+
+
+def _aligned(offset):
+    return (offset + 63) // 64 * 64
+
+
+def binary_layout(frame_count, shape_dtype):
+    # offset of each array in the binary file, and the size of the file
+    valid = BINARY_HEADER.itemsize
+    boxes = _aligned(valid + (frame_count + 7) // 8)
+    confidence = _aligned(boxes + frame_count * 4 * 4)
+    shapes = _aligned(confidence + frame_count * 4)
+    end = shapes + frame_count * 68 * 2 * shape_dtype.itemsize
+    return valid, boxes, confidence, shapes, end
+
+
+def landmark_filenames(video_filename):
+    # landmark files that can go with a video, binary, sparse and .csv
+    name = os.path.splitext(video_filename)[0]
+    return name + BINARY_ENDING, name + SPARSE_ENDING, name + '.csv'
+
+
+def find_landmark_file(video_filename):
+    # the landmark file of a video, if several formats exist the most recent one is used.
+    # None if the video has no landmarks
+    existing = [f for f in landmark_filenames(video_filename) if os.path.exists(f)]
+    if not existing:
+        return None
+    return max(existing, key=os.path.getmtime)
+
+
+class LandmarkStore:
+    """
+    shapes is a (frame_count, 68, 2) array with the landmarks of every frame,
+    boxes is a (frame_count, 4) array with the face bounding box of every frame
+    and valid marks the frames that have been processed. confidence is the
+    confidence of the landmarks of each frame (nan if unknown). get() returns a
+    view of the landmarks of a frame, nothing is copied.
+    """
+
+    def __init__(self, frame_count, shape_dtype=np.int32):
+        self.frame_count = frame_count
+        self.shapes = np.zeros((frame_count, 68, 2), dtype=shape_dtype)
+        self.boxes = np.zeros((frame_count, 4), dtype=np.float32)
+        self.confidence = np.full(frame_count, np.nan, dtype=np.float32)
+        self.valid = np.zeros(frame_count, dtype=bool)
+
+    def __contains__(self, frame_number):
+        return 0 <= frame_number < self.frame_count and self.valid[frame_number]
+
+    def __len__(self):
+        # number of frames with landmarks
+        return int(np.count_nonzero(self.valid))
+
+    def get(self, frame_number):
+        # landmarks of a frame or None if the frame has not been processed
+        if frame_number not in self:
+            return None
+        return self.shapes[frame_number]
+
+    def boundingbox(self, frame_number):
+        if frame_number not in self:
+            return None
+        return self.boxes[frame_number]
+
+    def set(self, frame_number, boundingbox, shape, confidence=np.nan):
+        self.boxes[frame_number] = boundingbox
+        if self.shapes.dtype.kind == 'i':
+            shape = np.round(shape)
+        self.shapes[frame_number] = shape
+        self.confidence[frame_number] = confidence
+        self.valid[frame_number] = True
+
+    def frame_numbers(self):
+        # frames that have landmarks
+        return np.flatnonzero(self.valid)
+
+    def add(self, frame_numbers, boxes, shapes):
+        # set the landmarks of several frames, frames outside the store are ignored. The
+        # frames are marked as valid after their data is in place, so the store can be
+        # read while it is being filled
+        frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+        inside = (frame_numbers >= 0) & (frame_numbers < self.frame_count)
+        frame_numbers = frame_numbers[inside]
+        self.boxes[frame_numbers] = np.asarray(boxes)[inside]
+        shapes = np.asarray(shapes).reshape(-1, 68, 2)[inside]
+        if self.shapes.dtype.kind == 'i':
+            shapes = np.round(shapes)
+        self.shapes[frame_numbers] = shapes
+        self.valid[frame_numbers] = True
+
+    def add_csv_rows(self, values):
+        # rows of a landmark .csv file (index, frame number, bounding box, landmarks)
+        if values.ndim != 2 or values.shape[1] < 6 + 136:
+            raise ValueError('Not a landmark file')
+        values = values.astype(np.float64)
+        self.add(values[:, 1], values[:, 2:6], values[:, 6:6 + 136])
+
+    @classmethod
+    def from_arrays(cls, frame_numbers, boxes, shapes, frame_count=None):
+        frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+        if frame_count is None:
+            frame_count = int(frame_numbers.max()) + 1 if len(frame_numbers) > 0 else 0
+        store = cls(frame_count)
+        store.add(frame_numbers, boxes, shapes)
+        return store
+
+    def resized(self, frame_count):
+        # copy of the store with room for frame_count frames
+        store = LandmarkStore(frame_count, self.shapes.dtype)
+        n = min(frame_count, self.frame_count)
+        store.shapes[:n] = self.shapes[:n]
+        store.boxes[:n] = self.boxes[:n]
+        store.confidence[:n] = self.confidence[:n]
+        store.valid[:n] = self.valid[:n]
+        return store
+
+    def next_processed(self, frame_number):
+        # first frame with landmarks after frame_number, None if there is none
+        following = np.flatnonzero(self.valid[max(frame_number + 1, 0):])
+        return int(following[0]) + max(frame_number + 1, 0) if len(following) > 0 else None
+
+    def previous_processed(self, frame_number):
+        # last frame with landmarks before frame_number, None if there is none
+        previous = np.flatnonzero(self.valid[:max(frame_number, 0)])
+        return int(previous[-1]) if len(previous) > 0 else None
+
+    @classmethod
+    def load(cls, filename, frame_count=None, mapped=True):
+        # open a landmark file in any format. Binary files are memory-mapped unless mapped
+        # is False, a file that is going to be replaced must not be mapped (Windows does
+        # not allow it)
+        if filename.endswith(BINARY_ENDING):
+            return cls.open_binary(filename, mapped)
+        if filename.endswith(SPARSE_ENDING):
+            return SparseLandmarkStore.load(filename).to_store(frame_count)
+        return cls.load_csv(filename, frame_count)
+
+    @classmethod
+    def load_csv(cls, filename, frame_count=None):
+        # the landmark file is read once, all the rows are converted together
+        values = pd.read_csv(filename).values
+        if frame_count is None:
+            frame_count = int(values[:, 1].max()) + 1 if values.ndim == 2 and len(values) > 0 else 0
+        store = cls(frame_count)
+        store.add_csv_rows(values)
+        return store
+
+    def save(self, filename, shape_dtype='i2'):
+        # store the landmarks in the format given by the file name
+        if filename.endswith(BINARY_ENDING):
+            self.save_binary(filename, shape_dtype)
+        elif filename.endswith(SPARSE_ENDING):
+            SparseLandmarkStore.from_store(self).save(filename, shape_dtype)
+        else:
+            self.save_csv(filename)
+
+    def save_csv(self, filename):
+        frame_numbers = self.frame_numbers()
+        save_landmark_csv_file(filename, frame_numbers, self.boxes[frame_numbers], self.shapes[frame_numbers])
+
+    def save_binary(self, filename, shape_dtype='i2'):
+        # shape_dtype is 'i2' (int16, whole pixels) or 'f4' (float32). The file is written
+        # next to the final one and then renamed, readers never see half a file
+        if isinstance(shape_dtype, str):
+            shape_dtype = shape_dtype.encode()
+        dtype = SHAPE_DTYPES[shape_dtype]
+        valid_offset, boxes_offset, confidence_offset, shapes_offset, end = binary_layout(self.frame_count, dtype)
+        header = np.zeros(1, dtype=BINARY_HEADER)
+        header['magic'] = BINARY_MAGIC
+        header['version'] = BINARY_VERSION
+        header['frame_count'] = self.frame_count
+        header['n_landmarks'] = 68
+        header['shape_dtype'] = shape_dtype
+
+        shapes = self.shapes
+        if dtype.kind == 'i':
+            shapes = np.round(shapes)
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.truncate(end)
+            for offset, array in ((0, header),
+                                  (valid_offset, np.packbits(self.valid)),
+                                  (boxes_offset, self.boxes.astype('<f4')),
+                                  (confidence_offset, self.confidence.astype('<f4')),
+                                  (shapes_offset, shapes.astype(dtype))):
+                f.seek(offset)
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def open_binary(cls, filename, mapped=True):
+        # memory-map a binary landmark file (or read it if mapped is False). Changes made to
+        # the store are kept in memory, the file only changes with save_binary
+        header = np.fromfile(filename, dtype=BINARY_HEADER, count=1)
+        if len(header) == 0 or header['magic'][0] != BINARY_MAGIC or header['version'][0] > BINARY_VERSION:
+            raise ValueError('Not a landmark file')
+        frame_count = int(header['frame_count'][0])
+        dtype = SHAPE_DTYPES.get(header['shape_dtype'][0])
+        if dtype is None or header['n_landmarks'][0] != 68:
+            raise ValueError('Unknown landmark format')
+        valid_offset, boxes_offset, confidence_offset, shapes_offset, end = binary_layout(frame_count, dtype)
+        if os.path.getsize(filename) < end:
+            raise ValueError('Landmark file is truncated')
+
+        store = cls.__new__(cls)
+        store.frame_count = frame_count
+        if frame_count == 0:
+            store.__init__(0, dtype)
+            return store
+        store.valid = np.unpackbits(np.fromfile(filename, dtype=np.uint8, count=(frame_count + 7) // 8,
+                                                offset=valid_offset))[:frame_count].astype(bool)
+        store.boxes = np.memmap(filename, dtype='<f4', mode='c', offset=boxes_offset, shape=(frame_count, 4))
+        store.confidence = np.memmap(filename, dtype='<f4', mode='c', offset=confidence_offset, shape=(frame_count,))
+        store.shapes = np.memmap(filename, dtype=dtype, mode='c', offset=shapes_offset, shape=(frame_count, 68, 2))
+        if not mapped:
+            store.release()
+        return store
+
+    def release(self):
+        # stop using the file of a memory-mapped store, the landmarks are copied into memory.
+        # Everybody that holds the store keeps working with it, and the file can be replaced
+        for name in ('boxes', 'confidence', 'shapes'):
+            array = getattr(self, name)
+            if isinstance(array, np.memmap):
+                setattr(self, name, np.array(array))
+
+
+class SparseLandmarkStore:
+    """
+    Landmarks of the processed frames only. bitmap is the packed bitmap (one
+    bit per frame, see np.packbits) of the frames with landmarks, boxes,
+    confidence and shapes hold one row per set bit, in frame order. The rank
+    table counts the set bits before every block of RANK_BLOCK frames, rank()
+    (position of a frame in the packed arrays) and select() (frame of a
+    position) only have to look inside one block.
+    cleared is the bitmap of the frames that were processed without finding a
+    face, they remove older landmarks when runs are merged.
+    """
+
+    def __init__(self, frame_count, bitmap, boxes, confidence, shapes, cleared=None):
+        self.frame_count = frame_count
+        n_bytes = (frame_count + 7) // 8
+        self.bitmap = np.zeros(n_bytes, dtype=np.uint8)
+        self.bitmap[:min(n_bytes, len(bitmap))] = bitmap[:n_bytes]
+        if frame_count % 8:
+            # bits after the last frame are not frames
+            self.bitmap[-1:] &= (0xFF << (8 - frame_count % 8)) & 0xFF
+        self.cleared = np.zeros(n_bytes, dtype=np.uint8)
+        if cleared is not None:
+            self.cleared[:min(n_bytes, len(cleared))] = cleared[:n_bytes]
+            self.cleared &= ~self.bitmap
+        block_bytes = RANK_BLOCK // 8
+        counts = POPCOUNT[self.bitmap]
+        blocks = np.add.reduceat(counts, np.arange(0, n_bytes, block_bytes), dtype=np.int64) if n_bytes else []
+        self._rank = np.concatenate(([0], np.cumsum(blocks, dtype=np.int64)))
+        if len(boxes) != self._rank[-1] or len(shapes) != self._rank[-1] or len(confidence) != self._rank[-1]:
+            raise ValueError('The landmarks do not match the bitmap')
+        self.boxes = boxes
+        self.confidence = confidence
+        self.shapes = shapes
+
+    @classmethod
+    def empty(cls, frame_count=0, shape_dtype=np.int32):
+        return cls(frame_count, np.zeros(0, dtype=np.uint8), np.zeros((0, 4), dtype=np.float32),
+                   np.zeros(0, dtype=np.float32), np.zeros((0, 68, 2), dtype=shape_dtype))
+
+    @classmethod
+    def from_arrays(cls, frame_numbers, boxes, shapes, confidence=None, frame_count=None, cleared_frames=(),
+                    shape_dtype=np.int32):
+        # landmarks of unsorted frames, a frame that appears more than once keeps its last row.
+        # cleared_frames are processed frames without face
+        frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+        cleared_frames = np.asarray(cleared_frames, dtype=np.int64)
+        if frame_count is None:
+            frame_count = int(max(frame_numbers.max() if len(frame_numbers) else -1,
+                                  cleared_frames.max() if len(cleared_frames) else -1)) + 1
+        if confidence is None:
+            confidence = np.full(len(frame_numbers), np.nan)
+        # last occurrence of every frame, in frame order
+        reverse = frame_numbers[::-1]
+        unique, first = np.unique(reverse, return_index=True)
+        rows = len(frame_numbers) - 1 - first
+        valid = np.zeros(frame_count, dtype=bool)
+        valid[unique] = True
+        cleared = np.zeros(frame_count, dtype=bool)
+        cleared[cleared_frames] = True
+        shapes = np.asarray(shapes).reshape(-1, 68, 2)[rows]
+        if np.dtype(shape_dtype).kind == 'i':
+            shapes = np.round(shapes)
+        return cls(frame_count, np.packbits(valid), np.asarray(boxes, dtype=np.float32).reshape(-1, 4)[rows],
+                   np.asarray(confidence, dtype=np.float32)[rows], shapes.astype(shape_dtype), np.packbits(cleared))
+
+    @classmethod
+    def from_store(cls, store):
+        frame_numbers = store.frame_numbers()
+        return cls(store.frame_count, np.packbits(store.valid), np.asarray(store.boxes[frame_numbers]),
+                   np.asarray(store.confidence[frame_numbers]), np.asarray(store.shapes[frame_numbers]))
+
+    def to_store(self, frame_count=None):
+        # dense LandmarkStore with the same landmarks
+        store = LandmarkStore(self.frame_count if frame_count is None else frame_count, self.shapes.dtype)
+        frame_numbers = self.frame_numbers()
+        store.add(frame_numbers, self.boxes, self.shapes)
+        inside = frame_numbers < store.frame_count
+        store.confidence[frame_numbers[inside]] = self.confidence[inside]
+        return store
+
+    def __len__(self):
+        return int(self._rank[-1])
+
+    def __contains__(self, frame_number):
+        return 0 <= frame_number < self.frame_count and bool(self.bitmap[frame_number >> 3] & (0x80 >> (frame_number & 7)))
+
+    def rank(self, frame_number):
+        # number of frames with landmarks before frame_number, the row of frame_number
+        # in the packed arrays if it has landmarks
+        if frame_number <= 0:
+            return 0
+        if frame_number >= self.frame_count:
+            return len(self)
+        byte, bit = divmod(frame_number, 8)
+        block = frame_number // RANK_BLOCK
+        count = int(self._rank[block]) + int(POPCOUNT[self.bitmap[block * (RANK_BLOCK // 8):byte]].sum())
+        if bit:
+            count += int(POPCOUNT[self.bitmap[byte] & ((0xFF << (8 - bit)) & 0xFF)])
+        return count
+
+    def select(self, index):
+        # frame of row index of the packed arrays
+        if not 0 <= index < len(self):
+            raise IndexError('Only ' + str(len(self)) + ' frames have landmarks')
+        block = int(np.searchsorted(self._rank, index, side='right')) - 1
+        start = block * (RANK_BLOCK // 8)
+        counts = np.cumsum(POPCOUNT[self.bitmap[start:start + RANK_BLOCK // 8]])
+        remaining = index - int(self._rank[block])
+        byte = int(np.searchsorted(counts, remaining, side='right'))
+        if byte > 0:
+            remaining -= int(counts[byte - 1])
+        bits = np.flatnonzero(np.unpackbits(self.bitmap[start + byte:start + byte + 1]))
+        return (start + byte) * 8 + int(bits[remaining])
+
+    def get(self, frame_number):
+        # landmarks of a frame or None if the frame has not been processed
+        if frame_number not in self:
+            return None
+        return self.shapes[self.rank(frame_number)]
+
+    def boundingbox(self, frame_number):
+        if frame_number not in self:
+            return None
+        return self.boxes[self.rank(frame_number)]
+
+    def frame_numbers(self):
+        # frames that have landmarks
+        return np.flatnonzero(np.unpackbits(self.bitmap)[:self.frame_count])
+
+    def next_processed(self, frame_number):
+        # first frame with landmarks after frame_number, None if there is none
+        index = self.rank(frame_number + 1)
+        return self.select(index) if index < len(self) else None
+
+    def previous_processed(self, frame_number):
+        # last frame with landmarks before frame_number, None if there is none
+        index = self.rank(frame_number)
+        return self.select(index - 1) if index > 0 else None
+
+    def merge(self, newer):
+        # landmarks of both stores, the frames of newer (with or without face) replace the
+        # frames of this store
+        frame_count = max(self.frame_count, newer.frame_count)
+
+        def bits(bitmap, n):
+            unpacked = np.zeros(frame_count, dtype=bool)
+            unpacked[:n] = np.unpackbits(bitmap)[:n]
+            return unpacked
+
+        own_frames = self.frame_numbers()
+        replaced = bits(newer.bitmap | newer.cleared, newer.frame_count)
+        keep = ~replaced[own_frames]
+        valid = (bits(self.bitmap, self.frame_count) & ~replaced) | bits(newer.bitmap, newer.frame_count)
+        cleared = bits(self.cleared, self.frame_count) | bits(newer.cleared, newer.frame_count)
+
+        frame_numbers = np.flatnonzero(valid)
+        n = len(frame_numbers)
+        dtype = np.result_type(self.shapes.dtype, newer.shapes.dtype)
+        boxes = np.zeros((n, 4), dtype=np.float32)
+        confidence = np.zeros(n, dtype=np.float32)
+        shapes = np.zeros((n, 68, 2), dtype=dtype)
+        rows = np.searchsorted(frame_numbers, own_frames[keep])
+        boxes[rows], confidence[rows], shapes[rows] = self.boxes[keep], self.confidence[keep], self.shapes[keep]
+        rows = np.searchsorted(frame_numbers, newer.frame_numbers())
+        boxes[rows], confidence[rows], shapes[rows] = newer.boxes, newer.confidence, newer.shapes
+        return SparseLandmarkStore(frame_count, np.packbits(valid), boxes, confidence, shapes, np.packbits(cleared))
+
+    def _run(self, shape_dtype='i2'):
+        # header and data of this store as a run of a sparse file
+        if isinstance(shape_dtype, str):
+            shape_dtype = shape_dtype.encode()
+        dtype = SHAPE_DTYPES[shape_dtype]
+        shapes = self.shapes
+        if dtype.kind == 'i':
+            shapes = np.round(shapes)
+        bitmap = zlib.compress(self.bitmap.tobytes())
+        cleared = zlib.compress(self.cleared.tobytes())
+        data = b''.join((bitmap, cleared, np.ascontiguousarray(self.boxes, dtype='<f4').tobytes(),
+                         np.ascontiguousarray(self.confidence, dtype='<f4').tobytes(),
+                         np.ascontiguousarray(shapes, dtype=dtype).tobytes()))
+        header = np.zeros(1, dtype=RUN_HEADER)
+        header['magic'] = RUN_MAGIC
+        header['version'] = RUN_VERSION
+        header['frame_count'] = self.frame_count
+        header['n_frames'] = len(self)
+        header['bitmap_size'] = len(bitmap)
+        header['cleared_size'] = len(cleared)
+        header['shape_dtype'] = shape_dtype
+        header['checksum'] = zlib.crc32(data)
+        return header.tobytes() + data
+
+    def append_run(self, filename, shape_dtype='i2'):
+        # add the landmarks of this store to a sparse file (created if needed) without
+        # rewriting the runs already there
+        with open(filename, 'ab') as f:
+            f.write(self._run(shape_dtype))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def save(self, filename, shape_dtype='i2'):
+        # sparse file with this store as its only run, replaces the file
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(self._run(shape_dtype))
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def read_runs(cls, filename):
+        # stores of the runs of a sparse file, in the order they were written. A run that
+        # was not completely written (the program stopped while appending it) and the
+        # ones after it are ignored
+        runs = []
+        with open(filename, 'rb') as f:
+            while True:
+                header = np.frombuffer(f.read(RUN_HEADER.itemsize), dtype=RUN_HEADER)
+                if len(header) == 0:
+                    break
+                header = header[0]
+                if header['magic'] != RUN_MAGIC or header['version'] > RUN_VERSION:
+                    if not runs:
+                        raise ValueError('Not a landmark file')
+                    break
+                dtype = SHAPE_DTYPES.get(header['shape_dtype'])
+                if dtype is None:
+                    raise ValueError('Unknown landmark format')
+                n = int(header['n_frames'])
+                size = (int(header['bitmap_size']) + int(header['cleared_size']) + n * 4 * 4 + n * 4 +
+                        n * 68 * 2 * dtype.itemsize)
+                data = f.read(size)
+                if len(data) < size or zlib.crc32(data) != header['checksum']:
+                    break
+                offset = int(header['bitmap_size'])
+                bitmap = np.frombuffer(zlib.decompress(data[:offset]), dtype=np.uint8)
+                cleared = np.frombuffer(zlib.decompress(data[offset:offset + int(header['cleared_size'])]),
+                                        dtype=np.uint8)
+                offset += int(header['cleared_size'])
+                boxes = np.frombuffer(data, dtype='<f4', count=n * 4, offset=offset).reshape(n, 4)
+                offset += n * 4 * 4
+                confidence = np.frombuffer(data, dtype='<f4', count=n, offset=offset)
+                offset += n * 4
+                shapes = np.frombuffer(data, dtype=dtype, count=n * 68 * 2, offset=offset).reshape(n, 68, 2)
+                runs.append(cls(int(header['frame_count']), bitmap, boxes, confidence, shapes, cleared))
+        return runs
+
+    @classmethod
+    def load(cls, filename):
+        # all the runs of a sparse file merged in a single store
+        runs = cls.read_runs(filename)
+        if not runs:
+            raise ValueError('Not a landmark file')
+        store = runs[0]
+        for run in runs[1:]:
+            store = store.merge(run)
+        return store
+
+    @classmethod
+    def compact(cls, filename, shape_dtype='i2'):
+        # replace the runs of a sparse file by a single run with the same landmarks
+        store = cls.load(filename)
+        store.save(filename, shape_dtype)
+        return store
+
+
+def _record_checksum(record):
+    return zlib.crc32(record.tobytes()[:LOG_RECORD.itemsize - 4])
+
+
+def _log_header(filename, magic=LOG_MAGIC, record=LOG_RECORD):
+    header = np.fromfile(filename, dtype=LOG_HEADER, count=1)
+    if len(header) == 0 or header['magic'][0] != magic or header['record_size'][0] != record.itemsize:
+        return None
+    return header[0]
+
+
+def read_landmark_log(filename, signature=None):
+    # complete records of a landmark log, in the order they were written. The file can
+    # be read while it is being written. If signature is given (see
+    # video_index.video_signature) and the log was written for a different version of
+    # the video, no records are returned
+    empty = np.zeros(0, dtype=LOG_RECORD)
+    if not os.path.exists(filename):
+        return empty
+    header = _log_header(filename)
+    if header is None or (signature is not None and not np.array_equal(header['signature'], signature)):
+        return empty
+    n_records = (os.path.getsize(filename) - LOG_HEADER.itemsize) // LOG_RECORD.itemsize
+    records = np.fromfile(filename, dtype=LOG_RECORD, count=n_records, offset=LOG_HEADER.itemsize)
+    for i, record in enumerate(records):
+        if record['checksum'] != _record_checksum(record):
+            # the writer died while writing this record, the ones after it are not reliable
+            return records[:i]
+    return records
+
+
+class LandmarkWriter:
+    """
+    Appends the landmarks of each processed frame to a log file, one fixed size
+    record per frame. The data is forced to disk (fsync) every sync_frames
+    records or sync_seconds seconds, so a crash loses at most those frames. If
+    the log exists and was created for the same video (signature) new records
+    are appended after the complete records already there, done() tells which
+    frames are already in the log.
+    """
+
+    def __init__(self, filename, signature=None, sync_frames=50, sync_seconds=2.0):
+        self.filename = filename
+        self.sync_frames = sync_frames
+        self.sync_seconds = sync_seconds
+        signature = np.zeros(2, dtype=np.int64) if signature is None else np.asarray(signature)
+
+        header = _log_header(filename) if os.path.exists(filename) else None
+        if header is not None and np.array_equal(header['signature'], signature):
+            records = read_landmark_log(filename)
+            # drop a record that was being written when the previous writer stopped
+            self.file = open(filename, 'r+b')
+            self.file.truncate(LOG_HEADER.itemsize + len(records) * LOG_RECORD.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            header = np.zeros(1, dtype=LOG_HEADER)
+            header['magic'] = LOG_MAGIC
+            header['version'] = LOG_VERSION
+            header['record_size'] = LOG_RECORD.itemsize
+            header['signature'] = signature
+            self.file = open(filename, 'wb')
+            self.file.write(header.tobytes())
+            records = np.zeros(0, dtype=LOG_RECORD)
+        self.existing = records
+        self._record = np.zeros(1, dtype=LOG_RECORD)
+        self._unsynced = 0
+        self._last_sync = time.perf_counter()
+
+    def done(self):
+        # frames that were in the log when it was opened
+        return set(int(n) for n in self.existing['frame_number'])
+
+    def append(self, frame_number, boundingbox=None, shape=None, confidence=np.nan):
+        # boundingbox and shape are None if there is no face in the frame
+        record = self._record
+        record['frame_number'] = frame_number
+        record['box'] = np.nan if boundingbox is None else boundingbox
+        record['shape'] = np.nan if shape is None else shape
+        record['confidence'] = confidence
+        record['checksum'] = _record_checksum(record[0])
+        self.file.write(record.tobytes())
+        self._unsynced += 1
+        if self._unsynced >= self.sync_frames or time.perf_counter() - self._last_sync >= self.sync_seconds:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.perf_counter()
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+
+def store_from_log(records, frame_count=None):
+    # LandmarkStore with the frames of a log that have a face, later records of
+    # the same frame replace earlier ones
+    face = ~np.isnan(records['box']).any(axis=1)
+    records = records[face]
+    store = LandmarkStore.from_arrays(records['frame_number'], records['box'], records['shape'], frame_count)
+    inside = records['frame_number'] < store.frame_count
+    store.confidence[records['frame_number'][inside]] = records['confidence'][inside]
+    return store
+
+
+# one lock per video, see landmark_file_lock
+_file_locks = {}
+_file_locks_lock = Lock()
+
+
+def landmark_file_lock(landmark_filename):
+    # lock of the landmark file of a video (whatever its format) and of its correction log
+    key = os.path.abspath(os.path.splitext(landmark_filename)[0])
+    with _file_locks_lock:
+        return _file_locks.setdefault(key, Lock())
+
+
+def correction_log_filename(landmark_filename):
+    return os.path.splitext(landmark_filename)[0] + CORRECTION_ENDING
+
+
+def landmark_signature(landmark_filename):
+    # size and modification time (ns) of a landmark file, zeros if there is no file. The
+    # file has the same size after a binary file is replaced, the time tells them apart
+    if not os.path.exists(landmark_filename):
+        return np.zeros(2, dtype=np.int64)
+    stats = os.stat(landmark_filename)
+    return np.array([stats.st_size, stats.st_mtime_ns], dtype=np.int64)
+
+
+def _correction_checksum(record):
+    return zlib.crc32(record.tobytes()[:CORRECTION_RECORD.itemsize - 4])
+
+
+def read_correction_log(filename, signature=None):
+    # complete records of a correction log, in the order they were written. If signature
+    # is given (see landmark_signature) and the log was written for a different version
+    # of the landmark file, no records are returned
+    empty = np.zeros(0, dtype=CORRECTION_RECORD)
+    if not os.path.exists(filename):
+        return empty
+    header = _log_header(filename, CORRECTION_MAGIC, CORRECTION_RECORD)
+    if header is None or (signature is not None and not np.array_equal(header['signature'], signature)):
+        return empty
+    n_records = (os.path.getsize(filename) - LOG_HEADER.itemsize) // CORRECTION_RECORD.itemsize
+    records = np.fromfile(filename, dtype=CORRECTION_RECORD, count=n_records, offset=LOG_HEADER.itemsize)
+    for i, record in enumerate(records):
+        if record['checksum'] != _correction_checksum(record):
+            return records[:i]
+    return records
+
+
+def _write_correction_log(filename, records, signature):
+    # new correction log with the given records, replaces the log
+    header = np.zeros(1, dtype=LOG_HEADER)
+    header['magic'] = CORRECTION_MAGIC
+    header['version'] = LOG_VERSION
+    header['record_size'] = CORRECTION_RECORD.itemsize
+    header['signature'] = signature
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(records.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, filename)
+
+
+def keep_corrections(landmark_filename, records):
+    # the landmark file was replaced, the records are still valid for the new file. The
+    # log is removed if there are no records. The caller holds landmark_file_lock
+    log_filename = correction_log_filename(landmark_filename)
+    if len(records) > 0:
+        _write_correction_log(log_filename, records, landmark_signature(landmark_filename))
+    elif os.path.exists(log_filename):
+        os.remove(log_filename)
+
+
+class LandmarkCorrections:
+    """
+    Manual corrections layered over a landmark store (dense or sparse). Every
+    correct(frame, landmark, x, y) is appended to the correction log and forced
+    to disk, a single record whatever the length of the video. get() returns
+    the landmarks of the store with the corrections of the frame applied.
+    When the log has more than compact_records records the corrections are
+    copied into landmark_filename in a different thread (see compact) and the
+    log is emptied. Corrections made meanwhile stay in the log. Before a binary
+    landmark file is replaced its store is released (see LandmarkStore.release).
+    Corrections of a log written for a different version of the landmark file
+    are ignored. Whoever else replaces the landmark file must call release()
+    first, holding landmark_file_lock.
+    """
+
+    def __init__(self, store, landmark_filename, compact_records=500):
+        self.store = store
+        self.landmark_filename = landmark_filename
+        self.log_filename = correction_log_filename(landmark_filename)
+        self.compact_records = compact_records
+        self.corrections = {}  # frame_number -> {landmark: (x, y)}
+        self.error = None
+
+        records = read_correction_log(self.log_filename, landmark_signature(landmark_filename))
+        for record in records:
+            self._apply(record)
+        self.n_records = len(records)
+        self.file = None  # the log is opened with the first correction
+        self._record = np.zeros(1, dtype=CORRECTION_RECORD)
+        self.lock = Lock()
+        self.compaction = None
+
+    def _apply(self, record):
+        frame = self.corrections.setdefault(int(record['frame_number']), {})
+        frame[int(record['landmark'])] = tuple(float(c) for c in record['position'])
+
+    def __contains__(self, frame_number):
+        return frame_number in self.store
+
+    def __len__(self):
+        return len(self.store)
+
+    def get(self, frame_number):
+        # landmarks of a frame with its corrections, a copy if the frame was corrected
+        shape = self.store.get(frame_number)
+        if shape is None or frame_number not in self.corrections:
+            return shape
+        shape = np.array(shape)
+        for landmark, position in self.corrections[frame_number].items():
+            shape[landmark] = np.round(position) if shape.dtype.kind == 'i' else position
+        return shape
+
+    def boundingbox(self, frame_number):
+        return self.store.boundingbox(frame_number)
+
+    def frame_numbers(self):
+        return self.store.frame_numbers()
+
+    def next_processed(self, frame_number):
+        return self.store.next_processed(frame_number)
+
+    def previous_processed(self, frame_number):
+        return self.store.previous_processed(frame_number)
+
+    def release(self):
+        # the landmark file and the log are going to be replaced by somebody else. The
+        # store stops using the file (sparse stores are never mapped) and the log is
+        # closed, the next correction opens it again
+        with self.lock:
+            if isinstance(self.store, LandmarkStore):
+                self.store.release()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _open_log(self):
+        # new records go after the complete records of the log, a record that was being
+        # written when the log was closed is dropped, and so is a log written for a
+        # different version of the landmark file
+        signature = landmark_signature(self.landmark_filename)
+        records = read_correction_log(self.log_filename, signature)
+        _write_correction_log(self.log_filename, records, signature)
+        self.n_records = len(records)
+        self.file = open(self.log_filename, 'ab')
+
+    def _write(self, frame_number, landmark, x, y):
+        # append a record to the log, False if the log is not open
+        if self.file is None:
+            return False
+        record = self._record
+        record['frame_number'] = frame_number
+        record['landmark'] = landmark
+        record['position'] = (x, y)
+        record['checksum'] = _correction_checksum(record[0])
+        self.file.write(record.tobytes())
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._apply(record[0])
+        self.n_records += 1
+        return True
+
+    def correct(self, frame_number, landmark, x, y):
+        with self.lock:
+            written = self._write(frame_number, landmark, x, y)
+        if not written:
+            # opening the log rewrites it, it waits for whoever is replacing the landmark
+            # file. The file lock is always taken before self.lock
+            with landmark_file_lock(self.landmark_filename):
+                with self.lock:
+                    if self.file is None:
+                        self._open_log()
+                    self._write(frame_number, landmark, x, y)
+        if self.n_records > self.compact_records:
+            self.start_compaction()
+
+    def start_compaction(self):
+        if self.compaction is not None and self.compaction.is_alive():
+            return
+        self.compaction = Thread(target=self.update, args=())
+        self.compaction.daemon = True
+        self.compaction.start()
+
+    def update(self):
+        try:
+            self.compact()
+        except (OSError, ValueError) as error:
+            # the corrections stay in the log
+            self.error = error
+
+    def compact(self):
+        with landmark_file_lock(self.landmark_filename):
+            self._compact()
+
+    def _compact(self):
+        # copy the corrections in the log into the landmark file and remove them from the
+        # log. The landmark file is replaced (sparse files get a new run) before the log is
+        # emptied, if the program stops in between the log no longer matches the landmark
+        # file and is ignored: the corrections made during the compaction are lost
+        with self.lock:
+            n_records = self.n_records
+        records = read_correction_log(self.log_filename, landmark_signature(self.landmark_filename))[:n_records]
+        if len(records) == 0:
+            return
+        corrections = {}
+        for record in records:
+            corrections.setdefault(int(record['frame_number']), {})[int(record['landmark'])] = record['position']
+
+        if self.landmark_filename.endswith(SPARSE_ENDING):
+            base = SparseLandmarkStore.load(self.landmark_filename)
+        else:
+            base = LandmarkStore.load(self.landmark_filename, mapped=False)
+        sparse = isinstance(base, SparseLandmarkStore)
+        frame_numbers, boxes, shapes, confidence = [], [], [], []
+        for frame_number, landmarks in corrections.items():
+            shape = base.get(frame_number)
+            if shape is None:
+                # the frame lost its landmarks (processed again without finding a face)
+                continue
+            shape = np.array(shape, dtype=np.float64)
+            for landmark, position in landmarks.items():
+                shape[landmark] = position
+            frame_numbers.append(frame_number)
+            boxes.append(base.boundingbox(frame_number))
+            shapes.append(shape)
+            confidence.append(base.confidence[base.rank(frame_number) if sparse else frame_number])
+        if frame_numbers:
+            if sparse:
+                # only the corrected frames are written
+                run = SparseLandmarkStore.from_arrays(frame_numbers, boxes, shapes, confidence)
+                run.append_run(self.landmark_filename)
+            else:
+                for frame_number, box, shape, value in zip(frame_numbers, boxes, shapes, confidence):
+                    base.set(frame_number, box, shape, value)
+                with self.lock:
+                    # the log stays open, only the file of the store is replaced
+                    self.store.release()
+                base.save(self.landmark_filename)
+
+        with self.lock:
+            # corrections made during the compaction are kept
+            remaining = read_correction_log(self.log_filename)[n_records:]
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            keep_corrections(self.landmark_filename, remaining)
+            self.n_records = len(remaining)
+
+    def close(self):
+        if self.compaction is not None:
+            self.compaction.join()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class LandmarkLoader:
+    """
+    Loads a landmark file in a different thread. store is available right away
+    and is filled as the file is read, in chunks of chunk_rows rows (the first
+    chunk is small so that the first frames are ready almost immediately).
+    chunk_callback(first_frame, last_frame) is called after every chunk and
+    finished_callback(loader) at the end, error is set if the file cannot be
+    read. Binary files are memory-mapped and sparse files are read when the
+    loader is created, they are ready immediately.
+    """
+
+    def __init__(self, filename, frame_count, chunk_rows=5000, first_chunk_rows=64, chunk_callback=None,
+                 finished_callback=None):
+        self.filename = filename
+        self.frame_count = frame_count
+        self.chunk_rows = chunk_rows
+        self.first_chunk_rows = first_chunk_rows
+        self.chunk_callback = chunk_callback
+        self.finished_callback = finished_callback
+        self.loaded = False
+        self.error = None
+        if filename.endswith(BINARY_ENDING):
+            self.store = LandmarkStore.open_binary(filename)
+            self.loaded = True
+        elif filename.endswith(SPARSE_ENDING):
+            self.store = SparseLandmarkStore.load(filename)
+            self.loaded = True
+        else:
+            self.store = LandmarkStore(frame_count)
+        self.stopped = False
+        self.Thread = Thread(target=self.update, args=())
+        self.Thread.daemon = True
+
+    def start(self):
+        self.Thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+
+    def update(self):
+        try:
+            if not self.loaded:
+                self.read_csv()
+                self.loaded = not self.stopped
+        except (OSError, ValueError, pd.errors.ParserError) as error:
+            self.error = error
+        if self.finished_callback is not None:
+            self.finished_callback(self)
+
+    def read_csv(self):
+        with pd.read_csv(self.filename, iterator=True) as chunks:
+            rows = self.first_chunk_rows
+            while not self.stopped:
+                try:
+                    values = chunks.get_chunk(rows).values
+                except StopIteration:
+                    break
+                if len(values) == 0:
+                    break
+                self.store.add_csv_rows(values)
+                if self.chunk_callback is not None:
+                    self.chunk_callback(int(values[0, 1]), int(values[-1, 1]))
+                rows = self.chunk_rows
+
+
+def convert(input_filename, output_filename, shape_dtype='i2'):
+    # convert a landmark file between the .csv, binary and sparse formats
+    LandmarkStore.load(input_filename).save(output_filename, shape_dtype)
+
+
+if __name__ == '__main__':
+    # python landmark_store.py video.csv video.landmarks (or the other way around)
+    if len(sys.argv) != 3:
+        print('usage: python landmark_store.py input_file output_file')
+        sys.exit(1)
+    convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Long landmark localization jobs (all the frames of a video or a selection of
+frames). The job runs in its own thread, can be paused, resumed and cancelled,
+and reports its progress and the estimated remaining time. Every processed
+frame is appended to a log file next to the video (see LandmarkWriter), if
+the job is interrupted (cancelled, program closed, crash) running the job
+again skips the frames that are already in the log.
+"""
+import os
+import time
+import numpy as np
+from threading import Thread, Event
+
+from video_index import sidecar_filename, video_signature
+from video_reader import FrameReader
+from frame_plan import FramePlan
+from landmark_store import (LandmarkStore, SparseLandmarkStore, LandmarkWriter, find_landmark_file,
+                            SPARSE_ENDING, landmark_file_lock, landmark_signature, correction_log_filename,
+                            read_correction_log, keep_corrections)
+
+
+class LandmarkJob:
+    """
+    Localizes the landmarks of the frames of a FramePlan with process_function
+    (frame_number, frame) -> (bounding box, landmarks) or None, by default the
+    face detection and FaceAlignment models used by batch_process. The
+    results are merged into the landmark file of the video when the job
+    finishes. If the video has no landmark file a new .csv file is created, or
+    a sparse file if sparse is True (only some frames are processed). Sparse
+    files get the results as a new run, the file is not rewritten. The log is forced to disk every
+    sync_frames frames. If frame_cache (a MemmapFrameCache of the video) is given
+    the frames are read from it and the decoded ones are stored in it, landmarks
+    found in downscaled frames are converted to video pixels.
+    progress_callback(done, total, eta) is called after every frame, eta is the
+    estimated remaining time in seconds (None until it can be estimated).
+    finished_callback(job) is called when the job ends (finished, cancelled or
+    stopped by an error). before_save() is called before the landmark file is
+    replaced, whoever has the file open (memory-mapped) or is writing its
+    correction log must release them (see LandmarkCorrections.release). The
+    manual corrections of the frames that were processed again are discarded,
+    the others are kept.
+    """
+
+    sidecar_ending = '_landmark_job.log'
+
+    def __init__(self, video_filename, frame_plan, keyframe_index=None, frame_timestamps=None,
+                 backend='opencv', process_function=None, sync_frames=50, progress_callback=None,
+                 finished_callback=None, sparse=False, frame_cache=None, before_save=None):
+        self.video_filename = video_filename
+        self.landmark_filename = os.path.splitext(video_filename)[0] + (SPARSE_ENDING if sparse else '.csv')
+        self.log_filename = sidecar_filename(video_filename, self.sidecar_ending)
+        self.frame_plan = frame_plan
+        self.keyframe_index = keyframe_index
+        self.frame_timestamps = frame_timestamps
+        self.backend = backend
+        if process_function is None:
+            from batch_process import process_frame
+            process_function = process_frame
+        self.process_function = process_function
+        self.frame_cache = frame_cache
+        self.sync_frames = sync_frames
+        self.progress_callback = progress_callback
+        self.finished_callback = finished_callback
+        self.before_save = before_save
+
+        self.results = {}  # frame_number -> (bounding box, landmarks), None if there is no face
+        self.total = len(frame_plan)
+        self.finished = False
+        self.error = None
+
+        self.cancelled = Event()
+        self._running = Event()  # cleared while the job is paused
+        self._running.set()
+        self.Thread = Thread(target=self.update, args=())
+        self.Thread.daemon = True
+
+    def start(self):
+        self.Thread.start()
+        return self
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def cancel(self):
+        # the frames processed so far stay in the log
+        self.cancelled.set()
+        self._running.set()
+
+    def wait(self, timeout=None):
+        self.Thread.join(timeout)
+
+    def update(self):
+        try:
+            self.run()
+        except Exception as error:
+            # the log keeps the work done so far, the job can be started again
+            self.error = error
+        if self.finished_callback is not None:
+            self.finished_callback(self)
+
+    def run(self):
+        writer = LandmarkWriter(self.log_filename, video_signature(self.video_filename), self.sync_frames)
+        # frames of this job that were processed by a previous run
+        selected = set(self.frame_plan.frame_numbers)
+        for record in writer.existing:
+            frame_number = int(record['frame_number'])
+            if frame_number in selected:
+                if np.isnan(record['box']).any():
+                    self.results[frame_number] = None
+                else:
+                    self.results[frame_number] = (record['box'], record['shape'])
+        remaining = [n for n in self.frame_plan.frame_numbers if n not in self.results]
+        plan = FramePlan(remaining, self.keyframe_index, self.frame_plan.max_grab)
+        reader = FrameReader(self.video_filename, self.keyframe_index, backend=self.backend,
+                             frame_timestamps=self.frame_timestamps)
+
+        if self.frame_cache is not None:
+            frames = self.frame_cache.read_frames(reader, remaining)
+        else:
+            frames = plan.read(reader)
+
+        start = time.perf_counter()
+        processed = 0  # frames processed in this run, used for the eta
+        try:
+            for frame_number, frame in frames:
+                self._running.wait()
+                if self.cancelled.is_set():
+                    break
+                result = self.process_function(frame_number, frame)
+                if result is not None and self.frame_cache is not None:
+                    result = (self.frame_cache.video_coordinates(result[0]),
+                              self.frame_cache.video_coordinates(result[1]))
+                self.results[frame_number] = result
+                if result is None:
+                    writer.append(frame_number)
+                else:
+                    writer.append(frame_number, result[0], result[1])
+                processed += 1
+                if self.progress_callback is not None:
+                    done = len(self.results)
+                    rate = processed / (time.perf_counter() - start)
+                    self.progress_callback(done, self.total, (self.total - done) / rate if rate > 0 else None)
+        finally:
+            reader.release()
+            writer.close()
+            if self.frame_cache is not None:
+                self.frame_cache.flush()
+
+        if self.cancelled.is_set():
+            return
+        # the video might be shorter than expected, the job is done anyway
+        self.save_results()
+        os.remove(self.log_filename)
+        self.finished = True
+
+    def save_results(self):
+        # merge the new landmarks with the landmark file of the video (in the format of
+        # that file), frames that were processed again are replaced
+        existing = find_landmark_file(self.video_filename)
+        if existing is not None:
+            self.landmark_filename = existing
+        with landmark_file_lock(self.landmark_filename):
+            if self.before_save is not None:
+                self.before_save()
+            # corrections made over the landmarks that are going to be replaced
+            corrections = read_correction_log(correction_log_filename(self.landmark_filename),
+                                              landmark_signature(self.landmark_filename))
+            self._save_results(existing)
+            reprocessed = np.isin(corrections['frame_number'], np.fromiter(self.results, dtype=np.int64))
+            keep_corrections(self.landmark_filename, corrections[~reprocessed])
+
+    def _save_results(self, existing):
+        if self.landmark_filename.endswith(SPARSE_ENDING):
+            # the results are added as a new run, the runs already in the file are kept
+            faces = [n for n, result in self.results.items() if result is not None]
+            run = SparseLandmarkStore.from_arrays(
+                faces, [self.results[n][0] for n in faces], [self.results[n][1] for n in faces],
+                cleared_frames=[n for n, result in self.results.items() if result is None])
+            run.append_run(self.landmark_filename)
+            return
+        if existing is not None:
+            # read into memory, the file is going to be replaced
+            store = LandmarkStore.load(existing, mapped=False)
+        else:
+            store = LandmarkStore(0)
+        store = store.resized(max([store.frame_count] + [n + 1 for n in self.results]))
+        for frame_number, result in self.results.items():
+            if result is None:
+                store.valid[frame_number] = False
+            else:
+                store.set(frame_number, result[0], result[1])
+        store.save(self.landmark_filename)
@@ -11,12 +11,18 @@ from PyQt5 import QtCore
 
 from PyQt5.QtCore import QFile, QTextStream
 
+from frame_plan import FramePlan, parse_frame_list
+
 """
 
 """
 
 
 class ProcessingWindow(QtWidgets.QWidget):
+
+    # the frames selected by the user, as a FramePlan
+    processframes = QtCore.pyqtSignal(object)
+
     def __init__(self, parent=None):
         super(ProcessingWindow, self).__init__(parent)
         
@@ -27,6 +33,10 @@ class ProcessingWindow(QtWidgets.QWidget):
 
         self.numberoflistboundingbox = 1 #this variable counts the number of list used to crete the frames in the bounding box 
 
+        # video that will be processed, required to compile the frame plan
+        self.frame_count = None
+        self.keyframe_index = None
+
         # initialize the User Interface
         self.initUI()
         self.show()
@@ -64,6 +74,15 @@ class ProcessingWindow(QtWidgets.QWidget):
         # self._help_CE.clicked.connect(lambda: self.push_help_CE(pixmap_CE, text_CE_title, text_CE_content))
         # self._help_CE.setIconSize(QtCore.QSize(20, 20))
         
+        # estimated cost of processing the selected frames
+        self.planlabel = QtWidgets.QLabel('')
+        self.planlabel.setFont(QtGui.QFont("Times", 10))
+        processframesLayout.addWidget(self.planlabel, 0, 0, 1, 1)
+
+        processbutton = QtWidgets.QPushButton('Process')
+        processbutton.clicked.connect(self.process)
+        processframesLayout.addWidget(processbutton, 1, 0, 1, 1)
+
         addbutton = QtWidgets.QPushButton('Push')
         addbutton.clicked.connect(self.addNewRow)
 
@@ -136,9 +155,10 @@ class ProcessingWindow(QtWidgets.QWidget):
         self.framelistboundingbox.setFixedHeight(25)
         self.framelistboundingbox.setFont(QtGui.QFont("Times", 8))
 
-        self.framelistboundingbox.setValidator(QtGui.QRegExpValidator(QtCore.QRegExp("^(\d+(,\d+)*)?$")))
+        self.framelistboundingbox.setValidator(QtGui.QRegExpValidator(QtCore.QRegExp("^([1-9]\d*(,[1-9]\d*)*)?$")))
         
-        RegExpVal = QtGui.QRegExpValidator(QtCore.QRegExp("^(\d+)?$"))
+        # frames are numbered from 1, 0 is not accepted
+        RegExpVal = QtGui.QRegExpValidator(QtCore.QRegExp("^([1-9]\d*)?$"))
         
         self.frameinitboundingbox_1 = QtWidgets.QLineEdit()
         self.frameinitboundingbox_1.setMinimumWidth(50)
@@ -174,6 +194,13 @@ class ProcessingWindow(QtWidgets.QWidget):
         layoutadditionalframes_lines.addWidget(self.buttontoaddlines)
         
 
+        # the plan is compiled again every time the selection changes
+        self.allframestick_boundingbox.stateChanged.connect(self.updateplan)
+        self.firstframetick_boundingbox.stateChanged.connect(self.updateplan)
+        for lineedit in (self.framelistboundingbox, self.frameinitboundingbox_1,
+                         self.framestepboundingbox_1, self.frameendboundingbox_1):
+            lineedit.textChanged.connect(self.updateplan)
+
         self.boundingboxLayout.addWidget(label_allframes, 0, 0, 1, 1)
         self.boundingboxLayout.addWidget(self.allframestick_boundingbox, 0, 1, 1, 1)
         self.boundingboxLayout.addWidget(label_firstframes, 1, 0, 1, 1)
@@ -189,6 +216,42 @@ class ProcessingWindow(QtWidgets.QWidget):
         self.setLayout(layout)
 
 
+    def setvideo(self, frame_count, keyframe_index=None):
+        self.frame_count = frame_count
+        self.keyframe_index = keyframe_index
+        self.updateplan()
+
+    def frameplan(self):
+        # compile the selected frames into a FramePlan. Frames are numbered as in the
+        # video viewer (the first frame is 1), the plan uses the decoder numbers (from 0)
+        if self.frame_count is None:
+            return None
+        ranges = []
+        init = self.frameinitboundingbox_1.text()
+        if init:
+            step = self.framestepboundingbox_1.text()
+            end = self.frameendboundingbox_1.text()
+            ranges.append((int(init) - 1, int(step) if step else 1, int(end) - 1 if end else self.frame_count - 1))
+        return FramePlan.from_selection(self.frame_count,
+                                        all_frames=self.allframestick_boundingbox.isChecked(),
+                                        first_frame=self.firstframetick_boundingbox.isChecked(),
+                                        frame_list=[n - 1 for n in parse_frame_list(self.framelistboundingbox.text())],
+                                        ranges=ranges,
+                                        keyframe_index=self.keyframe_index)
+
+    def updateplan(self):
+        plan = self.frameplan()
+        if plan is None:
+            self.planlabel.setText('')
+        else:
+            self.planlabel.setText(plan.summary())
+
+    def process(self):
+        plan = self.frameplan()
+        if plan is not None and len(plan) > 0:
+            self.processframes.emit(plan)
+            self.close()
+
     def addNewRow(self):
         self.pushButton = QtWidgets.QPushButton('I am in Test widget')
         self.boundingboxLayout.addWidget(Test(widget = self.pushButton))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures. The videos are generated once per test session: every frame
+shows its frame number as a row of black and white blocks, so a frame that is
+returned in place of another one is easy to tell apart.
+"""
+import os
+import sys
+import numpy as np
+import cv2
+import pytest
+
+# the modules of the program are in the folder above this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FRAME_SIZE = (320, 240)  # width, height
+N_BITS = 9
+
+
+def numbered_frame(frame_number):
+    width, height = FRAME_SIZE
+    frame = np.full((height, width, 3), 128, dtype=np.uint8)
+    block = width // N_BITS
+    for bit in range(N_BITS):
+        frame[:40, bit * block:(bit + 1) * block] = 255 if (frame_number >> bit) & 1 else 0
+    # something that moves, so that the frames are not all alike for the encoder
+    cv2.circle(frame, (40 + frame_number % 240, 140), 20, (0, 0, 255), -1)
+    return frame
+
+
+def frame_number_of(frame):
+    # frame number shown by a decoded frame
+    block = FRAME_SIZE[0] // N_BITS
+    bits = [frame[5:35, bit * block + 5:(bit + 1) * block - 5].mean() > 128 for bit in range(N_BITS)]
+    return sum(1 << bit for bit, value in enumerate(bits) if value)
+
+
+def decode_all(filename):
+    stream = cv2.VideoCapture(filename)
+    frames = []
+    while True:
+        grabbed, frame = stream.read()
+        if not grabbed:
+            break
+        frames.append(frame)
+    stream.release()
+    return frames
+
+
+@pytest.fixture(scope='session')
+def cfr_video(tmp_path_factory):
+    # (file name, every frame decoded in order) of a 150 frames video at 30 fps
+    filename = str(tmp_path_factory.mktemp('cfr') / 'clip.mp4')
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'mp4v'), 30, FRAME_SIZE)
+    if not writer.isOpened():
+        pytest.skip('OpenCV cannot write mp4 videos')
+    for frame_number in range(150):
+        writer.write(numbered_frame(frame_number))
+    writer.release()
+    return filename, decode_all(filename)
+
+
+@pytest.fixture(scope='session')
+def vfr_video(tmp_path_factory):
+    # (file name, every frame decoded in order) of a 150 frames video with variable frame rate
+    av = pytest.importorskip('av')
+    from fractions import Fraction
+    filename = str(tmp_path_factory.mktemp('vfr') / 'clip.mp4')
+    output = av.open(filename, 'w')
+    stream = output.add_stream('mpeg4', rate=30)
+    stream.width, stream.height = FRAME_SIZE
+    stream.pix_fmt = 'yuv420p'
+    stream.codec_context.time_base = Fraction(1, 1000)
+    stream.codec_context.gop_size = 12
+    intervals = np.random.default_rng(0).choice([16, 33, 50, 100], size=150)
+    time = 0
+    for frame_number in range(150):
+        frame = av.VideoFrame.from_ndarray(numbered_frame(frame_number), format='bgr24')
+        frame.pts = time
+        frame.time_base = Fraction(1, 1000)
+        time += int(intervals[frame_number])
+        for packet in stream.encode(frame):
+            output.mux(packet)
+    for packet in stream.encode():
+        output.mux(packet)
+    output.close()
+    return filename, decode_all(filename)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import numpy as np
+import pytest
+
+import batch_process
+from conftest import frame_number_of
+from landmark_store import LandmarkStore, LandmarkWriter, correction_log_filename
+from processing_job import LandmarkJob
+from video_index import sidecar_filename
+
+
+def fake_landmarks(frame_number, frame, device='cpu'):
+    # stands for the models: no face every 10 frames, otherwise values made from the
+    # number shown by the frame
+    shown = frame_number_of(frame)
+    if shown % 10 == 0:
+        return None
+    boundingbox = np.array([shown, shown + 1, shown + 2, shown + 3], dtype=np.float64)
+    return boundingbox, np.full((68, 2), shown, dtype=np.float64)
+
+
+def fail_after_frame_69(frame_number, frame, device='cpu'):
+    if frame_number >= 70:
+        raise ValueError('the model failed')
+    return fake_landmarks(frame_number, frame, device)
+
+
+def never_before_frame_70(frame_number, frame, device='cpu'):
+    # the first 70 frames were processed by the previous run
+    assert frame_number >= 70
+    return fake_landmarks(frame_number, frame, device)
+
+
+@pytest.fixture
+def video(cfr_video, tmp_path):
+    # copy of the video in a folder of its own, the results are stored next to it
+    filename = str(tmp_path / 'video.mp4')
+    shutil.copy(cfr_video[0], filename)
+    return filename
+
+
+def check_landmarks(landmark_filename, frame_count):
+    store = LandmarkStore.load_csv(landmark_filename, frame_count)
+    assert list(store.frame_numbers()) == [n for n in range(frame_count) if n % 10 != 0]
+    for frame_number in store.frame_numbers():
+        assert np.all(store.get(frame_number) == frame_number)
+        assert list(store.boundingbox(frame_number)) == [frame_number + i for i in range(4)]
+
+
+def test_process_video(video, monkeypatch):
+    monkeypatch.setattr(batch_process, 'process_frame', fake_landmarks)
+    landmark_filename = batch_process.process_video(video, n_workers=2)
+    assert landmark_filename == os.path.splitext(video)[0] + '.csv'
+    check_landmarks(landmark_filename, 150)
+    # the log of the processed frames is removed at the end
+    assert not os.path.exists(sidecar_filename(video, LandmarkJob.sidecar_ending))
+
+
+def test_process_video_through_the_frame_cache(video, tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_process, 'process_frame', fake_landmarks)
+    cache_dir = tmp_path / 'cache'
+    check_landmarks(batch_process.process_video(video, n_workers=2, frame_cache_dir=str(cache_dir)), 150)
+    assert sorted(os.path.splitext(name)[1] for name in os.listdir(cache_dir)) == ['.frames', '.valid']
+
+
+def test_interrupted_video_continues_from_the_log(video, monkeypatch):
+    monkeypatch.setattr(batch_process, 'process_frame', fail_after_frame_69)
+    with pytest.raises(RuntimeError):
+        batch_process.process_video(video, n_workers=1)
+    assert not os.path.exists(os.path.splitext(video)[0] + '.csv')
+
+    monkeypatch.setattr(batch_process, 'process_frame', never_before_frame_70)
+    landmark_filename = batch_process.process_video(video, n_workers=2)
+    check_landmarks(landmark_filename, 150)
+
+
+def test_log_of_a_different_video_is_not_used(video, monkeypatch):
+    # a log left by a previous version of the video
+    writer = LandmarkWriter(sidecar_filename(video, LandmarkJob.sidecar_ending), np.array([1, 2]))
+    writer.append(5, [0, 0, 1, 1], np.zeros((68, 2)))
+    writer.close()
+    monkeypatch.setattr(batch_process, 'process_frame', fake_landmarks)
+    check_landmarks(batch_process.process_video(video, n_workers=1), 150)
+
+
+def test_processing_again_removes_the_corrections(video, monkeypatch):
+    landmark_filename = os.path.splitext(video)[0] + '.csv'
+    with open(correction_log_filename(landmark_filename), 'wb') as f:
+        f.write(b'corrections of the previous landmarks')
+    monkeypatch.setattr(batch_process, 'process_frame', fake_landmarks)
+    batch_process.process_video(video, n_workers=1)
+    assert not os.path.exists(correction_log_filename(landmark_filename))
+
+
+def test_main(video, tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_process, 'process_frame', fake_landmarks)
+    assert batch_process.main([str(tmp_path), '--workers', '1']) == 0
+    check_landmarks(os.path.splitext(video)[0] + '.csv', 150)
+    # videos with a landmark file are skipped
+    monkeypatch.setattr(batch_process, 'process_frame', fail_after_frame_69)
+    assert batch_process.main([str(tmp_path), '--workers', '1']) == 0
+    # a video that fails does not stop the others, the exit code tells it
+    assert batch_process.main([str(tmp_path), '--workers', '1', '--overwrite']) == 1
+    assert batch_process.main([str(tmp_path / 'missing.mp4')]) == 1
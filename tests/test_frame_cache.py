@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import pickle
+import numpy as np
+import pytest
+
+from frame_cache import FrameCache, MemmapFrameCache, fitting_scale
+from video_reader import FrameReader
+
+
+def frame(value, size=10):
+    return np.full((size, size, 3), value, dtype=np.uint8)
+
+
+def test_least_recently_used_frames_are_removed():
+    cache = FrameCache(max_bytes=3 * frame(0).nbytes)
+    for frame_number in range(3):
+        cache.put(frame_number, frame(frame_number))
+    # frame 0 is used again, frame 1 is now the oldest one
+    assert cache.get(0)[0, 0, 0] == 0
+    cache.put(3, frame(3))
+    assert 1 not in cache
+    assert [n in cache for n in (0, 2, 3)] == [True, True, True]
+    assert cache.current_bytes == 3 * frame(0).nbytes
+
+
+def test_replacing_a_frame_keeps_the_size():
+    cache = FrameCache(max_bytes=10 * frame(0).nbytes)
+    cache.put(5, frame(1))
+    cache.put(5, frame(2))
+    assert len(cache) == 1
+    assert cache.current_bytes == frame(0).nbytes
+    assert cache.get(5)[0, 0, 0] == 2
+
+
+def test_frames_larger_than_the_cache_are_not_stored():
+    cache = FrameCache(max_bytes=frame(0).nbytes - 1)
+    cache.put(0, frame(0))
+    assert len(cache) == 0
+
+
+def test_frames_are_shared_and_read_only():
+    cache = FrameCache()
+    original = frame(7)
+    cache.put(0, original)
+    cached = cache.get(0)
+    assert np.shares_memory(cached, original)
+    # the caller can still use its array, whoever reads the cache cannot change it
+    assert original.flags.writeable
+    with pytest.raises(ValueError):
+        cached[0, 0, 0] = 1
+
+
+def test_hits_and_misses():
+    cache = FrameCache()
+    cache.put(0, frame(0))
+    cache.get(0)
+    cache.get(1)
+    cache.get(0)
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert cache.hit_rate() == pytest.approx(2 / 3)
+    # touch() changes the order without counting a hit
+    assert cache.touch(0)
+    assert not cache.touch(1)
+    assert cache.hits == 2
+    cache.reset_counters()
+    assert cache.stats()['hit_rate'] == 0.0
+
+
+def test_fitting_scale():
+    assert fitting_scale(100, (240, 320), 100 * 240 * 320 * 3) == 1.0
+    scale = fitting_scale(100, (240, 320), 100 * 240 * 320 * 3 // 4)
+    assert 0 < scale < 1
+    assert 100 * round(240 * scale) * round(320 * scale) * 3 <= 100 * 240 * 320 * 3 // 4
+    assert fitting_scale(100, (240, 320), 10) == 0
+
+
+def test_memmap_cache_keeps_frames_between_passes(cfr_video, tmp_path):
+    filename, frames = cfr_video
+    shape = frames[0].shape
+    cache = MemmapFrameCache(filename, len(frames), shape, str(tmp_path), scale=1.0)
+    reader = FrameReader(filename)
+    selected = [5, 6, 40, 41]
+    for frame_number, frame in cache.read_frames(reader, selected):
+        assert np.array_equal(frame, frames[frame_number])
+        assert not frame.flags.writeable
+    reader.release()
+    cache.flush()
+
+    # the next pass opens the same files and does not decode the frames again
+    cache = MemmapFrameCache(filename, len(frames), shape, str(tmp_path), scale=1.0)
+    assert [n in cache for n in (5, 6, 7, 40, 41)] == [True, True, False, True, True]
+    assert np.array_equal(cache.get(40), frames[40])
+    assert cache.get(7) is None
+    # a cache sent to another process opens the files again
+    copy = pickle.loads(pickle.dumps(cache))
+    assert np.array_equal(copy.get(41), frames[41])
+
+
+def test_downscaled_memmap_cache(cfr_video, tmp_path):
+    filename, frames = cfr_video
+    height, width = frames[0].shape[:2]
+    cache = MemmapFrameCache(filename, len(frames), frames[0].shape, str(tmp_path),
+                             max_bytes=len(frames) * height * width * 3 // 4)
+    assert cache.scale < 1
+    cache.put(3, frames[3])
+    assert cache.get(3).shape == (cache.frame_size[1], cache.frame_size[0], 3)
+    # positions in the cached frames are converted back to video pixels
+    assert np.allclose(cache.video_coordinates([10, 20]), np.array([10, 20]) / cache.scale)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from conftest import frame_number_of
+from frame_plan import FramePlan, parse_frame_list, SEQUENTIAL, GRAB_SKIP, KEYFRAME_SEEK
+from video_index import KeyframeIndex
+from video_reader import FrameReader
+
+
+def strategies(plan):
+    return [(interval.first, interval.last, interval.strategy) for interval in plan.intervals]
+
+
+def test_parse_frame_list():
+    assert parse_frame_list('1,5, 20,') == [1, 5, 20]
+    assert parse_frame_list('') == []
+
+
+def test_compile_without_index():
+    plan = FramePlan([5, 3, 4, 5, 10, 100, 101, 102])
+    assert plan.frame_numbers == [3, 4, 5, 10, 100, 101, 102]
+    # the decoder starts at frame 0, the first frames are grabbed on the way
+    assert strategies(plan) == [(3, 10, GRAB_SKIP), (100, 102, KEYFRAME_SEEK)]
+    assert plan.seeks() == 1
+    # 11 frames to reach frame 10, then a seek (16 frames) and 3 frames
+    assert plan.decoded_frames() == 11 + 16 + 3
+
+
+def test_compile_with_index():
+    index = KeyframeIndex([0, 50, 100], 150)
+    plan = FramePlan(list(range(0, 10)) + [60, 62] + [140], index)
+    assert strategies(plan) == [(0, 9, SEQUENTIAL), (60, 62, KEYFRAME_SEEK), (140, 140, KEYFRAME_SEEK)]
+    assert plan.intervals[1].entry == 50
+    assert plan.intervals[2].entry == 100
+    assert plan.decoded_frames() == 10 + (62 - 50 + 1 + 16) + (140 - 100 + 1 + 16)
+    assert plan.estimated_time(0.01) == pytest.approx(plan.decoded_frames() * 0.01)
+    assert plan.summary() == '13 frames selected, %d frames decoded, 2 seeks' % plan.decoded_frames()
+
+
+def test_from_selection():
+    plan = FramePlan.from_selection(100, first_frame=True, frame_list=[5, 500, 50], ranges=[(10, 20, 60), (-3, 10, 25)])
+    assert plan.frame_numbers == [0, 5, 7, 10, 17, 30, 50]
+    assert len(FramePlan.from_selection(40, all_frames=True, frame_list=[5])) == 40
+    assert len(FramePlan.from_selection(40)) == 0
+    assert FramePlan.from_selection(40).intervals == []
+
+
+@pytest.mark.parametrize('use_index', [False, True])
+def test_read_follows_the_plan(cfr_video, use_index):
+    filename, frames = cfr_video
+    index = KeyframeIndex.load_or_build(filename) if use_index else None
+    selected = [2, 3, 4, 30, 31, 75, 120, 121, 149, 30]
+    plan = FramePlan(selected, index)
+    reader = FrameReader(filename, index)
+    result = [(frame_number, frame_number_of(frame)) for frame_number, frame in plan.read(reader)]
+    assert result == [(n, n) for n in sorted(set(selected))]
+    reader.release()
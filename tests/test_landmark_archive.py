@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pytest
+
+from landmark_archive import LandmarkArchive, write_archive, archive_scale, main, ARCHIVE_ENDING, MAX_SCALE
+from landmark_store import LandmarkStore
+
+
+def moving_face(frame_count, frame_numbers, seed=0, whole_pixels=True):
+    # landmarks that move a little between frames, like a real face
+    rng = np.random.default_rng(seed)
+    base = rng.uniform(100, 400, size=(68, 2))
+    steps = rng.normal(0, 2, size=(len(frame_numbers), 1, 2))
+    shapes = base + np.cumsum(steps, axis=0)
+    boxes = np.column_stack((shapes[:, :, 0].min(axis=1), shapes[:, :, 1].min(axis=1),
+                             shapes[:, :, 0].max(axis=1), shapes[:, :, 1].max(axis=1)))
+    if whole_pixels:
+        shapes, boxes = np.round(shapes), np.round(boxes)
+    store = LandmarkStore(frame_count, np.float64)
+    store.add(frame_numbers, boxes, shapes)
+    return store
+
+
+def test_whole_pixels_are_archived_exactly(tmp_path):
+    frame_numbers = [n for n in range(200) if n % 7 != 3]
+    store = moving_face(200, frame_numbers)
+    filename = str(tmp_path / ('video' + ARCHIVE_ENDING))
+    write_archive(store, filename, chunk_frames=30)
+    archive = LandmarkArchive(filename)
+    assert archive.frame_count == 200 and archive.scale == 1
+    read_frames, boxes, shapes = archive.read()
+    assert list(read_frames) == frame_numbers
+    assert np.array_equal(shapes, store.shapes[frame_numbers])
+    assert np.array_equal(boxes, store.boxes[frame_numbers])
+    assert archive.get(3) is None
+    assert np.array_equal(archive.get(4), store.shapes[4])
+    archive.close()
+
+
+def test_fractions_of_a_pixel(tmp_path):
+    frame_numbers = list(range(0, 100))
+    store = moving_face(100, frame_numbers, whole_pixels=False)
+    filename = str(tmp_path / ('video' + ARCHIVE_ENDING))
+    write_archive(store, filename)
+    archive = LandmarkArchive(filename)
+    assert archive.scale == MAX_SCALE
+    _, boxes, shapes = archive.read()
+    assert np.abs(shapes - store.shapes).max() <= 0.5 / MAX_SCALE
+    assert np.abs(boxes - store.boxes).max() <= 0.5 / MAX_SCALE
+    archive.close()
+
+
+def test_large_jumps_between_frames(tmp_path):
+    # differences larger than int16 wrap around and are still decoded exactly
+    store = LandmarkStore(4, np.float64)
+    store.add([0, 1, 2, 3], [[0, 0, 1, 1], [-32000, -32000, 32000, 32000]] * 2,
+              [np.full((68, 2), -32000), np.full((68, 2), 32000)] * 2)
+    filename = str(tmp_path / ('video' + ARCHIVE_ENDING))
+    write_archive(store, filename)
+    archive = LandmarkArchive(filename)
+    _, boxes, shapes = archive.read()
+    assert np.array_equal(shapes, store.shapes)
+    assert np.array_equal(boxes, store.boxes)
+    archive.close()
+    with pytest.raises(ValueError):
+        archive_scale(np.array([40000.0]))
+
+
+def test_read_a_range(tmp_path):
+    store = moving_face(300, list(range(300)))
+    filename = str(tmp_path / ('video' + ARCHIVE_ENDING))
+    write_archive(store, filename, chunk_frames=30)
+    archive = LandmarkArchive(filename)
+    frame_numbers, boxes, shapes = archive.read(95, 130)
+    assert list(frame_numbers) == list(range(95, 131))
+    assert np.array_equal(shapes, store.shapes[95:131])
+    # frames outside the video are ignored
+    assert list(archive.read(290, 400)[0]) == list(range(290, 300))
+    assert len(archive.read(500, 600)[0]) == 0
+    store_again = archive.to_store()
+    assert np.array_equal(store_again.shapes, store.shapes)
+    archive.close()
+
+
+def test_truncated_archive(tmp_path):
+    filename = str(tmp_path / ('video' + ARCHIVE_ENDING))
+    write_archive(moving_face(100, list(range(100))), filename)
+    with open(filename, 'r+b') as f:
+        f.truncate(os.path.getsize(filename) - 4)
+    with pytest.raises(ValueError):
+        LandmarkArchive(filename)
+
+
+def test_archive_and_extract(tmp_path):
+    frame_numbers = [0, 1, 2, 50]
+    store = moving_face(51, frame_numbers)
+    csv_filename = str(tmp_path / 'video.csv')
+    archive_filename = str(tmp_path / ('video' + ARCHIVE_ENDING))
+    extracted_filename = str(tmp_path / 'extracted.csv')
+    store.save(csv_filename)
+    assert main(['archive', csv_filename, archive_filename]) == 0
+    assert main(['extract', archive_filename, extracted_filename]) == 0
+    extracted = LandmarkStore.load(extracted_filename)
+    assert list(extracted.frame_numbers()) == frame_numbers
+    assert np.array_equal(extracted.shapes[frame_numbers], store.shapes[frame_numbers])
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pytest
+
+from landmark_store import (LandmarkStore, SparseLandmarkStore, LandmarkWriter, LandmarkLoader, BINARY_ENDING,
+                            SPARSE_ENDING, LOG_HEADER, LOG_RECORD, convert, find_landmark_file, read_landmark_log,
+                            store_from_log, LandmarkCorrections, correction_log_filename, read_correction_log,
+                            landmark_signature)
+
+
+def random_landmarks(frame_numbers, seed=0):
+    # bounding boxes and landmarks (whole pixels, like the .csv files) of some frames
+    rng = np.random.default_rng(seed)
+    boxes = rng.integers(0, 500, size=(len(frame_numbers), 4)).astype(np.float64)
+    shapes = rng.integers(0, 1000, size=(len(frame_numbers), 68, 2)).astype(np.float64)
+    return boxes, shapes
+
+
+def assert_same_landmarks(store, frame_numbers, boxes, shapes):
+    assert list(store.frame_numbers()) == list(frame_numbers)
+    for frame_number, box, shape in zip(frame_numbers, boxes, shapes):
+        assert np.array_equal(store.get(frame_number), shape)
+        assert np.array_equal(store.boundingbox(frame_number), box)
+
+
+def test_dense_store():
+    store = LandmarkStore(10)
+    assert len(store) == 0
+    assert store.get(3) is None
+    store.set(3, [1, 2, 3, 4], np.full((68, 2), 2.6), confidence=0.5)
+    assert 3 in store and 4 not in store and 20 not in store
+    # landmarks are whole pixels unless the store uses floats
+    assert np.all(store.get(3) == 3)
+    assert store.confidence[3] == 0.5
+    store.add([7, 12], [[0, 0, 1, 1], [0, 0, 2, 2]], np.zeros((2, 68, 2)))
+    assert list(store.frame_numbers()) == [3, 7]
+    assert store.next_processed(3) == 7
+    assert store.next_processed(7) is None
+    assert store.previous_processed(7) == 3
+    assert store.previous_processed(3) is None
+    larger = store.resized(20)
+    assert larger.frame_count == 20 and list(larger.frame_numbers()) == [3, 7]
+
+
+def test_csv_round_trip(tmp_path):
+    frame_numbers = [0, 1, 5, 99]
+    boxes, shapes = random_landmarks(frame_numbers)
+    filename = str(tmp_path / 'video.csv')
+    LandmarkStore.from_arrays(frame_numbers, boxes, shapes).save(filename)
+    store = LandmarkStore.load(filename)
+    assert store.frame_count == 100
+    assert_same_landmarks(store, frame_numbers, boxes, shapes)
+    # room for the frames of the video after the last frame with landmarks
+    assert LandmarkStore.load(filename, frame_count=150).frame_count == 150
+
+
+def test_not_a_landmark_file(tmp_path):
+    filename = tmp_path / 'video.csv'
+    filename.write_text('a,b\n1,2\n')
+    with pytest.raises(ValueError):
+        LandmarkStore.load(str(filename))
+
+
+@pytest.mark.parametrize('shape_dtype', ['i2', 'f4'])
+def test_binary_round_trip(tmp_path, shape_dtype):
+    frame_numbers = [2, 3, 50, 77]
+    boxes, shapes = random_landmarks(frame_numbers)
+    if shape_dtype == 'f4':
+        shapes = shapes + 0.25
+    original = LandmarkStore(80, np.float64)
+    original.add(frame_numbers, boxes, shapes)
+    original.confidence[3] = 0.75
+    filename = str(tmp_path / ('video' + BINARY_ENDING))
+    original.save(filename, shape_dtype)
+
+    store = LandmarkStore.load(filename)
+    assert store.frame_count == 80
+    assert isinstance(store.shapes, np.memmap)
+    assert_same_landmarks(store, frame_numbers, boxes, shapes)
+    assert store.confidence[3] == 0.75 and np.isnan(store.confidence[2])
+    # the store can stop using the file, nothing changes for whoever has it
+    store.release()
+    assert not isinstance(store.shapes, np.memmap)
+    assert_same_landmarks(store, frame_numbers, boxes, shapes)
+    assert_same_landmarks(LandmarkStore.load(filename, mapped=False), frame_numbers, boxes, shapes)
+
+
+def test_changes_to_a_mapped_store_stay_in_memory(tmp_path):
+    filename = str(tmp_path / ('video' + BINARY_ENDING))
+    LandmarkStore.from_arrays([1], [[0, 0, 1, 1]], np.ones((1, 68, 2))).save(filename)
+    store = LandmarkStore.load(filename)
+    store.set(1, [0, 0, 1, 1], np.full((68, 2), 5))
+    assert np.all(store.get(1) == 5)
+    assert np.all(LandmarkStore.load(filename).get(1) == 1)
+
+
+def test_truncated_binary_file(tmp_path):
+    filename = str(tmp_path / ('video' + BINARY_ENDING))
+    LandmarkStore.from_arrays([1, 2], np.zeros((2, 4)), np.ones((2, 68, 2))).save(filename)
+    with open(filename, 'r+b') as f:
+        f.truncate(200)
+    with pytest.raises(ValueError):
+        LandmarkStore.load(filename)
+
+
+def test_convert(tmp_path):
+    frame_numbers = [0, 4, 9]
+    boxes, shapes = random_landmarks(frame_numbers)
+    csv_filename = str(tmp_path / 'video.csv')
+    binary_filename = str(tmp_path / ('video' + BINARY_ENDING))
+    LandmarkStore.from_arrays(frame_numbers, boxes, shapes).save(csv_filename)
+    convert(csv_filename, binary_filename)
+    assert_same_landmarks(LandmarkStore.load(binary_filename), frame_numbers, boxes, shapes)
+    # the most recent landmark file of the video is used
+    assert find_landmark_file(str(tmp_path / 'video.mp4')) == binary_filename
+
+
+def write_log(filename, frame_numbers, signature=(1, 2)):
+    writer = LandmarkWriter(filename, np.array(signature))
+    for frame_number in frame_numbers:
+        if frame_number % 10 == 0:
+            writer.append(frame_number)
+        else:
+            writer.append(frame_number, [frame_number] * 4, np.full((68, 2), frame_number), confidence=0.5)
+    writer.close()
+
+
+def test_landmark_log(tmp_path):
+    filename = str(tmp_path / 'video_landmark_job.log')
+    write_log(filename, [9, 10, 11, 9])
+    records = read_landmark_log(filename)
+    assert list(records['frame_number']) == [9, 10, 11, 9]
+    store = store_from_log(records, frame_count=20)
+    # frames without face are not in the store
+    assert list(store.frame_numbers()) == [9, 11]
+    assert np.all(store.get(11) == 11)
+    assert store.confidence[11] == 0.5
+    # a log of a different version of the video has nothing for this one
+    assert len(read_landmark_log(filename, signature=np.array([1, 3]))) == 0
+
+
+def test_writer_recovers_after_a_truncated_record(tmp_path):
+    filename = str(tmp_path / 'video_landmark_job.log')
+    write_log(filename, range(5))
+    # the process died while writing the last record
+    size = os.path.getsize(filename)
+    with open(filename, 'r+b') as f:
+        f.truncate(size - 10)
+    assert list(read_landmark_log(filename)['frame_number']) == [0, 1, 2, 3]
+
+    writer = LandmarkWriter(filename, np.array([1, 2]))
+    assert writer.done() == {0, 1, 2, 3}
+    writer.append(4, [4] * 4, np.full((68, 2), 4))
+    writer.close()
+    assert list(read_landmark_log(filename)['frame_number']) == [0, 1, 2, 3, 4]
+    assert os.path.getsize(filename) == size
+
+
+def test_corrupted_record_stops_the_log(tmp_path):
+    filename = str(tmp_path / 'video_landmark_job.log')
+    write_log(filename, range(5))
+    # a damaged record, the records after it are not reliable either
+    offset = LOG_HEADER.itemsize + 2 * LOG_RECORD.itemsize + 20
+    with open(filename, 'r+b') as f:
+        f.seek(offset)
+        f.write(b'\xff' * 8)
+    assert list(read_landmark_log(filename)['frame_number']) == [0, 1]
+
+
+def test_writer_starts_again_for_a_different_video(tmp_path):
+    filename = str(tmp_path / 'video_landmark_job.log')
+    write_log(filename, range(5))
+    writer = LandmarkWriter(filename, np.array([1, 3]))
+    assert writer.done() == set()
+    writer.close()
+    assert len(read_landmark_log(filename)) == 0
+
+
+def test_loader_reads_the_csv_file_in_chunks(tmp_path):
+    frame_numbers = list(range(0, 300, 2))
+    boxes, shapes = random_landmarks(frame_numbers)
+    filename = str(tmp_path / 'video.csv')
+    LandmarkStore.from_arrays(frame_numbers, boxes, shapes).save(filename)
+    chunks = []
+    finished = []
+    loader = LandmarkLoader(filename, 300, chunk_rows=50, first_chunk_rows=10,
+                            chunk_callback=lambda first, last: chunks.append((first, last)),
+                            finished_callback=finished.append)
+    assert not loader.loaded
+    loader.start()
+    loader.Thread.join(30)
+    assert finished == [loader] and loader.loaded and loader.error is None
+    assert chunks[:2] == [(0, 18), (20, 118)]
+    assert chunks[-1][1] == 298
+    assert_same_landmarks(loader.store, frame_numbers, boxes, shapes)
+
+
+def test_loader_of_a_binary_file_is_ready_at_once(tmp_path):
+    filename = str(tmp_path / ('video' + BINARY_ENDING))
+    LandmarkStore.from_arrays([4], [[0, 0, 1, 1]], np.ones((1, 68, 2))).save(filename)
+    loader = LandmarkLoader(filename, 10)
+    assert loader.loaded
+    assert 4 in loader.store
+
+
+def test_loader_of_a_damaged_file(tmp_path):
+    filename = tmp_path / 'video.csv'
+    filename.write_text('a,b\n1,2\n')
+    loader = LandmarkLoader(str(filename), 10).start()
+    loader.Thread.join(30)
+    assert not loader.loaded
+    assert isinstance(loader.error, ValueError)
+
+
+def test_sparse_rank_and_select():
+    rng = np.random.default_rng(1)
+    frame_numbers = np.sort(rng.choice(5000, size=700, replace=False))
+    boxes, shapes = random_landmarks(frame_numbers)
+    store = SparseLandmarkStore.from_arrays(frame_numbers, boxes, shapes, frame_count=5000)
+    assert len(store) == 700
+    assert np.array_equal(store.frame_numbers(), frame_numbers)
+    for frame_number in list(frame_numbers[::7]) + [0, 511, 512, 513, 4999]:
+        assert store.rank(frame_number) == np.count_nonzero(frame_numbers < frame_number)
+    for index in list(range(0, 700, 11)) + [699]:
+        assert store.select(index) == frame_numbers[index]
+    with pytest.raises(IndexError):
+        store.select(700)
+    assert_same_landmarks(store, frame_numbers, boxes, shapes)
+    assert store.next_processed(int(frame_numbers[10])) == frame_numbers[11]
+    assert store.previous_processed(int(frame_numbers[10])) == frame_numbers[9]
+    assert store.next_processed(4999) is None
+
+
+def test_sparse_round_trip(tmp_path):
+    frame_numbers = [3, 700, 701, 2000]
+    boxes, shapes = random_landmarks(frame_numbers)
+    filename = str(tmp_path / ('video' + SPARSE_ENDING))
+    LandmarkStore.from_arrays(frame_numbers, boxes, shapes, frame_count=3000).save(filename)
+    assert_same_landmarks(SparseLandmarkStore.load(filename), frame_numbers, boxes, shapes)
+    store = LandmarkStore.load(filename)
+    assert store.frame_count == 3000
+    assert_same_landmarks(store, frame_numbers, boxes, shapes)
+
+
+def test_later_runs_replace_earlier_ones(tmp_path):
+    filename = str(tmp_path / ('video' + SPARSE_ENDING))
+    SparseLandmarkStore.from_arrays([1, 2, 3], np.zeros((3, 4)), np.ones((3, 68, 2))).append_run(filename)
+    # frame 2 processed again, frame 3 processed again without face
+    SparseLandmarkStore.from_arrays([2, 9], np.zeros((2, 4)), np.full((2, 68, 2), 5),
+                                    cleared_frames=[3]).append_run(filename)
+    assert len(SparseLandmarkStore.read_runs(filename)) == 2
+    store = SparseLandmarkStore.load(filename)
+    assert list(store.frame_numbers()) == [1, 2, 9]
+    assert np.all(store.get(1) == 1) and np.all(store.get(2) == 5)
+
+    size = os.path.getsize(filename)
+    SparseLandmarkStore.compact(filename)
+    assert len(SparseLandmarkStore.read_runs(filename)) == 1
+    assert os.path.getsize(filename) < size
+    assert list(SparseLandmarkStore.load(filename).frame_numbers()) == [1, 2, 9]
+
+
+def test_incomplete_run_is_ignored(tmp_path):
+    filename = str(tmp_path / ('video' + SPARSE_ENDING))
+    SparseLandmarkStore.from_arrays([1], np.zeros((1, 4)), np.ones((1, 68, 2))).append_run(filename)
+    size = os.path.getsize(filename)
+    SparseLandmarkStore.from_arrays([1, 5], np.zeros((2, 4)), np.full((2, 68, 2), 5)).append_run(filename)
+    # the program stopped while the second run was written
+    with open(filename, 'r+b') as f:
+        f.truncate(size + 100)
+    store = SparseLandmarkStore.load(filename)
+    assert list(store.frame_numbers()) == [1]
+    assert np.all(store.get(1) == 1)
+
+
+def landmark_file(tmp_path, ending='.csv'):
+    filename = str(tmp_path / ('video' + ending))
+    LandmarkStore.from_arrays([1, 2, 3], np.zeros((3, 4)), np.ones((3, 68, 2)), frame_count=10).save(filename)
+    return filename
+
+
+@pytest.mark.parametrize('ending', ['.csv', BINARY_ENDING, SPARSE_ENDING])
+def test_corrections_are_kept_in_the_log(tmp_path, ending):
+    filename = landmark_file(tmp_path, ending)
+    store = LandmarkStore.load(filename)
+    corrections = LandmarkCorrections(store, filename)
+    corrections.correct(2, 30, 7.0, 8.0)
+    corrections.correct(2, 31, 9.0, 10.0)
+    shape = corrections.get(2)
+    assert list(shape[30]) == [7, 8] and list(shape[31]) == [9, 10] and list(shape[29]) == [1, 1]
+    # the landmarks underneath and the landmark file do not change
+    assert np.all(store.get(2) == 1)
+    assert np.all(LandmarkStore.load(filename).get(2) == 1)
+    corrections.close()
+
+    # the corrections are there the next time the file is opened
+    corrections = LandmarkCorrections(LandmarkStore.load(filename), filename)
+    assert list(corrections.get(2)[30]) == [7, 8]
+    assert np.all(corrections.get(1) == 1)
+    corrections.close()
+
+
+@pytest.mark.parametrize('ending', ['.csv', BINARY_ENDING, SPARSE_ENDING])
+def test_corrections_are_copied_into_the_landmark_file(tmp_path, ending):
+    filename = landmark_file(tmp_path, ending)
+    corrections = LandmarkCorrections(LandmarkStore.load(filename), filename, compact_records=3)
+    for landmark in range(4):
+        corrections.correct(3, landmark, 20.0 + landmark, 30.0)
+    corrections.close()
+    assert corrections.error is None
+    # the log is empty and the landmark file has the corrections
+    assert not os.path.exists(correction_log_filename(filename))
+    shape = LandmarkStore.load(filename).get(3)
+    assert [list(shape[landmark]) for landmark in range(5)] == [[20, 30], [21, 30], [22, 30], [23, 30], [1, 1]]
+    assert np.all(LandmarkStore.load(filename).get(2) == 1)
+
+
+def test_corrections_of_a_replaced_landmark_file_are_ignored(tmp_path):
+    filename = landmark_file(tmp_path)
+    corrections = LandmarkCorrections(LandmarkStore.load(filename), filename)
+    corrections.correct(1, 0, 50.0, 50.0)
+    corrections.close()
+    # the video was processed again by something that does not know about the log
+    LandmarkStore.from_arrays([1], np.zeros((1, 4)), np.full((1, 68, 2), 2), frame_count=10).save(filename)
+    corrections = LandmarkCorrections(LandmarkStore.load(filename), filename)
+    assert list(corrections.get(1)[0]) == [2, 2]
+    # new corrections start a new log for the new file
+    corrections.correct(1, 1, 60.0, 60.0)
+    corrections.close()
+    assert len(read_correction_log(correction_log_filename(filename), landmark_signature(filename))) == 1
+
+
+def test_incomplete_correction_is_dropped(tmp_path):
+    filename = landmark_file(tmp_path)
+    corrections = LandmarkCorrections(LandmarkStore.load(filename), filename)
+    corrections.correct(1, 0, 50.0, 50.0)
+    corrections.correct(1, 1, 51.0, 51.0)
+    corrections.close()
+    log_filename = correction_log_filename(filename)
+    with open(log_filename, 'r+b') as f:
+        f.truncate(os.path.getsize(log_filename) - 3)
+    corrections = LandmarkCorrections(LandmarkStore.load(filename), filename)
+    assert list(corrections.get(1)[0]) == [50, 50] and list(corrections.get(1)[1]) == [1, 1]
+    corrections.correct(1, 2, 52.0, 52.0)
+    corrections.close()
+    assert list(read_correction_log(log_filename)['landmark']) == [0, 2]
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import numpy as np
+import pytest
+
+from conftest import frame_number_of
+from frame_plan import FramePlan
+from landmark_store import LandmarkStore, SparseLandmarkStore, LandmarkCorrections, SPARSE_ENDING
+from processing_job import LandmarkJob
+from video_index import KeyframeIndex
+
+
+class FakeModel:
+    """
+    Stands for the models: no face every 10 frames, otherwise landmarks made
+    from the number shown by the frame. Remembers the frames it processed.
+    """
+
+    def __init__(self, value=0):
+        self.value = value
+        self.processed = []
+
+    def __call__(self, frame_number, frame):
+        shown = frame_number_of(frame)
+        assert shown == frame_number
+        self.processed.append(frame_number)
+        if shown % 10 == 0:
+            return None
+        return np.array([shown, shown, shown + 10, shown + 10], dtype=np.float64), np.full((68, 2), shown + self.value)
+
+
+@pytest.fixture
+def video(cfr_video, tmp_path):
+    filename = str(tmp_path / 'video.mp4')
+    shutil.copy(cfr_video[0], filename)
+    return filename
+
+
+def run_job(video, frame_numbers, model, **options):
+    job = LandmarkJob(video, FramePlan(frame_numbers, KeyframeIndex.load_or_build(video)), process_function=model,
+                      **options)
+    job.start()
+    job.wait(30)
+    assert job.error is None
+    return job
+
+
+def test_results_are_saved(video):
+    model = FakeModel()
+    progress = []
+    finished = []
+    job = run_job(video, range(0, 150, 5), model, progress_callback=lambda done, total, eta: progress.append(done),
+                  finished_callback=finished.append)
+    assert job.finished and finished == [job]
+    assert model.processed == list(range(0, 150, 5))
+    assert progress == list(range(1, 31))
+    store = LandmarkStore.load_csv(os.path.splitext(video)[0] + '.csv')
+    assert list(store.frame_numbers()) == [n for n in range(0, 150, 5) if n % 10 != 0]
+    assert np.all(store.get(45) == 45)
+    # the log is only needed while the job runs
+    assert not os.path.exists(job.log_filename)
+
+
+def test_pause_and_resume(video):
+    model = FakeModel()
+    job = LandmarkJob(video, FramePlan(range(20)), process_function=model)
+    job.pause()
+    job.start()
+    time.sleep(0.3)
+    assert job.paused
+    assert model.processed == []
+    job.resume()
+    job.wait(30)
+    assert not job.paused
+    assert job.finished
+    assert model.processed == list(range(20))
+
+
+def test_cancelled_job_continues_from_the_log(video):
+    model = FakeModel()
+
+    def cancel_after_frame_40(done, total, eta):
+        if done == 41:
+            job.cancel()
+
+    job = LandmarkJob(video, FramePlan(range(100)), process_function=model, progress_callback=cancel_after_frame_40,
+                      sync_frames=1)
+    job.start()
+    job.wait(30)
+    assert not job.finished
+    assert model.processed == list(range(41))
+    assert not os.path.exists(os.path.splitext(video)[0] + '.csv')
+
+    # the frames in the log are not processed again
+    model = FakeModel()
+    job = run_job(video, range(100), model)
+    assert job.finished
+    assert model.processed == list(range(41, 100))
+    store = LandmarkStore.load_csv(os.path.splitext(video)[0] + '.csv')
+    assert list(store.frame_numbers()) == [n for n in range(100) if n % 10 != 0]
+
+
+def test_results_replace_the_processed_frames(video):
+    run_job(video, range(0, 50), FakeModel())
+    # frames 20-29 processed again by a different model, frame 20 has no face
+    run_job(video, range(20, 30), FakeModel(value=1000))
+    store = LandmarkStore.load_csv(os.path.splitext(video)[0] + '.csv')
+    assert list(store.frame_numbers()) == [n for n in range(50) if n % 10 != 0]
+    assert np.all(store.get(19) == 19)
+    assert np.all(store.get(25) == 1025)
+
+
+def test_sparse_results(video):
+    run_job(video, [1, 2, 3], FakeModel(), sparse=True)
+    run_job(video, [3, 60, 61], FakeModel(value=1000))
+    landmark_filename = os.path.splitext(video)[0] + SPARSE_ENDING
+    # the second job uses the file of the first one, every job is a new run
+    assert len(SparseLandmarkStore.read_runs(landmark_filename)) == 2
+    store = SparseLandmarkStore.load(landmark_filename)
+    assert list(store.frame_numbers()) == [1, 2, 3, 61]
+    assert np.all(store.get(2) == 2)
+    assert np.all(store.get(3) == 1003)
+
+
+def test_errors_stop_the_job(video):
+    def failing_model(frame_number, frame):
+        raise ValueError('no model')
+
+    finished = []
+    job = LandmarkJob(video, FramePlan(range(10)), process_function=failing_model, finished_callback=finished.append)
+    job.start()
+    job.wait(30)
+    assert isinstance(job.error, ValueError)
+    assert not job.finished and finished == [job]
+
+
+def test_corrections_of_processed_frames_are_discarded(video):
+    run_job(video, range(0, 30), FakeModel())
+    landmark_filename = os.path.splitext(video)[0] + '.csv'
+    corrections = LandmarkCorrections(LandmarkStore.load(landmark_filename), landmark_filename)
+    corrections.correct(5, 0, 500.0, 500.0)
+    corrections.correct(25, 0, 600.0, 600.0)
+
+    # the job replaces the landmark file while the corrections are in use
+    run_job(video, range(20, 30), FakeModel(value=1000), before_save=corrections.release)
+    assert list(corrections.get(5)[0]) == [500, 500]
+    corrections.close()
+
+    corrections = LandmarkCorrections(LandmarkStore.load(landmark_filename), landmark_filename)
+    assert list(corrections.get(5)[0]) == [500, 500]
+    # frame 25 was processed again, its correction was made on the old landmarks
+    assert list(corrections.get(25)[0]) == [1025, 1025]
+    corrections.close()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import numpy as np
+
+from thumbnails import ThumbnailAtlas
+from video_index import load_or_build_indexes, sidecar_filename
+
+
+def test_thumbnails_without_indexes(cfr_video, tmp_path):
+    filename = str(tmp_path / 'video.mp4')
+    shutil.copy(cfr_video[0], filename)
+    frames = cfr_video[1]
+    atlas = ThumbnailAtlas(filename, interval=1.0, thumbnail_height=48)
+    assert atlas.nearest(10) == (None, None)
+    atlas.start()
+    # the indexes arrive while the thumbnails are created
+    atlas.use_indexes(*load_or_build_indexes(filename))
+    atlas.Thread.join(30)
+    assert atlas.ready
+    # one thumbnail per second of video (30 fps)
+    assert list(atlas.frame_numbers) == [0, 30, 60, 90, 120]
+    assert atlas.thumbnail_size == (64, 48)
+    frame_number, thumbnail = atlas.nearest(50)
+    assert frame_number == 60
+    assert thumbnail.shape == (48, 64, 3)
+    # the thumbnail of the right frame, resizing changes the pixels a little
+    small = frames[60][::5, ::5].astype(int)
+    assert np.abs(thumbnail.astype(int) - small).mean() < 3
+    assert atlas.nearest(1000)[0] == 120
+
+    # the next time the video is opened the thumbnails are read from disk
+    assert os.path.exists(sidecar_filename(filename, ThumbnailAtlas.sidecar_ending))
+    atlas = ThumbnailAtlas(filename, interval=1.0, thumbnail_height=48)
+    assert atlas.load()
+    assert atlas.ready and list(atlas.frame_numbers) == [0, 30, 60, 90, 120]
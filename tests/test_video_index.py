@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pytest
+
+from video_index import (KeyframeIndex, FrameTimestamps, scan_packets, load_sidecar, sidecar_filename,
+                         load_or_build_indexes)
+
+
+def test_keyframe_before_and_after():
+    index = KeyframeIndex([10, 30, 20], 50)
+    # the first frame is always a keyframe
+    assert list(index.keyframes) == [0, 10, 20, 30]
+    assert index.keyframe_before(0) == 0
+    assert index.keyframe_before(19) == 10
+    assert index.keyframe_before(20) == 20
+    assert index.keyframe_before(49) == 30
+    assert index.keyframe_after(20) == 30
+    assert index.keyframe_after(35) == 50
+    assert index.max_gop_length() == 20
+
+
+def test_keyframes_in_display_order():
+    # packets in decoding order (I P B B P B B), the B frames are shown before the P frames
+    timestamps = np.array([0, 99, 33, 66, 198, 132, 165])
+    keyframes = np.array([True, False, False, False, True, False, False])
+    index = KeyframeIndex.from_packets(timestamps, keyframes)
+    assert index.frame_count == 7
+    assert list(index.keyframes) == [0, 6]
+
+
+def test_index_of_a_video(cfr_video):
+    filename, frames = cfr_video
+    if scan_packets(filename) is None:
+        pytest.skip('OpenCV cannot read the packets of a video')
+    index = KeyframeIndex.load_or_build(filename)
+    assert index.frame_count == len(frames)
+    assert index.keyframes[0] == 0
+    assert len(index.keyframes) > 1
+    # stored next to the video and used the next time
+    assert os.path.exists(sidecar_filename(filename, KeyframeIndex.sidecar_ending))
+    loaded = KeyframeIndex.load(filename)
+    assert np.array_equal(loaded.keyframes, index.keyframes)
+
+
+def test_sidecar_of_a_different_video(tmp_path):
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'first version')
+    KeyframeIndex([0, 5], 10).save(str(video))
+    assert KeyframeIndex.load(str(video)) is not None
+    # the video was replaced by a different file
+    video.write_bytes(b'second, longer version')
+    assert load_sidecar(str(video), KeyframeIndex.sidecar_ending) is None
+    assert KeyframeIndex.load(str(video)) is None
+
+
+def test_frame_timestamps():
+    timestamps = FrameTimestamps([0, 33, 100, 50, 150])
+    assert list(timestamps.timestamps) == [0, 33, 50, 100, 150]
+    assert timestamps.time_of(2) == 50
+    assert list(timestamps.time_of(np.array([0, 10]))) == [0, 150]
+    assert timestamps.frame_at(99.7) == 3
+    assert timestamps.frame_at(75) == 2
+    assert timestamps.frame_after(60) == 3
+    assert timestamps.duration() == 150
+    assert timestamps.average_fps() == pytest.approx(4000 / 150)
+    assert timestamps.is_variable()
+    assert not FrameTimestamps(np.arange(10) * 33.3).is_variable()
+
+
+def test_indexes_of_a_variable_frame_rate_video(vfr_video):
+    filename, frames = vfr_video
+    keyframe_index, frame_timestamps = load_or_build_indexes(filename)
+    if frame_timestamps is None:
+        pytest.skip('OpenCV cannot read the packets of a video')
+    assert frame_timestamps.frame_count == len(frames)
+    assert frame_timestamps.is_variable()
+    # both indexes are stored next to the video
+    assert FrameTimestamps.load(filename) is not None
+    assert KeyframeIndex.load(filename) is not None
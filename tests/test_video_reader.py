@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import random
+import numpy as np
+import pytest
+
+from conftest import frame_number_of
+from video_index import KeyframeIndex, load_or_build_indexes
+from video_reader import FrameReader, SegmentedDecoder, frames_from_ranges, jump_target
+
+
+def test_frames_from_ranges():
+    assert frames_from_ranges([(0, 5, 20)]) == [0, 5, 10, 15, 20]
+    # repeated frames appear once, in order
+    assert frames_from_ranges([(10, 10, 30), (0, 5, 20)]) == [0, 5, 10, 15, 20, 30]
+    # frames outside the video are ignored
+    assert frames_from_ranges([(-7, 5, 100)], frame_count=12) == [3, 8]
+    assert frames_from_ranges([(4, 0, 6)]) == [4, 5, 6]
+
+
+def test_jump_target_without_index():
+    # short distances forward are decoded, anything else is a jump
+    assert jump_target(10, 20, max_grab=16) is None
+    assert jump_target(10, 40, max_grab=16) == 40
+    assert jump_target(10, 5, max_grab=16) == 5
+
+
+def test_jump_target_with_index():
+    index = KeyframeIndex([0, 50, 100], 150)
+    # frame 60 is after keyframe 50, decoding from 10 would go through 40 frames more
+    assert jump_target(10, 60, index, max_grab=16) == 50
+    # the decoder is close to the keyframe, it keeps decoding
+    assert jump_target(45, 60, index, max_grab=16) is None
+    # the decoder is past the frame
+    assert jump_target(70, 60, index, max_grab=16) == 50
+
+
+@pytest.mark.parametrize('use_index', [False, True])
+def test_exact_frames_after_seeking(cfr_video, use_index):
+    filename, frames = cfr_video
+    index = KeyframeIndex.load_or_build(filename) if use_index else None
+    if use_index and index is None:
+        pytest.skip('OpenCV cannot read the packets of a video')
+    reader = FrameReader(filename, index)
+    order = [0, len(frames) - 1, 50, 51, 60, 3, 100, 99] + random.Random(0).sample(range(len(frames)), 40)
+    for frame_number in order:
+        grabbed, frame = reader.read(frame_number)
+        assert grabbed
+        assert frame_number_of(frame) == frame_number
+        assert np.array_equal(frame, frames[frame_number])
+    reader.release()
+
+
+def test_read_frames(cfr_video):
+    filename, frames = cfr_video
+    reader = FrameReader(filename, KeyframeIndex.load_or_build(filename))
+    selected = [90, 3, 4, 40, 3, 149]
+    result = [(frame_number, frame_number_of(frame)) for frame_number, frame in reader.read_frames(selected)]
+    assert result == [(n, n) for n in (3, 4, 40, 90, 149)]
+    # frames after the end of the video stop the iteration
+    assert [n for n, _ in reader.read_frames([148, 200, 149])] == [148, 149]
+    reader.release()
+
+
+def test_read_into_an_array(cfr_video):
+    filename, frames = cfr_video
+    reader = FrameReader(filename)
+    image = np.zeros_like(frames[0])
+    grabbed, frame = reader.read(20, image)
+    assert grabbed
+    assert np.array_equal(frame, frames[20])
+    reader.release()
+
+
+def number_shown(frame_number, frame):
+    return frame_number, frame_number_of(frame)
+
+
+def fail_at_frame_30(frame_number, frame):
+    if frame_number == 30:
+        raise ValueError('cannot process frame 30')
+    return frame_number
+
+
+def test_segmented_decoder_keeps_the_order(cfr_video):
+    filename, frames = cfr_video
+    selected = list(range(0, 150, 3)) + [7, 8]
+    decoder = SegmentedDecoder(filename, selected, n_workers=3, segment_length=10,
+                               keyframe_index=KeyframeIndex.load_or_build(filename), worker_function=number_shown)
+    results = list(decoder)
+    assert [frame_number for frame_number, _ in results] == sorted(selected)
+    assert all(result == (frame_number, frame_number) for frame_number, result in results)
+    assert decoder.processes == []
+
+
+def test_segmented_decoder_reports_errors(cfr_video):
+    filename, frames = cfr_video
+    decoder = SegmentedDecoder(filename, range(60), n_workers=2, segment_length=10, worker_function=fail_at_frame_30,
+                               poll_seconds=0.1)
+    received = []
+    with pytest.raises(RuntimeError, match='frame 30'):
+        for frame_number, result in decoder:
+            received.append(frame_number)
+    assert received == list(range(30))
+    assert decoder.processes == []
+
+
+def test_segmented_decoder_returns_the_frames(cfr_video):
+    filename, frames = cfr_video
+    selected = list(range(20, 90, 2))
+    decoder = SegmentedDecoder(filename, selected, n_workers=2, segment_length=8, read_ahead=3)
+    received = []
+    for frame_number, frame in decoder:
+        received.append(frame_number)
+        # a view of the ring buffer slot, valid until the next frame is requested
+        assert not frame.flags.owndata
+        assert np.array_equal(frame, frames[frame_number])
+    assert received == selected
+    assert decoder.ring_buffers == []
+
+
+def test_exact_frames_after_seeking_with_variable_frame_rate(vfr_video):
+    filename, frames = vfr_video
+    keyframe_index, frame_timestamps = load_or_build_indexes(filename)
+    if frame_timestamps is None:
+        pytest.skip('OpenCV cannot read the packets of a video')
+    reader = FrameReader(filename, keyframe_index, frame_timestamps=frame_timestamps)
+    order = [0, len(frames) - 1, 50, 51, 60, 3, 100, 99] + random.Random(1).sample(range(len(frames)), 40)
+    for frame_number in order:
+        grabbed, frame = reader.read(frame_number)
+        assert grabbed
+        assert frame_number_of(frame) == frame_number
+        assert np.array_equal(frame, frames[frame_number])
+    reader.release()
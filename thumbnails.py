@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Small pictures (thumbnails) of frames sampled along the video, used to give
+visual feedback while the user moves the frame slider. The thumbnails are
+created in the background, kept in memory in a single array (the atlas) and
+stored next to the video as JPEG images so that they are available immediately
+the next time the video is opened.
+"""
+import numpy as np
+import cv2
+from threading import Thread
+
+from video_index import load_sidecar, save_sidecar, sidecar_filename, video_signature
+from video_reader import FrameReader
+
+
+class ThumbnailAtlas:
+    """
+    One thumbnail every interval seconds (at most max_thumbnails thumbnails),
+    thumbnail_height pixels tall. Thumbnails are created in frame order and can
+    be used as soon as they are ready, nearest() returns the closest thumbnail
+    that is already available. The indexes are not required: without them the
+    frames are sampled with the frame rate of the video, and use_indexes() makes
+    the decoder faster once they are ready.
+    """
+
+    sidecar_ending = '_thumbnails.npz'
+
+    def __init__(self, video_filename, interval=1.0, thumbnail_height=72, max_thumbnails=2000,
+                 keyframe_index=None, frame_timestamps=None, backend='opencv'):
+        self.video_filename = video_filename
+        self.keyframe_index = keyframe_index
+        self.frame_timestamps = frame_timestamps
+        self.backend = backend
+        self.reader = None
+
+        stream = cv2.VideoCapture(self.video_filename)
+        frame_count = int(stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = stream.get(cv2.CAP_PROP_FPS)
+        width = int(stream.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(stream.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        stream.release()
+
+        thumbnail_height = min(thumbnail_height, height) if height > 0 else thumbnail_height
+        thumbnail_width = int(round(width * thumbnail_height / height)) if height > 0 else 0
+        self.thumbnail_size = (thumbnail_width, thumbnail_height)
+
+        # frames sampled, every interval seconds. Long videos use a longer interval
+        # so that the atlas does not grow without limit
+        if frame_timestamps is not None:
+            duration = frame_timestamps.duration() / 1000
+        else:
+            duration = frame_count / fps if fps > 0 else 0
+        interval = max(interval, duration / max_thumbnails)
+        if frame_timestamps is not None:
+            # variable frame rate, the frames are sampled by time
+            times = frame_timestamps.time_of(0) + np.arange(0, duration * 1000, interval * 1000)
+            self.frame_numbers = np.unique([frame_timestamps.frame_at(t) for t in times]).astype(np.int64)
+        else:
+            step = max(int(round(interval * fps)), 1) if fps > 0 else 1
+            self.frame_numbers = np.arange(0, frame_count, step, dtype=np.int64)
+
+        self.atlas = np.zeros((len(self.frame_numbers), thumbnail_height, thumbnail_width, 3), dtype=np.uint8)
+        self.count = 0  # number of thumbnails ready, they are created in frame order
+        self.stopped = False
+        self.Thread = Thread(target=self.update, args=())
+        self.Thread.daemon = True
+
+    def start(self):
+        self.Thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+
+    def use_indexes(self, keyframe_index, frame_timestamps=None):
+        # the indexes were built after the thumbnails were started, the frames already
+        # sampled are kept and the decoder uses them for the next jumps
+        self.keyframe_index = keyframe_index
+        self.frame_timestamps = frame_timestamps
+        reader = self.reader
+        if reader is not None:
+            reader.keyframe_index = keyframe_index
+            reader.frame_timestamps = frame_timestamps
+
+    @property
+    def ready(self):
+        return self.count == len(self.frame_numbers)
+
+    def update(self):
+        # load the thumbnails from disk, or create them and store them for next time
+        if self.load():
+            return
+        if self.build():
+            try:
+                self.save()
+            except OSError:
+                # the folder might be read-only, the thumbnails are still in memory
+                pass
+
+    def build(self):
+        # only the sampled frames are converted, the others are just grabbed
+        reader = FrameReader(self.video_filename, self.keyframe_index, backend=self.backend,
+                             frame_timestamps=self.frame_timestamps)
+        self.reader = reader
+        # the indexes might have arrived while the decoder was opened
+        reader.keyframe_index, reader.frame_timestamps = self.keyframe_index, self.frame_timestamps
+        try:
+            for frame_number, frame in reader.read_frames(self.frame_numbers):
+                if self.stopped:
+                    return False
+                self.atlas[self.count] = cv2.resize(frame, self.thumbnail_size, interpolation=cv2.INTER_AREA)
+                self.count += 1
+        finally:
+            self.reader = None
+            reader.release()
+        # the video might have less frames than reported
+        self.frame_numbers = self.frame_numbers[:self.count]
+        self.atlas = self.atlas[:self.count]
+        return self.count > 0
+
+    def nearest(self, frame_number):
+        # return (frame_number, thumbnail) of the available thumbnail closest to
+        # frame_number, or (None, None) if there are no thumbnails yet
+        count = self.count
+        if count == 0:
+            return None, None
+        frame_numbers = self.frame_numbers[:count]
+        position = int(np.searchsorted(frame_numbers, frame_number))
+        if position == count or (position > 0 and
+                                 frame_number - frame_numbers[position - 1] < frame_numbers[position] - frame_number):
+            position -= 1
+        return int(frame_numbers[position]), self.atlas[position]
+
+    def save(self):
+        # the thumbnails are stored as JPEG images, one after the other
+        encoded = [cv2.imencode('.jpg', thumbnail)[1].ravel() for thumbnail in self.atlas]
+        offsets = np.cumsum([0] + [len(jpeg) for jpeg in encoded])
+        save_sidecar(sidecar_filename(self.video_filename, self.sidecar_ending),
+                     frame_numbers=self.frame_numbers,
+                     jpeg=np.concatenate(encoded),
+                     offsets=offsets,
+                     signature=video_signature(self.video_filename))
+
+    def load(self):
+        data = load_sidecar(self.video_filename, self.sidecar_ending)
+        if data is None or len(data['offsets']) < 2:
+            return False
+        offsets = data['offsets']
+        thumbnails = [cv2.imdecode(data['jpeg'][offsets[i]:offsets[i + 1]], cv2.IMREAD_COLOR)
+                      for i in range(len(offsets) - 1)]
+        if any(thumbnail is None or thumbnail.shape[:2] != self.atlas.shape[1:3] for thumbnail in thumbnails):
+            # created with a different size
+            return False
+        self.frame_numbers = data['frame_numbers']
+        self.atlas = np.stack(thumbnails)
+        self.count = len(thumbnails)
+        return True
@@ -572,6 +572,31 @@ def save_txt_file(file_name,shape,circle_left,circle_right, boundingbox):
     os.remove(file_no_ext + '_temp_circle_right.txt')
     os.remove(file_no_ext + '_temp_boundingbox.txt')
     
+def landmark_csv_columns():
+    #columns of the landmark .csv files that are loaded with the videos
+    columns = ["Frame_number", "bbox_top_x", "bbox_top_y", "bbox_bottom_x", "bbox_bottom_y"]
+    for i in range(0,68):
+        columns.append('landmark_'+str(i)+'_x')
+        columns.append('landmark_'+str(i)+'_y')
+    return columns
+
+
+def save_landmark_csv_file(file_name, frame_numbers, boundingboxes, shapes):
+    
+    #save the bounding box and landmarks of each frame in a .csv file with the 
+    #same layout that the video viewer reads. boundingboxes is (n,4) and shapes 
+    #is (n,68,2). The file is written to a temporary file first so that an
+    #interrupted process never leaves half a file behind
+    data = np.column_stack((np.asarray(frame_numbers, dtype=int),
+                            np.asarray(boundingboxes).reshape(-1,4),
+                            np.asarray(shapes).reshape(-1,136).astype(int)))
+    LandmarkDataFrame = pd.DataFrame(data, columns=landmark_csv_columns())
+    integer_columns = [LandmarkDataFrame.columns[0]] + list(LandmarkDataFrame.columns[5:])
+    LandmarkDataFrame[integer_columns] = LandmarkDataFrame[integer_columns].astype(int)
+    LandmarkDataFrame.to_csv(file_name + '.tmp')
+    os.replace(file_name + '.tmp', file_name)
+    
+    
 def save_xls_file(file_name, MeasurementsLeft, MeasurementsRight, MeasurementsDeviation, MeasurementsPercentual):
     #saves the facial metrics into a xls file. It works only for a single photo
     
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Video decoding back-ends. Every back-end offers the part of the
+cv2.VideoCapture interface used by the program (isOpened, get, set, grab,
+retrieve, read, release) so they can be used interchangeably. Some codecs
+decode much faster with one back-end than with the other, probe_backends
+measures the speed of every available back-end on a given file.
+"""
+import time
+import numpy as np
+import cv2
+
+try:
+    import av
+except ImportError:
+    # PyAV is optional, without it only OpenCV is available
+    av = None
+
+
+class OpenCVBackend:
+    """
+    Decoding with cv2.VideoCapture. output can be 'bgr' or 'gray', threads is
+    the number of decoding threads (0 lets OpenCV decide).
+    """
+
+    name = 'opencv'
+
+    def __init__(self, filename, output='bgr', threads=0):
+        self.output = output
+        if threads and hasattr(cv2, 'CAP_PROP_N_THREADS'):
+            self.stream = cv2.VideoCapture(filename, cv2.CAP_ANY, [cv2.CAP_PROP_N_THREADS, threads])
+        else:
+            self.stream = cv2.VideoCapture(filename)
+
+    @staticmethod
+    def available():
+        return True
+
+    def isOpened(self):
+        return self.stream.isOpened()
+
+    def get(self, prop):
+        return self.stream.get(prop)
+
+    def set(self, prop, value):
+        return self.stream.set(prop, value)
+
+    def grab(self):
+        return self.stream.grab()
+
+    def retrieve(self, image=None):
+        if self.output == 'gray':
+            grabbed, frame = self.stream.retrieve()
+            if not grabbed:
+                return grabbed, None
+            return grabbed, cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, image)
+        return self.stream.retrieve(image)
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def release(self):
+        self.stream.release()
+
+
+class PyAVBackend:
+    """
+    Decoding with PyAV (the FFmpeg libraries) using frame and slice threading.
+    output can be 'bgr' or 'gray', threads is the number of decoding threads
+    (0 lets FFmpeg decide).
+    """
+
+    name = 'pyav'
+    pixel_formats = {'bgr': 'bgr24', 'gray': 'gray'}
+
+    def __init__(self, filename, output='bgr', threads=0):
+        self.pixel_format = self.pixel_formats[output]
+        self.container = None
+        try:
+            self.container = av.open(filename)
+            self.stream = self.container.streams.video[0]
+        except (av.FFmpegError, IndexError):
+            self.release()
+            return
+        self.stream.thread_type = 'AUTO'
+        if threads:
+            self.stream.thread_count = threads
+
+        rate = self.stream.average_rate or self.stream.guessed_rate
+        self.fps = float(rate) if rate else 0.0
+        self.start_time = self.stream.start_time or 0
+        self.frame_count = self.stream.frames
+        if not self.frame_count and self.stream.duration and self.fps:
+            self.frame_count = int(round(self.stream.duration * self.stream.time_base * self.fps))
+
+        self._frames = self.container.decode(self.stream)
+        self._frame = None
+        self._pending = None  # frame found while seeking, returned by the next grab
+        self.position = 0
+
+    @staticmethod
+    def available():
+        return av is not None
+
+    def isOpened(self):
+        return self.container is not None
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(self.frame_count)
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.stream.codec_context.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.stream.codec_context.height)
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.position)
+        if prop == cv2.CAP_PROP_POS_MSEC and self._frame is not None and self._frame.pts is not None:
+            return float((self._frame.pts - self.start_time) * self.stream.time_base * 1000)
+        return 0.0
+
+    def frame_pts(self, frame_number):
+        # presentation time of a frame, assuming a constant frame rate
+        return self.start_time + int(round(frame_number / self.fps / self.stream.time_base))
+
+    def set(self, prop, value):
+        # seek by frame number (assumes a constant frame rate) or by time in ms (exact)
+        if prop == cv2.CAP_PROP_POS_FRAMES and self.fps:
+            frame_number = int(value)
+            target_pts = self.frame_pts(frame_number)
+            # half a frame of tolerance for rounding in the timestamps
+            tolerance = self.frame_pts(0.5) - self.start_time
+        elif prop == cv2.CAP_PROP_POS_MSEC:
+            frame_number = int(round(value * self.fps / 1000))
+            target_pts = self.start_time + int(round(value / 1000 / self.stream.time_base))
+            tolerance = int(round(0.0005 / self.stream.time_base))
+        else:
+            return False
+        self.container.seek(target_pts, stream=self.stream, backward=True, any_frame=False)
+        self._frames = self.container.decode(self.stream)
+        self._pending = None
+        for frame in self._frames:
+            if frame.pts is None or frame.pts >= target_pts - tolerance:
+                self._pending = frame
+                break
+        self.position = frame_number
+        return self._pending is not None
+
+    def grab(self):
+        if self._pending is not None:
+            self._frame, self._pending = self._pending, None
+        else:
+            try:
+                self._frame = next(self._frames)
+            except (StopIteration, av.FFmpegError):
+                self._frame = None
+                return False
+        self.position += 1
+        return True
+
+    def retrieve(self, image=None):
+        if self._frame is None:
+            return False, None
+        frame = self._frame.to_ndarray(format=self.pixel_format)
+        if image is not None:
+            np.copyto(image, frame)
+            frame = image
+        return True, frame
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def release(self):
+        if self.container is not None:
+            self.container.close()
+            self.container = None
+
+
+BACKENDS = {OpenCVBackend.name: OpenCVBackend,
+            PyAVBackend.name: PyAVBackend}
+
+
+def available_backends():
+    return [name for name, backend in BACKENDS.items() if backend.available()]
+
+
+def open_video(filename, backend='opencv', output='bgr', threads=0):
+    # open a video with the requested back-end
+    return BACKENDS[backend](filename, output, threads)
+
+
+def probe_backends(filename, n_frames=15, output='bgr'):
+    # decode the first n_frames of the video with every available back-end and
+    # return the average time per frame (in seconds) of each one
+    timings = {}
+    for name in available_backends():
+        stream = None
+        try:
+            stream = open_video(filename, name, output)
+            if not stream.isOpened() or not stream.read()[0]:
+                continue
+            start = time.perf_counter()
+            decoded = 0
+            while decoded < n_frames and stream.read()[0]:
+                decoded += 1
+            if decoded > 0:
+                timings[name] = (time.perf_counter() - start) / decoded
+        except Exception:
+            # a back-end that cannot read the file is not an option
+            continue
+        finally:
+            if stream is not None:
+                stream.release()
+    return timings
+
+
+def select_backend(filename, n_frames=15, output='bgr'):
+    # name of the fastest back-end for this file, OpenCV if none of them works
+    timings = probe_backends(filename, n_frames, output)
+    if not timings:
+        return OpenCVBackend.name
+    return min(timings, key=timings.get)
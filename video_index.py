@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Indexes that describe the structure of a video file so that frames can be
+located without decoding the whole file. The indexes are stored as sidecar
+files next to the video (same name as the video with a different ending), the
+same way the landmark .csv files are stored.
+"""
+import os
+import numpy as np
+import cv2
+
+
+def sidecar_filename(video_filename, ending):
+    # name of a file that lives next to the video and describes it
+    return os.path.splitext(video_filename)[0] + ending
+
+
+def video_signature(video_filename):
+    # size and modification time of the video, used to verify that a sidecar
+    # file was created for the current version of the video
+    stats = os.stat(video_filename)
+    return np.array([stats.st_size, int(stats.st_mtime)], dtype=np.int64)
+
+
+def save_sidecar(filename, **arrays):
+    # write the arrays to a temporary file and then replace the old sidecar,
+    # this way a crash never leaves a half written index behind
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temp_filename, filename)
+
+
+def load_sidecar(video_filename, ending):
+    # read the arrays stored in a sidecar file, returns None if the file does not
+    # exist or if it was created for a different version of the video
+    filename = sidecar_filename(video_filename, ending)
+    if not os.path.exists(filename):
+        return None
+    try:
+        with np.load(filename) as data:
+            if not np.array_equal(data['signature'], video_signature(video_filename)):
+                return None
+            return {key: data[key] for key in data.files}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def scan_packets(video_filename):
+    # read the video packets without decoding them and return the presentation time
+    # (in ms) of each packet and whether it is a keyframe, both in decoding order.
+    # This requires the FFMPEG back-end of OpenCV, if it is not available None is returned
+    if not hasattr(cv2, 'CAP_PROP_LRF_HAS_KEY_FRAME'):
+        return None
+    try:
+        stream = cv2.VideoCapture(video_filename, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+    except cv2.error:
+        return None
+    if not stream.isOpened():
+        return None
+
+    timestamps = []
+    keyframes = []
+    while stream.grab():
+        timestamps.append(stream.get(cv2.CAP_PROP_POS_MSEC))
+        keyframes.append(bool(stream.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME)))
+    stream.release()
+
+    if len(timestamps) == 0:
+        return None
+    return np.array(timestamps), np.array(keyframes)
+
+
+class KeyframeIndex:
+    """
+    Position of every keyframe in the video. It allows to move to any frame by
+    jumping to the closest keyframe before it and decoding forward, so that the
+    cost of a seek is bounded by the length of a GOP (group of pictures).
+    """
+
+    sidecar_ending = '_keyframes.npz'
+
+    def __init__(self, keyframes, frame_count):
+        self.keyframes = np.unique(np.asarray(keyframes, dtype=np.int64))
+        self.frame_count = int(frame_count)
+        if len(self.keyframes) == 0 or self.keyframes[0] != 0:
+            # the first frame is always decodable, the decoder starts there
+            self.keyframes = np.insert(self.keyframes, 0, 0)
+
+    def keyframe_before(self, frame_number):
+        # return the last keyframe located at or before frame_number
+        position = np.searchsorted(self.keyframes, frame_number, side='right') - 1
+        return int(self.keyframes[max(position, 0)])
+
+    def keyframe_after(self, frame_number):
+        # return the first keyframe located after frame_number, or the number
+        # of frames if there are no more keyframes
+        position = np.searchsorted(self.keyframes, frame_number, side='right')
+        if position < len(self.keyframes):
+            return int(self.keyframes[position])
+        return self.frame_count
+
+    def max_gop_length(self):
+        # largest number of frames that must be decoded to reach any frame
+        bounds = np.append(self.keyframes, self.frame_count)
+        return int(np.max(np.diff(bounds)))
+
+    @classmethod
+    def from_packets(cls, timestamps, keyframes):
+        # packets are in decoding order, with B-frames this is different from the
+        # order in which frames are shown. The position of each packet in the video
+        # is given by the order of its presentation time
+        display_order = np.empty(len(timestamps), dtype=np.int64)
+        display_order[np.argsort(timestamps, kind='stable')] = np.arange(len(timestamps))
+        return cls(display_order[keyframes], len(timestamps))
+
+    @classmethod
+    def build(cls, video_filename):
+        # if the packets cannot be read then None is returned and the caller should
+        # fall back to the regular (slow) seeking provided by OpenCV
+        packets = scan_packets(video_filename)
+        if packets is None:
+            return None
+        return cls.from_packets(*packets)
+
+    def save(self, video_filename):
+        save_sidecar(sidecar_filename(video_filename, self.sidecar_ending),
+                     keyframes=self.keyframes,
+                     frame_count=np.array(self.frame_count),
+                     signature=video_signature(video_filename))
+
+    @classmethod
+    def load(cls, video_filename):
+        data = load_sidecar(video_filename, cls.sidecar_ending)
+        if data is None:
+            return None
+        return cls(data['keyframes'], int(data['frame_count']))
+
+    @classmethod
+    def load_or_build(cls, video_filename):
+        # use the sidecar if possible, otherwise scan the video and store the
+        # result for next time
+        index = cls.load(video_filename)
+        if index is None:
+            index = cls.build(video_filename)
+            if index is not None:
+                try:
+                    index.save(video_filename)
+                except OSError:
+                    # the folder might be read-only, the index is still useful
+                    pass
+        return index
+
+
+class FrameTimestamps:
+    """
+    Presentation time (in ms) of every frame in the video, in the order in which
+    frames are shown. Videos recorded with
+    phones often have a variable frame rate, in that case the time of a frame is
+    not frame_number/fps and this table is required to go from frame numbers to
+    time and back.
+    """
+
+    sidecar_ending = '_timestamps.npz'
+
+    def __init__(self, timestamps):
+        self.timestamps = np.sort(np.asarray(timestamps, dtype=np.float64))
+        self.frame_count = len(self.timestamps)
+
+    def time_of(self, frame_number):
+        # time of a frame (or of an array of frames) in ms, as reported by the decoder
+        frame_number = np.clip(frame_number, 0, self.frame_count - 1)
+        return self.timestamps[frame_number]
+
+    def frame_at(self, time):
+        # frame that is shown at time (in ms). Times are rounded by the decoders,
+        # half a ms of tolerance is used in the comparisons
+        position = np.searchsorted(self.timestamps, time + 0.5, side='right') - 1
+        return int(np.clip(position, 0, self.frame_count - 1))
+
+    def frame_after(self, time):
+        # first frame shown after time (in ms)
+        return int(np.searchsorted(self.timestamps, time + 0.5, side='left'))
+
+    def duration(self):
+        return self.timestamps[-1] - self.timestamps[0]
+
+    def average_fps(self):
+        if self.frame_count < 2 or self.duration() <= 0:
+            return 0.0
+        return 1000.0 * (self.frame_count - 1) / self.duration()
+
+    def is_variable(self, tolerance=0.1):
+        # True if the time between frames changes more than tolerance (fraction of
+        # the average time between frames)
+        if self.frame_count < 3:
+            return False
+        intervals = np.diff(self.timestamps)
+        mean_interval = np.mean(intervals)
+        return bool(np.max(np.abs(intervals - mean_interval)) > tolerance * mean_interval)
+
+    @classmethod
+    def build(cls, video_filename):
+        packets = scan_packets(video_filename)
+        if packets is None:
+            return None
+        return cls(packets[0])
+
+    def save(self, video_filename):
+        save_sidecar(sidecar_filename(video_filename, self.sidecar_ending),
+                     timestamps=self.timestamps,
+                     signature=video_signature(video_filename))
+
+    @classmethod
+    def load(cls, video_filename):
+        data = load_sidecar(video_filename, cls.sidecar_ending)
+        if data is None:
+            return None
+        return cls(data['timestamps'])
+
+
+def load_or_build_indexes(video_filename):
+    # return the keyframe index and the frame timestamps of a video. The sidecar
+    # files are used if possible, otherwise the video packets are read once to
+    # create both of them and the result is stored for next time
+    keyframe_index = KeyframeIndex.load(video_filename)
+    frame_timestamps = FrameTimestamps.load(video_filename)
+    if keyframe_index is not None and frame_timestamps is not None:
+        return keyframe_index, frame_timestamps
+
+    packets = scan_packets(video_filename)
+    if packets is None:
+        return keyframe_index, frame_timestamps
+
+    new_indexes = []
+    if keyframe_index is None:
+        keyframe_index = KeyframeIndex.from_packets(*packets)
+        new_indexes.append(keyframe_index)
+    if frame_timestamps is None:
+        frame_timestamps = FrameTimestamps(packets[0])
+        new_indexes.append(frame_timestamps)
+    for index in new_indexes:
+        try:
+            index.save(video_filename)
+        except OSError:
+            # the folder might be read-only, the index is still useful
+            pass
+    return keyframe_index, frame_timestamps
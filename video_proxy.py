@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Low resolution copy (proxy) of a video used to scrub large videos. The proxy is
+created in the background and stored next to the video. Every frame of the
+proxy is a keyframe (MJPG), so any frame can be read without decoding its
+neighbours.
+"""
+import os
+import numpy as np
+import cv2
+from threading import Thread
+
+from video_index import KeyframeIndex, sidecar_filename
+from video_reader import FrameReader
+
+
+class VideoProxy:
+    """
+    Creates and reads the proxy of a video. The proxy frames are at most
+    max_height pixels tall, scale is the factor that converts proxy pixels
+    into pixels of the original video.
+    """
+
+    sidecar_ending = '_proxy.avi'
+
+    def __init__(self, video_filename, max_height=480):
+        self.video_filename = video_filename
+        self.proxy_filename = sidecar_filename(video_filename, self.sidecar_ending)
+        self.max_height = max_height
+
+        stream = cv2.VideoCapture(self.video_filename)
+        self.frame_count = int(stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = stream.get(cv2.CAP_PROP_FPS)
+        width = int(stream.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(stream.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        stream.release()
+
+        # MJPG frames must have an even size
+        proxy_height = 2 * (min(height, self.max_height) // 2)
+        proxy_width = 2 * int(round(width * proxy_height / height / 2)) if height > 0 else 0
+        self.proxy_size = (proxy_width, proxy_height)
+        self.scale = height / proxy_height if proxy_height > 0 else 1.0
+
+        self.ready = False
+        self.progress = 0.0  # fraction of the proxy that has been created
+        self.stopped = False
+        self.reader = None
+        self.Thread = Thread(target=self.update, args=())
+        self.Thread.daemon = True
+
+    def start(self):
+        self.Thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+
+    def is_valid(self):
+        # the proxy exists and was created after the last change to the video
+        if not os.path.exists(self.proxy_filename):
+            return False
+        if os.path.getmtime(self.proxy_filename) < os.path.getmtime(self.video_filename):
+            return False
+        stream = cv2.VideoCapture(self.proxy_filename)
+        valid = stream.isOpened() and int(stream.get(cv2.CAP_PROP_FRAME_COUNT)) > 0
+        stream.release()
+        return valid
+
+    def update(self):
+        # create the proxy (if needed) and open it
+        if not self.is_valid():
+            if not self.build():
+                return
+        self.open()
+
+    def build(self):
+        # decode the whole video once, downscale every frame and store it as MJPG.
+        # The proxy is written to a temporary file that replaces the proxy once it is complete
+        temp_filename = self.proxy_filename + '.tmp.avi'
+        stream = cv2.VideoCapture(self.video_filename)
+        writer = cv2.VideoWriter(temp_filename, cv2.VideoWriter_fourcc(*'MJPG'),
+                                 self.fps if self.fps > 0 else 30, self.proxy_size)
+        if not stream.isOpened() or not writer.isOpened():
+            stream.release()
+            writer.release()
+            return False
+
+        frame_number = 0
+        while not self.stopped:
+            success, image = stream.read()
+            if not success:
+                break
+            writer.write(cv2.resize(image, self.proxy_size, interpolation=cv2.INTER_AREA))
+            frame_number += 1
+            if self.frame_count > 0:
+                self.progress = min(frame_number / self.frame_count, 1.0)
+
+        stream.release()
+        writer.release()
+
+        if self.stopped or frame_number == 0:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            return False
+
+        try:
+            os.replace(temp_filename, self.proxy_filename)
+        except OSError:
+            return False
+        return True
+
+    def open(self):
+        reader = FrameReader(self.proxy_filename)
+        if not reader.isOpened():
+            return
+        frame_count = int(reader.get(cv2.CAP_PROP_FRAME_COUNT))
+        # all the frames are keyframes, seeking never decodes other frames
+        reader.keyframe_index = KeyframeIndex(np.arange(frame_count), frame_count)
+        self.reader = reader
+        self.progress = 1.0
+        self.ready = True
+
+    def read(self, frame_number):
+        # read a frame from the proxy, the reader is only used by the main thread
+        if not self.ready:
+            return False, None
+        return self.reader.read(frame_number)
+
+    def release(self):
+        self.stop()
+        if self.reader is not None:
+            self.reader.release()
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Frame accurate access to video files using OpenCV. These classes do not depend
+on Qt so they can be used by the GUI and by background workers.
+"""
+import os
+import cv2
+import multiprocessing
+import queue as queue_module
+import traceback
+import numpy as np
+
+from video_backends import open_video
+from frame_buffer import FrameRingBuffer
+
+
+def frames_from_ranges(ranges, frame_count=None):
+    # list of frames described by (init, step, end) ranges, the end is included.
+    # The frames are sorted and repeated frames are removed, frames before the first
+    # frame or (if frame_count is given) after the last frame of the video are ignored
+    frames = set()
+    for init, step, end in ranges:
+        step = max(step, 1)
+        if init < 0:
+            # first frame of the range inside the video
+            init %= step
+        if frame_count is not None:
+            end = min(end, frame_count - 1)
+        frames.update(range(init, end + 1, step))
+    return sorted(frames)
+
+
+def jump_target(position, frame_number, keyframe_index=None, max_grab=16):
+    # frame where the decoder must jump to go from position to frame_number, or None if
+    # it is better to keep decoding forward. Jumping has a fixed cost (OpenCV decodes
+    # some frames before the target to land exactly on it), so it is only done if it
+    # avoids decoding more than max_grab frames
+    if keyframe_index is None:
+        if 0 <= frame_number - position <= max_grab:
+            return None
+        return frame_number
+    keyframe = keyframe_index.keyframe_before(frame_number)
+    if position > frame_number or keyframe - position > max_grab:
+        # the decoder is past the frame or far behind it, jump to the keyframe.
+        # Otherwise it is cheaper to keep decoding from the current position
+        return keyframe
+    return None
+
+
+class FrameReader:
+    """
+    Wrapper around a cv2.VideoCapture object that keeps track of the position
+    of the decoder. Random access uses the keyframe index (if available) to jump
+    to the closest keyframe and decode forward, and continues decoding from the
+    current position when that saves decoding at least max_grab frames.
+    Frames that are skipped are only grabbed (decoded without color conversion).
+    backend and output select the decoder and the format of the frames (see
+    video_backends). If the frame timestamps are known, jumps are exact in
+    videos with variable frame rate.
+    """
+
+    def __init__(self, filename, keyframe_index=None, max_grab=16, backend='opencv', output='bgr',
+                 frame_timestamps=None):
+        self.video_filename = filename
+        self.stream = open_video(self.video_filename, backend, output)
+        self.keyframe_index = keyframe_index
+        self.frame_timestamps = frame_timestamps
+        self.max_grab = max_grab
+        self.position = 0  # number of the next frame that the decoder will return
+
+    def isOpened(self):
+        return self.stream.isOpened()
+
+    def get(self, prop):
+        return self.stream.get(prop)
+
+    def seek(self, frame_number):
+        # move the decoder so that the next read returns frame_number
+        target = jump_target(self.position, frame_number, self.keyframe_index, self.max_grab)
+        if target is not None:
+            self.jump(target)
+
+        while self.position < frame_number:
+            if not self.stream.grab():
+                break
+            self.position += 1
+
+    def jump(self, frame_number):
+        # move the decoder to frame_number, or to a frame before it (the position is
+        # updated to the frame where the decoder actually is)
+        frame_timestamps = self.frame_timestamps
+        if frame_timestamps is None or frame_number == 0:
+            self.stream.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            self.position = frame_number
+            return
+
+        if self.stream.name != 'opencv':
+            # the other back-ends seek by presentation time and land on the frame
+            self.stream.set(cv2.CAP_PROP_POS_MSEC, frame_timestamps.time_of(frame_number))
+            self.position = frame_number
+            return
+
+        # OpenCV converts frame numbers into times using the average frame rate, which is
+        # wrong for videos with variable frame rate. After seeking, the decoder reports
+        # the time of the last frame it decoded and the next read returns the frame after it
+        fps = self.stream.get(cv2.CAP_PROP_FPS)
+        target = int(frame_timestamps.time_of(frame_number) * fps / 1000)
+        while True:
+            self.stream.set(cv2.CAP_PROP_POS_FRAMES, target)
+            if target <= 0:
+                position = 0
+                break
+            position = frame_timestamps.frame_after(self.stream.get(cv2.CAP_PROP_POS_MSEC))
+            if position <= frame_number:
+                break
+            # landed after the frame, try again earlier
+            target = max(target - (position - frame_number), 0)
+        self.position = position
+
+    def read(self, frame_number=None, image=None):
+        # read a frame, if frame_number is None then the next frame is returned.
+        # If image is given the frame is decoded into it (it must have the size of the frame)
+        if frame_number is not None and frame_number != self.position:
+            self.seek(frame_number)
+        grabbed, frame = self.stream.read(image)
+        if grabbed:
+            self.position += 1
+        return grabbed, frame
+
+    def read_frames(self, frame_numbers):
+        # generator that returns (frame_number, frame) for each of the requested frames
+        # in increasing order. Frames that are not requested are only grabbed, never
+        # converted to BGR, and if the next requested frame is after a keyframe the
+        # decoder jumps to that keyframe instead of going through all the frames
+        for frame_number in sorted(set(frame_numbers)):
+            grabbed, frame = self.read(frame_number)
+            if not grabbed:
+                return
+            yield frame_number, frame
+
+    def release(self):
+        self.stream.release()
+
+
+def read_into_ring_buffer(reader, frame_numbers, ring_buffer):
+    # generator like FrameReader.read_frames that decodes every frame directly into a
+    # free slot of a FrameRingBuffer and returns (frame_number, slot). The slot belongs
+    # to whoever receives it until it is released
+    for frame_number in sorted(set(frame_numbers)):
+        slot = ring_buffer.acquire_write()
+        image = ring_buffer.slot(slot)
+        grabbed, frame = reader.read(frame_number, image)
+        if not grabbed:
+            ring_buffer.release(slot)
+            return
+        if not np.shares_memory(frame, image):
+            # the decoder could not write in the slot (fails if the size is not the expected one)
+            np.copyto(image, frame)
+        yield frame_number, slot
+
+
+def decode_segments(video_filename, segments, keyframe_index, output_queue, worker_function=None,
+                    backend='opencv', ring_buffer=None, frame_cache=None):
+    # decode groups of consecutive frames, one group after the other, in its own process
+    # and send them (or the result of worker_function applied to them) to the main
+    # process, as ('frame', segment, frame_number, frame). segments is a list of
+    # (segment, frame_numbers). If ring_buffer is given the frames are decoded into its
+    # slots and the number of the slot is sent instead of the frame.
+    # If frame_cache (a MemmapFrameCache) is given the frames are read from it, and the
+    # frames that are not there yet are decoded and stored.
+    # ('end', segment, None, None) marks the end of every segment, if decoding or
+    # worker_function fail the worker stops after sending ('error', segment, frame_number, traceback)
+    reader = FrameReader(video_filename, keyframe_index, backend=backend)
+    segment = frame_number = None
+    try:
+        for segment, frame_numbers in segments:
+            if frame_cache is not None:
+                frames = frame_cache.read_frames(reader, frame_numbers)
+            else:
+                frames = reader.read_frames(frame_numbers)
+            if ring_buffer is not None and frame_cache is not None:
+                for frame_number, frame in frames:
+                    slot = ring_buffer.acquire_write()
+                    np.copyto(ring_buffer.slot(slot), frame)
+                    output_queue.put(('frame', segment, frame_number, slot))
+            elif ring_buffer is not None:
+                for frame_number, slot in read_into_ring_buffer(reader, frame_numbers, ring_buffer):
+                    output_queue.put(('frame', segment, frame_number, slot))
+            else:
+                for frame_number, frame in frames:
+                    if worker_function is not None:
+                        frame = worker_function(frame_number, frame)
+                    output_queue.put(('frame', segment, frame_number, frame))
+            output_queue.put(('end', segment, None, None))
+    except Exception:
+        output_queue.put(('error', segment, frame_number, traceback.format_exc()))
+    finally:
+        reader.release()
+        if ring_buffer is not None:
+            ring_buffer.close()
+        if frame_cache is not None:
+            frame_cache.flush()
+
+
+class SegmentedDecoder:
+    """
+    Decodes a video using several processes. The frames are divided in segments
+    of segment_length consecutive frames, and the segments are given in turns to
+    n_workers processes (worker 0 decodes segments 0, n_workers, 2 * n_workers...),
+    each one with its own decoder (jumping to the keyframe before every segment).
+    Iterating over the decoder returns (frame_number, frame) in increasing frame
+    order. If worker_function(frame_number, frame) is given, it is applied inside
+    the worker processes and its result is returned instead of the frame, this
+    way the processing is also done in parallel. worker_function must be a module
+    level function so that it can be sent to the worker processes.
+    Without worker_function each worker decodes into the slots of its own
+    FrameRingBuffer (all the slots together use at most buffer_bytes) and only
+    the slot numbers go through the queues. The frames returned are views into
+    the slots, nothing is copied: a frame is only valid until the next one is
+    requested, then its slot is given back to the worker (copy the frames that
+    have to be kept). A worker waits when all its slots are in use.
+    If frame_cache (a MemmapFrameCache) is given the workers read the frames
+    from it, and store the ones they decode. The frames are then those of the
+    cache, downscaled if the cache is.
+    Every worker sends its results through its own queue of read_ahead results,
+    when the queue is full the worker waits. The workers are never more than a
+    segment and read_ahead results ahead of the iteration, the memory used does
+    not depend on the length of the video. If a worker fails (an exception in
+    the decoder or in worker_function) or dies without finishing its segments
+    (for example killed by the system when memory runs out) the iteration raises
+    RuntimeError when it reaches the frames of that worker.
+    """
+
+    def __init__(self, video_filename, frame_numbers=None, n_workers=None, keyframe_index=None,
+                 worker_function=None, segment_length=100, read_ahead=None, backend='opencv',
+                 poll_seconds=1.0, buffer_bytes=512 * 1024 ** 2, frame_cache=None):
+        self.video_filename = video_filename
+        self.backend = backend
+        stream = open_video(video_filename, backend)
+        if frame_numbers is None:
+            frame_numbers = range(int(stream.get(cv2.CAP_PROP_FRAME_COUNT)))
+        self.frame_shape = (int(stream.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(stream.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+        stream.release()
+        self.frame_numbers = sorted(set(frame_numbers))
+        self.keyframe_index = keyframe_index
+        self.worker_function = worker_function
+        self.poll_seconds = poll_seconds
+        self.frame_cache = frame_cache
+        if frame_cache is not None:
+            self.frame_shape = frame_cache.shape[1:]
+
+        # very short segments spend more time seeking than decoding
+        self.segments = self.split(self.frame_numbers, segment_length)
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        self.n_workers = max(min(n_workers, len(self.segments)), 1)
+        # a worker can prepare the whole of its next segment while it waits for its turn
+        self.read_ahead = read_ahead if read_ahead is not None else segment_length
+        # at least one slot for the frame being used and one for the frame being decoded
+        frame_bytes = int(np.prod(self.frame_shape))
+        self.ring_slots = min(max(buffer_bytes // (frame_bytes * self.n_workers), 2), self.read_ahead + 1)
+
+        self.processes = []
+        self.queues = []  # one per worker
+        self.ring_buffers = []  # one per worker, only if the frames are returned
+
+    @staticmethod
+    def split(frame_numbers, segment_length):
+        # divide the frames in groups of segment_length frames (the last one can be shorter)
+        segment_length = max(segment_length, 1)
+        return [frame_numbers[i:i + segment_length] for i in range(0, len(frame_numbers), segment_length)]
+
+    def start(self):
+        for worker in range(self.n_workers):
+            self.queues.append(multiprocessing.Queue(self.read_ahead))
+            ring_buffer = None
+            if self.worker_function is None:
+                ring_buffer = FrameRingBuffer(self.ring_slots, self.frame_shape)
+                self.ring_buffers.append(ring_buffer)
+            segments = [(segment, self.segments[segment])
+                        for segment in range(worker, len(self.segments), self.n_workers)]
+            process = multiprocessing.Process(target=decode_segments,
+                                              args=(self.video_filename, segments, self.keyframe_index,
+                                                    self.queues[worker], self.worker_function, self.backend,
+                                                    ring_buffer, self.frame_cache))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        return self
+
+    def frames_text(self, segment):
+        return 'frames ' + str(self.segments[segment][0]) + '-' + str(self.segments[segment][-1])
+
+    def receive(self, segment):
+        # next message of the worker of a segment. If there is none for a while, verify
+        # that the worker is still running. A worker that died had time to send
+        # everything it had sent before the check, so it is only an error if there is
+        # still nothing after checking twice
+        worker = segment % self.n_workers
+        dead = False
+        while True:
+            try:
+                return self.queues[worker].get(timeout=self.poll_seconds)
+            except queue_module.Empty:
+                process = self.processes[worker]
+                if not process.is_alive():
+                    if dead:
+                        raise RuntimeError('The worker of ' + self.frames_text(segment) + ' stopped (exit code ' +
+                                           str(process.exitcode) + ')')
+                    dead = True
+
+    def __iter__(self):
+        if not self.processes:
+            self.start()
+        try:
+            for segment in range(len(self.segments)):
+                while True:
+                    kind, received, frame_number, frame = self.receive(segment)
+                    if kind == 'error':
+                        raise RuntimeError('The worker of ' + self.frames_text(received) + ' failed at frame ' +
+                                           str(frame_number) + ':\n' + frame)
+                    if kind == 'end':
+                        break
+                    if self.ring_buffers:
+                        ring_buffer = self.ring_buffers[segment % self.n_workers]
+                        yield frame_number, ring_buffer.slot(frame)
+                        # the next frame was requested, the worker can write the slot again
+                        ring_buffer.release(frame)
+                    else:
+                        yield frame_number, frame
+        finally:
+            self.stop()
+
+    def stop(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.processes = []
+        for ring_buffer in self.ring_buffers:
+            try:
+                ring_buffer.close()
+            except BufferError:
+                # somebody still has the last frame, the memory is unmapped when it is deleted
+                pass
+            ring_buffer.unlink()
+        self.ring_buffers = []
+        self.queues = []